@@ -193,7 +193,7 @@ def create_features(_df_in):
         # ,'per_change_close'
         # ,'ema26'
     ]:
-        _df_out[_col] = [norm_time_s(_x,_df_out[_col],CONFIG['feature_eng']['norm_window'],_mode='std') for _x in _df_out.index]
+        _df_out[_col] = norm_time_series(_df_out[_col],CONFIG['feature_eng']['norm_window'],mode='std')
     #Between -1 and 1
     # for _col in [
     #     'macd'
@@ -54,7 +54,7 @@ def build_ft_arrays(df_in):
         ------
         list - list of outputs
         """
-        li = [norm_time_s(x,df_in[col],CONFIG['nn_ft_eng']['ft_periods'],_return_series=True,_fill_window=True).tolist() for x in df_in.index]
+        li = norm_time_windows(df_in[col],CONFIG['nn_ft_eng']['ft_periods']).tolist()
         if reverse:
             li = [1 - np.array(x) for x in li]
         return li
@@ -70,7 +70,7 @@ def build_ft_arrays(df_in):
         ------
         3 lists - list of absolute outputs,list of binaries showing positive
         """
-        raw_li = [norm_time_s(x,df_in[col],CONFIG['nn_ft_eng']['ft_periods'],_return_series=True,_fill_window=True,_neg_vals=True).tolist() for x in df_in.index]
+        raw_li = norm_time_windows(df_in[col],CONFIG['nn_ft_eng']['ft_periods'],neg_vals=True).tolist()
         abs_li = [np.abs(x).tolist() for x in raw_li]
         pos_binary_li = [(np.array(x) > 0).astype(int).tolist() for x in raw_li]
         neg_binary_li = [(np.array(x) < 0).astype(int).tolist() for x in raw_li]
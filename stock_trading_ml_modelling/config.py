@@ -13,6 +13,45 @@ CONFIG = {
     },
     "scrape":{
         "max_days":140,
+        "concurrency":8, #Open connections
+        "limit_per_host":4,
+        "host_rate":2.0, #Requests started per second to each host
+        "write_queue_size":32, #Scraped tickers waiting to be written
+        "retries":5, #Attempts per url
+        "backoff_base":1.0, #Seconds, doubled each retry (with jitter)
+        "backoff_max":60.0,
+        "request_timeout":30.0, #Seconds for one attempt
+        "total_timeout":300.0, #Seconds for all attempts at a url
+        "breaker_threshold":10, #Consecutive failures before requests to a host stop
+        "breaker_reset":120.0, #Seconds before a host is tried again
+        "parser":"lxml", #"selectolax" (if installed), "lxml" or "bs4"
+        "parse_workers":2, #Processes parsing pages, 0 to parse on the event loop
+        "cache":{
+            "mode":"normal", #"normal", "offline" (replay from the cache) or "off"
+            #Seconds before a cached page is revalidated, by web_addr source
+            "ttl":{
+                "ftse100":12*3600,
+                "ftse250":12*3600,
+                "share_price":6*3600,
+                "holidays":30*86400,
+            },
+            #Price windows ending this many days ago can no longer change
+            "final_after_days":7,
+        },
+    },
+    "db":{
+        "insert_batch_size":10000,
+        "read_chunksize":100000,
+        "pool_size":5,
+        "max_overflow":10,
+        "pragmas":{
+            "journal_mode":"WAL",
+            "synchronous":"NORMAL",
+            "cache_size":-64000, #64MB
+            "mmap_size":268435456, #256MB
+            "temp_store":"MEMORY",
+            "busy_timeout":30000, #ms
+        },
     },
     'files':{
         "store_path":Path(__file__).parent.parent / r"data"
@@ -24,6 +63,8 @@ CONFIG = {
         ,"hist_prices_w":r"all_hist_prices_w.h5"
         ,"hist_prices_w_tmp":r"all_hist_prices_w_TMP.h5"
         ,"prices_db":r"prices.db"
+        ,"price_store":r"price_store"
+        ,"http_cache":r"http_cache.db"
         ,"ft_eng_w_tmp":r"all_hist_prices_w_ft_eng2_TMP.h5"
         ,"ft_eng_w":r"all_hist_prices_w_ft_eng2.h5"
         ,"ft_eng_col_list":r"feature_engineering_feature_list.txt"
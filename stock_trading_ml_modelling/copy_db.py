@@ -4,16 +4,13 @@ from sqlalchemy.orm import sessionmaker, scoped_session
 from tqdm import tqdm
 
 from stock_trading_ml_modelling.config import CONFIG
-from sqlalchemy import create_engine
-from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df, sqlaq_to_df_chunks
 from stock_trading_ml_modelling.database import ticker, ticker_market, daily_price, weekly_price
-from stock_trading_ml_modelling.database.add_data import _add_df
-from stock_trading_ml_modelling.database.models import engine, Session as session
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
+from stock_trading_ml_modelling.database.models import engine, Session as session, create_sqlite_engine
 from stock_trading_ml_modelling.database.models.prices import create_db, Ticker, TickerMarket, DailyPrice, WeeklyPrice
 
-eng_old = create_engine(
-    f'sqlite:///{str(CONFIG["files"]["store_path"] / "prices_old.db")}'
-)
+eng_old = create_sqlite_engine(CONFIG["files"]["store_path"] / "prices_old.db", read_only=True)
 old_session = scoped_session(sessionmaker(bind=eng_old, expire_on_commit=False))
 
 #Create the new db
@@ -22,22 +19,19 @@ create_db(engine)
 #ticker
 ticker_df = sqlaq_to_df(ticker.fetch(), session=old_session)
 #add to the new database
-_add_df(ticker_df, Ticker)
+_bulk_add_df(ticker_df, Ticker)
 
 #ticker_market
 ticker_market_df = sqlaq_to_df(ticker_market.fetch(), session=old_session)
 #add to the new database
-_add_df(ticker_market_df, TickerMarket)
+_bulk_add_df(ticker_market_df, TickerMarket)
 
-#daily_price
-for id in tqdm(ticker_df.id, total=ticker_df.shape[0]):
-    daily_price_df = sqlaq_to_df(daily_price.fetch(ticker_ids=[id]), session=old_session)
+#daily_price - streamed in chunks so the whole table is never held in memory
+for daily_price_df in tqdm(sqlaq_to_df_chunks(daily_price.fetch(), session=old_session), desc="Copy daily_price"):
     #add to the new database
-    _add_df(daily_price_df, DailyPrice)
+    _bulk_add_df(daily_price_df, DailyPrice)
 
 #weekly_price
-for id in tqdm(ticker_df.id, total=ticker_df.shape[0]):
-    weekly_price_df = sqlaq_to_df(weekly_price.fetch(ticker_ids=[id]), session=old_session)
+for weekly_price_df in tqdm(sqlaq_to_df_chunks(weekly_price.fetch(), session=old_session), desc="Copy weekly_price"):
     #add to the new database
-    _add_df(weekly_price_df, WeeklyPrice)
-
+    _bulk_add_df(weekly_price_df, WeeklyPrice)
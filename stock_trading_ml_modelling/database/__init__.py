@@ -1,23 +1,27 @@
 """Create sub-classes for querying the database"""
+import datetime as dt
+import pandas as pd
 from sqlalchemy import func, and_
 
 from stock_trading_ml_modelling.database.models import Session as session
-from stock_trading_ml_modelling.database.models.prices import Ticker, TickerMarket, DailyPrice, WeeklyPrice
-from stock_trading_ml_modelling.database.add_data import _add_df
+from stock_trading_ml_modelling.database.models.prices import Ticker, TickerMarket, DailyPrice, WeeklyPrice, MarketHoliday, MarketHolidayYear
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
 from stock_trading_ml_modelling.database.update_data import _update_df
+from stock_trading_ml_modelling.database.upsert_data import _upsert_df
 
 
 class TickerCl:
     def __init__(self):
         pass
 
-    def add_df(self, df, session=session):
+    def add_df(self, df, session=session, batch_size:int=None):
         """Function to add data to the database.
         
         args:
         ----
         df - pandas dataframe - the data to be added to the database
         session - sqla session:None - the db session object
+        batch_size - int:None - the rows per insert (None for the config default)
 
         returns:
         ----
@@ -29,7 +33,7 @@ class TickerCl:
                 keep_cols.append('last_seen_date')
             df = df[keep_cols] \
                 .drop_duplicates()
-            _add_df(df, Ticker, session=session)
+            _bulk_add_df(df, Ticker, session=session, batch_size=batch_size)
 
     def fetch(self,
         ticker_ids=[],
@@ -66,13 +70,14 @@ class TickerMarketCl:
     def __init__(self):
         pass
 
-    def add_df(self, df, session=session):
+    def add_df(self, df, session=session, batch_size:int=None):
         """Function to add data to the database.
         
         args:
         ----
         df - pandas dataframe - the data to be added to the database
         session - sqla session:None - the db session object
+        batch_size - int:None - the rows per insert (None for the config default)
 
         returns:
         ----
@@ -84,7 +89,7 @@ class TickerMarketCl:
                 keep_cols.append('first_seen_date')
             df = df[keep_cols] \
                 .drop_duplicates()
-            _add_df(df, TickerMarket, session=session)
+            _bulk_add_df(df, TickerMarket, session=session, batch_size=batch_size)
 
     def fetch(self,
         ticker_ids=[],
@@ -119,13 +124,14 @@ class DailyPriceCl:
     def __init__(self):
         pass
 
-    def add_df(self, df, session=session):
+    def add_df(self, df, session=session, batch_size:int=None):
         """Function to add data to the database.
         
         args:
         ----
         df - pandas dataframe - the data to be added to the database
         session - sqla session:None - the db session object
+        batch_size - int:None - the rows per insert (None for the config default)
 
         returns:
         ----
@@ -134,12 +140,14 @@ class DailyPriceCl:
         if df.shape[0]:
             df = df[['date','open','high','low','close','change','volume','week_start_date','ticker_id']] \
                 .drop_duplicates()
-            _add_df(df, DailyPrice, session=session)
+            _bulk_add_df(df, DailyPrice, session=session, batch_size=batch_size)
 
     def fetch(self,
         ticker_ids=[],
         from_date=None,
-        to_date=None
+        to_date=None,
+        columns:list=None,
+        order:bool=False
         ):
         """Function to create a query to grab all sub-jobs from the offers db.
         Open sub-jobs are set to status_id 1.
@@ -147,18 +155,27 @@ class DailyPriceCl:
         args:
         ----
         ticker_ids - list:[] - the ids of the records to be extracted
+        from_date - dtatime:None - the min date for filtering records
+        to_date - dtatime:None - the max date for filtering records
+        columns - list:None - only select these columns (None for all)
+        order - bool:False - order by ticker_id and date
 
         returns:
         ----
         sqlalchemy query 
         """
-        query = session.query(DailyPrice)
+        if columns is None:
+            query = session.query(DailyPrice)
+        else:
+            query = session.query(*[getattr(DailyPrice, c) for c in columns])
         if len(ticker_ids):
             query = query.filter(DailyPrice.ticker_id.in_(ticker_ids))
         if from_date:
             query = query.filter(DailyPrice.date >= from_date)
         if to_date:
             query = query.filter(DailyPrice.date <= to_date)
+        if order:
+            query = query.order_by(DailyPrice.ticker_id, DailyPrice.date)
         return query
 
         
@@ -209,13 +226,37 @@ class DailyPriceCl:
     def update_df(self, df, session=session):
         """Function for updating records from a dataframe"""
         return _update_df(df, DailyPrice, session=session)
+
+    def upsert_df(self, df, session=session, batch_size:int=None, commit:bool=True):
+        """Function to add data to the database, updating any records which 
+        already exist for the ticker_id and date.
+        
+        args:
+        ----
+        df - pandas dataframe - the data to be upserted into the database
+        session - sqla session:None - the db session object
+        batch_size - int:None - the rows per statement (None for the config default)
+        commit - bool:True - commit once upserted (False to leave the transaction open)
+
+        returns:
+        ----
+        int - the number of rows upserted
+        """
+        if not df.shape[0]:
+            return 0
+        #Last record wins if the df has duplicates
+        df = df[['date','open','high','low','close','change','volume','week_start_date','ticker_id']] \
+            .drop_duplicates(subset=['ticker_id','date'], keep='last')
+        return _upsert_df(df, DailyPrice, session=session, batch_size=batch_size, commit=commit)
         
     def remove(self,
         ids=[],
         ticker_ids=[],
         from_date=None,
         to_date=None,
-        del_all=False
+        del_all=False,
+        session=session,
+        commit:bool=True
         ):
         """Function to delete records from the daily prices table.
         
@@ -226,6 +267,9 @@ class DailyPriceCl:
         from_date - dtatime:None - the min date for filtering records
         to_date - dtatime:None - the max date for filtering records
         del_all - bool:False - safety to prevet deleting the whole table
+        session - sqla session:None - the db session object
+        commit - bool:True - commit once deleted (False to leave the transaction open,
+            errors are then raised for the caller to roll back)
 
         returns:
         ----
@@ -246,22 +290,26 @@ class DailyPriceCl:
             if to_date:
                 query = query.filter(DailyPrice.date <= to_date)
             query.delete(synchronize_session=False)
-            session.commit()
+            if commit:
+                session.commit()
             return True
         except:
+            if not commit:
+                raise
             return False
 
 class WeeklyPriceCl:
     def __init__(self):
         pass
 
-    def add_df(self, df, session=session):
+    def add_df(self, df, session=session, batch_size:int=None):
         """Function to add data to the database.
         
         args:
         ----
         df - pandas dataframe - the data to be added to the database
         session - sqla session:None - the db session object
+        batch_size - int:None - the rows per insert (None for the config default)
 
         returns:
         ----
@@ -270,12 +318,14 @@ class WeeklyPriceCl:
         if df.shape[0]:
             df = df[['date','open','high','low','close','change','volume','ticker_id']] \
                 .drop_duplicates()
-            _add_df(df, WeeklyPrice, session=session)
+            _bulk_add_df(df, WeeklyPrice, session=session, batch_size=batch_size)
 
     def fetch(self,
         ticker_ids=[],
         from_date=None,
-        to_date=None
+        to_date=None,
+        columns:list=None,
+        order:bool=False
         ):
         """Function to create a query to grab all sub-jobs from the offers db.
         Open sub-jobs are set to status_id 1.
@@ -283,18 +333,27 @@ class WeeklyPriceCl:
         args:
         ----
         ticker_ids - list:[] - the ids of the records to be extracted
+        from_date - dtatime:None - the min date for filtering records
+        to_date - dtatime:None - the max date for filtering records
+        columns - list:None - only select these columns (None for all)
+        order - bool:False - order by ticker_id and date
 
         returns:
         ----
         sqlalchemy query 
         """
-        query = session.query(WeeklyPrice)
+        if columns is None:
+            query = session.query(WeeklyPrice)
+        else:
+            query = session.query(*[getattr(WeeklyPrice, c) for c in columns])
         if len(ticker_ids):
             query = query.filter(WeeklyPrice.ticker_id.in_(ticker_ids))
         if from_date:
             query = query.filter(WeeklyPrice.date >= from_date)
         if to_date:
             query = query.filter(WeeklyPrice.date <= to_date)
+        if order:
+            query = query.order_by(WeeklyPrice.ticker_id, WeeklyPrice.date)
         return query
 
     def fetch_latest(self,
@@ -345,12 +404,36 @@ class WeeklyPriceCl:
         """Function for updating records from a dataframe"""
         return _update_df(df, WeeklyPrice, session=session)
 
+    def upsert_df(self, df, session=session, batch_size:int=None, commit:bool=True):
+        """Function to add data to the database, updating any records which 
+        already exist for the ticker_id and date.
+        
+        args:
+        ----
+        df - pandas dataframe - the data to be upserted into the database
+        session - sqla session:None - the db session object
+        batch_size - int:None - the rows per statement (None for the config default)
+        commit - bool:True - commit once upserted (False to leave the transaction open)
+
+        returns:
+        ----
+        int - the number of rows upserted
+        """
+        if not df.shape[0]:
+            return 0
+        #Last record wins if the df has duplicates
+        df = df[['date','open','high','low','close','change','volume','ticker_id']] \
+            .drop_duplicates(subset=['ticker_id','date'], keep='last')
+        return _upsert_df(df, WeeklyPrice, session=session, batch_size=batch_size, commit=commit)
+
     def remove(self,
         ids=[],
         ticker_ids=[],
         from_date=None,
         to_date=None,
-        del_all=False
+        del_all=False,
+        session=session,
+        commit:bool=True
         ):
         """Function to delete records from the weekly prices table.
         
@@ -361,6 +444,9 @@ class WeeklyPriceCl:
         from_date - dtatime:None - the min date for filtering records
         to_date - dtatime:None - the max date for filtering records
         del_all - bool:False - safety to prevet deleting the whole table
+        session - sqla session:None - the db session object
+        commit - bool:True - commit once deleted (False to leave the transaction open,
+            errors are then raised for the caller to roll back)
 
         returns:
         ----
@@ -381,12 +467,120 @@ class WeeklyPriceCl:
             if to_date:
                 query = query.filter(WeeklyPrice.date <= to_date)
             query.delete(synchronize_session=False)
-            session.commit()
+            if commit:
+                session.commit()
             return True
         except:
+            if not commit:
+                raise
             return False
 
+class MarketHolidayCl:
+    def __init__(self):
+        pass
+
+    def fetch(self,
+        from_date=None,
+        to_date=None
+        ):
+        """Function to create a query for the days the market is closed on a weekday.
+        
+        args:
+        ----
+        from_date - dtatime:None - the min date for filtering records
+        to_date - dtatime:None - the max date for filtering records
+
+        returns:
+        ----
+        sqlalchemy query 
+        """
+        query = session.query(MarketHoliday.date, MarketHoliday.name)
+        if from_date:
+            query = query.filter(MarketHoliday.date >= from_date)
+        if to_date:
+            query = query.filter(MarketHoliday.date <= to_date)
+        return query.order_by(MarketHoliday.date)
+
+    def fetch_years(self,
+        from_year:int=None,
+        to_year:int=None
+        ):
+        """Function to create a query for the years holidays have been scraped for
+        and when they were last scraped.
+        
+        args:
+        ----
+        from_year - int:None - the min year for filtering records
+        to_year - int:None - the max year for filtering records
+
+        returns:
+        ----
+        sqlalchemy query 
+        """
+        query = session.query(MarketHolidayYear.year, MarketHolidayYear.fetched_date)
+        if from_year:
+            query = query.filter(MarketHolidayYear.year >= from_year)
+        if to_year:
+            query = query.filter(MarketHolidayYear.year <= to_year)
+        return query.order_by(MarketHolidayYear.year)
+
+    def upsert_df(self, df, session=session, batch_size:int=None, commit:bool=True):
+        """Function to add holidays to the database, updating the name of any
+        which already exist for the date.
+        
+        args:
+        ----
+        df - pandas dataframe - date and name of the holidays
+        session - sqla session:None - the db session object
+        batch_size - int:None - the rows per statement (None for the config default)
+        commit - bool:True - commit once upserted (False to leave the transaction open)
+
+        returns:
+        ----
+        int - the number of rows upserted
+        """
+        if not df.shape[0]:
+            return 0
+        df = df[['date','name']] \
+            .drop_duplicates(subset=['date'], keep='last')
+        return _upsert_df(df, MarketHoliday, index_elements=["date"], session=session, batch_size=batch_size, commit=commit)
+
+    def replace_years(self, df, years:list, fetched_date=None, session=session):
+        """Function to store the scraped holidays of some years and record the years
+        as fetched, in one transaction. The stored holidays of each year with holidays
+        in df are replaced, so holidays which have been moved or cancelled are removed.
+        Years with none in df keep any stored holidays.
+        
+        args:
+        ----
+        df - pandas dataframe - date and name of the holidays
+        years - list - the years (ints) which were scraped
+        fetched_date - date:None - when the years were scraped (None for today)
+        session - sqla session:None - the db session object
+
+        returns:
+        ----
+        int - the number of holidays upserted
+        """
+        fetched_date = dt.date.today() if fetched_date is None else fetched_date
+        holiday_years = set(pd.to_datetime(df.date).dt.year) if df.shape[0] else set()
+        try:
+            for year in sorted(holiday_years):
+                session.query(MarketHoliday) \
+                    .filter(MarketHoliday.date >= dt.date(year, 1, 1), MarketHoliday.date <= dt.date(year, 12, 31)) \
+                    .delete(synchronize_session=False)
+            n_rows = self.upsert_df(df, session=session, commit=False)
+            if len(years):
+                _upsert_df(pd.DataFrame({"year":sorted(set(years)), "fetched_date":fetched_date}),
+                    MarketHolidayYear, index_elements=["year"], session=session, commit=False)
+            session.commit()
+        except:
+            session.rollback()
+            raise
+        return n_rows
+
 ticker = TickerCl()
 ticker_market = TickerMarketCl()
 daily_price = DailyPriceCl()
-weekly_price = WeeklyPriceCl()
\ No newline at end of file
+weekly_price = WeeklyPriceCl()
+market_holiday = MarketHolidayCl()
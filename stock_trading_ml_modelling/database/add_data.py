@@ -1,7 +1,10 @@
 """Functions for adding data to the prices database"""
 import re
+import time
 import pandas as pd
 
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.utils.data import overlap
 
 from stock_trading_ml_modelling.database.models import Session as session
@@ -13,6 +16,65 @@ def sqlaq_to_df(self, query, session=session, limit=None):
     out_df = out_df.iloc[:limit] if limit < out_df.shape[0] else out_df
     return out_df
 
+def _table_cols(df, DestClass, fields=[]):
+    """The columns of df which are in the table (and fields if given)"""
+    #Get table columns
+    tab_cols = DestClass.__table__.columns
+    #Remove table name prefix
+    tab_name = DestClass.__table__.name
+    tab_cols = [re.sub(fr"^{tab_name}\.", "", str(c)) for c in tab_cols]
+    cols = overlap([tab_cols, df.columns])
+    if len(fields) > 0:
+        cols = overlap([cols, fields])
+    return cols
+
+def _column_values(s):
+    """Convert a column into a list of python values (as the db driver needs), nulls become None"""
+    if pd.api.types.is_datetime64_any_dtype(s):
+        s = s.dt.date
+    values = s.to_numpy().tolist()
+    nulls = s.isnull().to_numpy()
+    if nulls.any():
+        values = [None if n else v for v, n in zip(values, nulls)]
+    return values
+
+def _bulk_add_df(df, DestClass, fields=[], session=session, batch_size:int=None):
+    """Fast function for adding to a table from a dataframe. Rows are sent as Core
+    executemany inserts built from the column arrays, no ORM objects are created.
+    All batches are inserted in a single transaction.
+    
+    args:
+    ----
+    df - pandas dataframe - the records to be added to the database 
+    DestClass - sqla table class - the class of the receiving table
+    fields - list:[] - limit the columns inserted to these fields
+    session - sqla session:None - the offers db session object
+    batch_size - int:None - the rows per executemany (None for CONFIG["db"]["insert_batch_size"])
+
+    returns:
+    ----
+    int - the number of rows inserted
+    """
+    batch_size = CONFIG["db"]["insert_batch_size"] if batch_size is None else batch_size
+    cols = _table_cols(df, DestClass, fields)
+    n_rows = df.shape[0]
+    if not n_rows:
+        return 0
+    st_time = time.perf_counter()
+    col_values = [_column_values(df[c]) for c in cols]
+    insert = DestClass.__table__.insert()
+    try:
+        for st in range(0, n_rows, batch_size):
+            batch = zip(*(v[st:st + batch_size] for v in col_values))
+            session.execute(insert, [dict(zip(cols, r)) for r in batch])
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    secs = time.perf_counter() - st_time
+    log.info(f"{n_rows} rows added to {DestClass.__table__.name} in {secs:.2f}s - {n_rows / max(secs, 1e-9):.0f} rows/sec")
+    return n_rows
+
 def _add_df(df, DestClass, fields=[], session=session):
     """Generic function for adding to a table from a dataframe.
     
@@ -26,14 +88,7 @@ def _add_df(df, DestClass, fields=[], session=session):
     ----
     None
     """
-    #Get table columns
-    tab_cols = DestClass.__table__.columns
-    #Remove table name prefix
-    tab_name = DestClass.__table__.name
-    tab_cols = [re.sub(fr"^{tab_name}\.", "", str(c)) for c in tab_cols]
-    cols = overlap([tab_cols, df.columns])
-    if len(fields) > 0:
-        cols = overlap([cols, fields])
+    cols = _table_cols(df, DestClass, fields)
     df = df[cols]
     objects = [DestClass(**r) for _,r in df.iterrows()]
     session.bulk_save_objects(objects)
@@ -0,0 +1,84 @@
+"""Benchmark per-ticker price fetches before and after the index migrations
+
+Run against a copy of the real db:
+    python -m stock_trading_ml_modelling.database.benchmark path/to/prices_copy.db
+or with no path to build a synthetic db in a temp folder. The db given is
+migrated in place, so do not point it at the live prices.db.
+"""
+import sys
+import time
+import tempfile
+import datetime as dt
+import numpy as np
+import pandas as pd
+from pathlib import Path
+from sqlalchemy import create_engine, select, text
+
+from stock_trading_ml_modelling.database.models.prices import DailyPrice, WeeklyPrice
+from stock_trading_ml_modelling.database.models.migrations import migrate, get_version
+
+def create_synthetic_db(path, n_tickers:int=500, n_days:int=2500):
+    """Create a db with daily prices and no indexes (as an old prices.db)"""
+    engine = create_engine(f"sqlite:///{path}")
+    for table in [DailyPrice.__table__, WeeklyPrice.__table__]:
+        table.create(engine, checkfirst=True)
+        for index in table.indexes:
+            index.drop(engine)
+    dates = [d.date() for d in pd.bdate_range(end=dt.date.today(), periods=n_days)]
+    rng = np.random.default_rng(0)
+    insert = DailyPrice.__table__.insert()
+    with engine.begin() as conn:
+        #Interleave tickers by date, as a daily scrape writes them
+        for date in dates:
+            prices = rng.random(n_tickers) * 100
+            conn.execute(insert, [{
+                "date":date, "open":p, "high":p, "low":p, "close":p, "change":0.0,
+                "volume":1000.0, "week_start_date":date, "ticker_id":tick_id
+                } for tick_id, p in enumerate(prices, start=1)])
+    return engine
+
+def time_ticker_fetches(engine, ticker_ids, from_date=None, repeats:int=3):
+    """Median seconds to fetch the prices of one ticker"""
+    times = []
+    with engine.connect() as conn:
+        for _ in range(repeats):
+            for tick_id in ticker_ids:
+                query = select(DailyPrice.__table__).where(DailyPrice.ticker_id == int(tick_id))
+                if from_date:
+                    query = query.where(DailyPrice.date >= from_date)
+                st_time = time.perf_counter()
+                conn.execute(query).fetchall()
+                times.append(time.perf_counter() - st_time)
+    return float(np.median(times))
+
+def run_benchmark(engine, n_sample:int=20):
+    """Time per-ticker fetches, run the migrations and time them again"""
+    with engine.connect() as conn:
+        ticker_ids = [r[0] for r in conn.execute(text("SELECT DISTINCT ticker_id FROM daily_price"))]
+        max_date = conn.execute(text("SELECT MAX(date) FROM daily_price")).scalar()
+    ticker_ids = np.random.default_rng(0).choice(ticker_ids, size=min(n_sample, len(ticker_ids)), replace=False)
+    from_date = (pd.Timestamp(max_date) - pd.Timedelta(weeks=52)).date()
+    results = {}
+    results["before_all"] = time_ticker_fetches(engine, ticker_ids)
+    results["before_year"] = time_ticker_fetches(engine, ticker_ids, from_date=from_date)
+    st_time = time.perf_counter()
+    version = migrate(engine)
+    results["migrate_secs"] = time.perf_counter() - st_time
+    results["after_all"] = time_ticker_fetches(engine, ticker_ids)
+    results["after_year"] = time_ticker_fetches(engine, ticker_ids, from_date=from_date)
+    print(f"Schema version {version}, migration took {results['migrate_secs']:.1f}s")
+    for fetch in ["all", "year"]:
+        before, after = results[f"before_{fetch}"], results[f"after_{fetch}"]
+        print(f"Fetch {fetch} prices for a ticker: {before * 1000:.2f}ms -> {after * 1000:.2f}ms ({before / after:.0f}x)")
+    return results
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        engine = create_engine(f"sqlite:///{sys.argv[1]}")
+    else:
+        path = Path(tempfile.mkdtemp()) / "prices_bench.db"
+        print(f"Building synthetic db at {path}")
+        engine = create_synthetic_db(path)
+    if get_version(engine):
+        print("WARNING: db has already been migrated, the before times will include the indexes")
+    run_benchmark(engine)
@@ -1,7 +1,70 @@
 """File to delete data from stock_trading_ml_modelling.database database"""
 import pandas as pd
+from sqlalchemy import func, select, delete
 
 from stock_trading_ml_modelling.config import CONFIG
 from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.database.models.prices import Ticker, TickerMarket, DailyPrice, WeeklyPrice
 from stock_trading_ml_modelling.database.models import Session as session
+
+def _duplicates_select(DestClass):
+    """Select the records which share a ticker_id and date with another record and
+    are not the one kept - the one with the highest volume, then the last added.
+    Every (ticker_id, date) is ranked with ROW_NUMBER() in one pass over the table.
+
+    args:
+    ----
+    DestClass - sqla table class - the prices table (DailyPrice or WeeklyPrice)
+
+    returns:
+    ----
+    sqla select - id, ticker_id, date, volume and dup_rank (2 and up) of each duplicate
+    """
+    dup_rank = func.row_number().over(
+        partition_by=(DestClass.ticker_id, DestClass.date),
+        order_by=(DestClass.volume.desc(), DestClass.id.desc()),
+        ).label("dup_rank")
+    ranked = select(DestClass.id, DestClass.ticker_id, DestClass.date, DestClass.volume, dup_rank) \
+        .subquery("ranked")
+    return select(ranked).where(ranked.c.dup_rank > 1)
+
+def _remove_duplicates_statement(DestClass):
+    """The single DELETE of the records selected by _duplicates_select, run by
+    _remove_duplicates and by the migration adding the unique price indexes"""
+    dups = _duplicates_select(DestClass).subquery("dups")
+    return delete(DestClass.__table__).where(DestClass.id.in_(select(dups.c.id)))
+
+def _find_duplicates(DestClass, session=session):
+    """The duplicate prices which _remove_duplicates would delete
+
+    args:
+    ----
+    DestClass - sqla table class - the prices table (DailyPrice or WeeklyPrice)
+    session - sqla session:None - the db session object
+
+    returns:
+    ----
+    pandas dataframe - id, ticker_id, date, volume and dup_rank of each duplicate
+    """
+    return pd.read_sql(_duplicates_select(DestClass), con=session.bind)
+
+def _remove_duplicates(DestClass, session=session):
+    """Remove duplicate prices (by ticker_id and date) with a single DELETE,
+    keeping the record with the highest volume.
+
+    args:
+    ----
+    DestClass - sqla table class - the prices table (DailyPrice or WeeklyPrice)
+    session - sqla session:None - the db session object
+
+    returns:
+    ----
+    int - the number of records deleted
+    """
+    try:
+        removed = session.execute(_remove_duplicates_statement(DestClass)).rowcount
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return removed
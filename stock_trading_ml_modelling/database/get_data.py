@@ -1,16 +1,116 @@
 """File to fetch data from stock_trading_ml_modelling.database database"""
+import numpy as np
 import pandas as pd
-from sqlalchemy import func, and_
+from sqlalchemy import func, and_, type_coerce, String, Date, DateTime, Integer, Float
 
 from stock_trading_ml_modelling.config import CONFIG
 from stock_trading_ml_modelling.database.models.prices import Ticker, TickerMarket, DailyPrice, WeeklyPrice
 from stock_trading_ml_modelling.database.models import Session as session
 
 #Converting query to dataframe
-def sqlaq_to_df(query, session=session):
+def sqlaq_to_df(query, session=session, dtypes:dict=None):
+    """Run a query into a dataframe, optionally casting columns (EG to np.float32 or 
+    datetime64[ns] for date columns) as they are read"""
     out_df = pd.read_sql(query.statement, con=session.bind)
+    if dtypes is not None:
+        out_df = cast_df(out_df, dtypes)
     return out_df
 
+def cast_df(df, dtypes:dict):
+    """Cast the columns of a dataframe, datetime64 columns are parsed in one go"""
+    for c, dtype in dtypes.items():
+        if c not in df.columns:
+            continue
+        if np.issubdtype(np.dtype(dtype), np.datetime64):
+            df[c] = pd.to_datetime(df[c])
+        elif np.issubdtype(np.dtype(dtype), np.integer) and df[c].isnull().any():
+            #Ints with nulls are left as floats
+            continue
+        else:
+            df[c] = df[c].astype(dtype)
+    return df
+
+def query_dtypes(query):
+    """The dtypes for the columns of a query, taken from their sqla column types"""
+    dtypes = {}
+    for col in query.statement.selected_columns:
+        if isinstance(col.type, (Date, DateTime)):
+            dtypes[col.name] = "datetime64[ns]"
+        elif isinstance(col.type, Integer):
+            dtypes[col.name] = np.int64
+        elif isinstance(col.type, Float):
+            dtypes[col.name] = np.float64
+    return dtypes
+
+def _raw_dates_statement(query):
+    """The statement for a query with date columns read as the stored strings,
+    skipping the per-row conversion to date objects (they are parsed in bulk after)"""
+    statement = query.statement
+    return statement.with_only_columns(*[
+        type_coerce(col, String).label(col.name) if isinstance(col.type, (Date, DateTime)) else col
+        for col in statement.selected_columns
+        ])
+
+def sqlaq_to_df_chunks(query, session=session, chunksize:int=None, dtypes:dict=None):
+    """Stream a query into dataframes of chunksize rows, so a whole table can be
+    processed in bounded memory. Columns are cast with the dtypes of their sqla
+    column types (dates to datetime64), overridden by dtypes.
+
+    args:
+    ----
+    query - sqla query
+    session - sqla session:session - the session to read with
+    chunksize - int:None - the rows per dataframe (None for CONFIG["db"]["read_chunksize"])
+    dtypes - dict:None - column to dtype, overrides the dtypes from the column types
+
+    returns:
+    ----
+    generator of pandas dataframes
+    """
+    chunksize = CONFIG["db"]["read_chunksize"] if chunksize is None else chunksize
+    dtypes = {**query_dtypes(query), **({} if dtypes is None else dtypes)}
+    for chunk in pd.read_sql(_raw_dates_statement(query), con=session.bind, chunksize=chunksize):
+        yield cast_df(chunk, dtypes)
+
+def sqlaq_to_ticker_dfs(query, session=session, chunksize:int=None, dtypes:dict=None):
+    """Stream a query ordered by ticker_id, yielding all the rows for one ticker at a
+    time. Only one chunk plus the rows of one ticker are held in memory.
+
+    args:
+    ----
+    query - sqla query - must be ordered by ticker_id (EG fetch(order=True))
+    session - sqla session:None - the db session object
+    chunksize - int:None - the rows per chunk (None for the config default)
+    dtypes - dict:None - column to dtype to cast to
+
+    returns:
+    ----
+    generator of int, pandas dataframe - ticker_id, the ticker's rows
+
+    raises:
+    ----
+    ValueError - if the query is not ordered by ticker_id (a ticker's rows are not
+        together), rather than yielding the ticker again with part of its rows
+    """
+    carry = None
+    seen = set()
+    for chunk in sqlaq_to_df_chunks(query, session=session, chunksize=chunksize, dtypes=dtypes):
+        if carry is not None:
+            chunk = pd.concat([carry, chunk], ignore_index=True)
+        #The first ticker_id of each run of rows, each must be a new ticker
+        ticker_ids = chunk.ticker_id.values
+        run_ids = ticker_ids[np.r_[True, ticker_ids[1:] != ticker_ids[:-1]]]
+        if len(set(run_ids)) < len(run_ids) or seen.intersection(run_ids):
+            raise ValueError("The query must be ordered by ticker_id")
+        #The last ticker may continue into the next chunk
+        last_mask = ticker_ids == ticker_ids[-1]
+        carry = chunk[last_mask]
+        for ticker_id, tick_df in chunk[~last_mask].groupby("ticker_id", sort=False):
+            seen.add(ticker_id)
+            yield ticker_id, tick_df.reset_index(drop=True)
+    if carry is not None and carry.shape[0]:
+        yield carry.ticker_id.iloc[0], carry.reset_index(drop=True)
+
 def sqlaq_to_df_first(query, session=session):
     out_df = pd.read_sql(query.statement, con=session.bind)
     return out_df.iloc[0]
\ No newline at end of file
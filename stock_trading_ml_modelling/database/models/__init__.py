@@ -1,15 +1,67 @@
 """Model for sql database"""
-from sqlalchemy import create_engine
+from sqlalchemy import create_engine, event
+from sqlalchemy.pool import QueuePool
 from sqlalchemy.orm import sessionmaker, scoped_session
 from sqlalchemy.ext.declarative import declarative_base
 from pathlib import Path
 
 from stock_trading_ml_modelling.config import CONFIG
 
+def set_sqlite_pragmas(dbapi_conn, pragmas:dict):
+    """Run PRAGMA statements on a new sqlite connection"""
+    cursor = dbapi_conn.cursor()
+    for k, v in pragmas.items():
+        cursor.execute(f"PRAGMA {k}={v}")
+    cursor.close()
+
+def create_sqlite_engine(path, read_only:bool=False, pragmas:dict=None, pool_size:int=None, max_overflow:int=None):
+    """Create an engine for a sqlite db file with the pragmas set on every connection.
+
+    The defaults (CONFIG["db"]) suit one writer with many readers - WAL lets reads
+    carry on while the scrape writes, synchronous=NORMAL only syncs at checkpoints
+    and busy_timeout waits for a lock rather than failing with "database is locked".
+    Connections are kept in a pool so the pragmas and page cache are not lost
+    after every query.
+
+    args:
+    ----
+    path - Path - the db file
+    read_only - bool:False - open the db read-only (it must already exist)
+    pragmas - dict:None - pragma name to value (None for CONFIG["db"]["pragmas"])
+    pool_size - int:None - connections kept open (None for CONFIG["db"]["pool_size"])
+    max_overflow - int:None - extra connections allowed (None for CONFIG["db"]["max_overflow"])
+
+    returns:
+    ----
+    sqla engine
+    """
+    pragmas = dict(CONFIG["db"]["pragmas"] if pragmas is None else pragmas)
+    pool_size = CONFIG["db"]["pool_size"] if pool_size is None else pool_size
+    max_overflow = CONFIG["db"]["max_overflow"] if max_overflow is None else max_overflow
+    if read_only:
+        url = f"sqlite:///file:{Path(path).as_posix()}?mode=ro&uri=true"
+        #The journal mode is stored in the db file and can only be set by a writer
+        pragmas.pop("journal_mode", None)
+        pragmas["query_only"] = "ON"
+    else:
+        url = f"sqlite:///{str(path)}"
+    engine = create_engine(
+        url,
+        poolclass=QueuePool,
+        pool_size=pool_size,
+        max_overflow=max_overflow,
+        #Pooled connections are shared between threads (one at a time)
+        connect_args={"check_same_thread":False},
+    )
+    event.listen(engine, "connect", lambda dbapi_conn, _: set_sqlite_pragmas(dbapi_conn, pragmas))
+    return engine
+
 #Start the engine and Session
-engine = create_engine(
-    f'sqlite:///{str(CONFIG["files"]["store_path"] / CONFIG["files"]["prices_db"])}'
-)
+db_path = CONFIG["files"]["store_path"] / CONFIG["files"]["prices_db"]
+engine = create_sqlite_engine(db_path)
 Session = scoped_session(sessionmaker(bind=engine, expire_on_commit=False))
+#Read-only engine and Session for the modelling and filtering code
+read_engine = create_sqlite_engine(db_path, read_only=True)
+ReadSession = scoped_session(sessionmaker(bind=read_engine, expire_on_commit=False))
 
-Base = declarative_base()
\ No newline at end of file
+Base = declarative_base()
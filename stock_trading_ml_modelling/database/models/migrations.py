@@ -0,0 +1,87 @@
+"""Lightweight schema migrations for the prices db
+
+The schema version is held in SQLite's PRAGMA user_version. Migrations are run
+once each, in order, and the version is bumped after each one. Every migration
+is written to be safe to re-run (IF NOT EXISTS) so a db created by create_all
+with the latest models can be stamped with the latest version.
+"""
+from sqlalchemy import text
+
+from stock_trading_ml_modelling.libs.logs import log
+
+PRICE_TABLES = ["daily_price", "weekly_price"]
+
+def _m001_unique_price_indexes(conn):
+    """Unique (ticker_id, date) indexes, needed for upserts. Duplicates are removed
+    first with the same rule as remove_duplicate_daily_prices - the record with the
+    highest volume is kept, then the last added."""
+    #Imported here as the models import this module
+    from stock_trading_ml_modelling.database.models.prices import DailyPrice, WeeklyPrice
+    from stock_trading_ml_modelling.database.del_data import _remove_duplicates_statement
+    price_classes = {"daily_price":DailyPrice, "weekly_price":WeeklyPrice}
+    for table in PRICE_TABLES:
+        removed = conn.execute(_remove_duplicates_statement(price_classes[table])).rowcount
+        if removed:
+            log.warning(f"Removed {removed} duplicate records from {table}")
+        conn.execute(text(f"CREATE UNIQUE INDEX IF NOT EXISTS uix_{table}_ticker_id_date ON {table} (ticker_id, date)"))
+
+def _m002_covering_price_indexes(conn):
+    """Covering (ticker_id, date) + OHLCV indexes for per-ticker fetches and
+    (date) indexes for cross-sectional queries"""
+    for table in PRICE_TABLES:
+        conn.execute(text(
+            f"CREATE INDEX IF NOT EXISTS ix_{table}_ticker_id_date_ohlcv ON {table} (ticker_id, date, open, high, low, close, volume)"
+            ))
+        conn.execute(text(f"CREATE INDEX IF NOT EXISTS ix_{table}_date ON {table} (date)"))
+    #Update the query planner stats
+    conn.execute(text("ANALYZE"))
+
+def _m003_market_holiday_table(conn):
+    """The market_holiday table, days the exchange is closed on a weekday"""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS market_holiday ("
+        "id INTEGER NOT NULL PRIMARY KEY, date DATE NOT NULL, name VARCHAR NOT NULL)"
+        ))
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS uix_market_holiday_date ON market_holiday (date)"))
+
+def _m004_market_holiday_year_table(conn):
+    """The market_holiday_year table, the date each year's holidays were scraped"""
+    conn.execute(text(
+        "CREATE TABLE IF NOT EXISTS market_holiday_year ("
+        "year INTEGER NOT NULL PRIMARY KEY, fetched_date DATE NOT NULL)"
+        ))
+
+MIGRATIONS = [
+    _m001_unique_price_indexes,
+    _m002_covering_price_indexes,
+    _m003_market_holiday_table,
+    _m004_market_holiday_year_table,
+]
+
+def get_version(engine):
+    """The schema version of the db"""
+    with engine.connect() as conn:
+        return conn.execute(text("PRAGMA user_version")).scalar()
+
+def migrate(engine, to_version:int=None):
+    """Upgrade the db in place by running any migrations it has not had yet
+
+    args:
+    ----
+    engine - sqla engine - the db to upgrade
+    to_version - int:None - the version to migrate to (None for the latest)
+
+    returns:
+    ----
+    int - the version of the db
+    """
+    to_version = len(MIGRATIONS) if to_version is None else to_version
+    version = get_version(engine)
+    for i in range(version, to_version):
+        migration = MIGRATIONS[i]
+        log.info(f"Running migration {i + 1} - {migration.__name__}")
+        with engine.begin() as conn:
+            migration(conn)
+            conn.execute(text(f"PRAGMA user_version = {i + 1}"))
+        version = i + 1
+    return version
@@ -2,11 +2,12 @@
 
 """
 from sqlalchemy import Column, Sequence, Integer, String, Float, Date, ForeignKey, \
-    Enum, UniqueConstraint
+    Enum, UniqueConstraint, Index
 from sqlalchemy.orm import relationship
 from datetime import datetime as dt
 
 from stock_trading_ml_modelling.database.models import Base
+from stock_trading_ml_modelling.database.models.migrations import migrate
 
 class Ticker(Base):
     __tablename__ = 'ticker'
@@ -31,6 +32,14 @@ class TickerMarket(Base):
 
 class DailyPrice(Base):
     __tablename__ = 'daily_price'
+    __table_args__ = (
+        #Needed for upserts (ON CONFLICT(ticker_id, date))
+        Index('uix_daily_price_ticker_id_date', 'ticker_id', 'date', unique=True),
+        #Covering index for per-ticker fetches
+        Index('ix_daily_price_ticker_id_date_ohlcv', 'ticker_id', 'date', 'open', 'high', 'low', 'close', 'volume'),
+        #For cross-sectional queries
+        Index('ix_daily_price_date', 'date'),
+    )
     id = Column(Integer, nullable=False, primary_key=True, autoincrement=True)
     date = Column(Date, nullable=False)
     open = Column(Float, nullable=False)
@@ -42,11 +51,17 @@ class DailyPrice(Base):
     week_start_date = Column(Date, nullable=False)
     #child
     ticker_id = Column(Integer, ForeignKey('ticker.id'))
-    #constraints
-    UniqueConstraint('ticker_id', 'date', name='uix_1')
 
 class WeeklyPrice(Base):
     __tablename__ = 'weekly_price'
+    __table_args__ = (
+        #Needed for upserts (ON CONFLICT(ticker_id, date))
+        Index('uix_weekly_price_ticker_id_date', 'ticker_id', 'date', unique=True),
+        #Covering index for per-ticker fetches
+        Index('ix_weekly_price_ticker_id_date_ohlcv', 'ticker_id', 'date', 'open', 'high', 'low', 'close', 'volume'),
+        #For cross-sectional queries
+        Index('ix_weekly_price_date', 'date'),
+    )
     id = Column(Integer, nullable=False, primary_key=True, autoincrement=True)
     date = Column(Date, nullable=False)
     open = Column(Float, nullable=False)
@@ -57,8 +72,23 @@ class WeeklyPrice(Base):
     volume = Column(Float, nullable=False)
     #child
     ticker_id = Column(Integer, ForeignKey('ticker.id'))
-    #constraints
-    UniqueConstraint('ticker_id', 'date', name='uix_1')
+
+class MarketHoliday(Base):
+    __tablename__ = 'market_holiday'
+    __table_args__ = (
+        Index('uix_market_holiday_date', 'date', unique=True),
+    )
+    id = Column(Integer, nullable=False, primary_key=True, autoincrement=True)
+    date = Column(Date, nullable=False)
+    name = Column(String, nullable=False)
+
+class MarketHolidayYear(Base):
+    __tablename__ = 'market_holiday_year'
+    year = Column(Integer, nullable=False, primary_key=True, autoincrement=False)
+    #When the year's holidays were last scraped, also marks years with no holidays as checked
+    fetched_date = Column(Date, nullable=False)
     
 def create_db(engine):
-    Base.metadata.create_all(engine)
\ No newline at end of file
+    Base.metadata.create_all(engine)
+    #create_all skips tables which already exist, bring them up to date
+    migrate(engine)
\ No newline at end of file
@@ -0,0 +1,184 @@
+"""Columnar (parquet) mirror of the price tables for analytical reads
+
+Each table is kept as a hive partitioned parquet dataset with one file per year:
+    <store_path>/price_store/<table>/year=<year>/part-0.parquet
+Rows are sorted by ticker_id and date, so row group statistics let readers skip
+other tickers as well as other years. SQLite stays the source of truth - a year
+is rewritten whole from the db when it is synced.
+"""
+import os
+import shutil
+import datetime as dt
+import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from pathlib import Path
+from sqlalchemy import func
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.libs.logs import log
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database import daily_price, weekly_price
+from stock_trading_ml_modelling.database.models import ReadSession as read_session
+from stock_trading_ml_modelling.database.models.prices import DailyPrice, WeeklyPrice
+
+STORE_PATH = CONFIG["files"]["store_path"] / CONFIG["files"]["price_store"]
+ROW_GROUP_SIZE = 20000
+PARTITIONING = ds.partitioning(pa.schema([("year", pa.int16())]), flavor="hive")
+_PRICE_FIELDS = [
+    ("ticker_id", pa.int32()),
+    ("date", pa.date32()),
+    ("open", pa.float64()),
+    ("high", pa.float64()),
+    ("low", pa.float64()),
+    ("close", pa.float64()),
+    ("change", pa.float64()),
+    ("volume", pa.float64()),
+]
+SCHEMAS = {
+    "daily_price":pa.schema(_PRICE_FIELDS + [("week_start_date", pa.date32())]),
+    "weekly_price":pa.schema(_PRICE_FIELDS),
+}
+TABLES = {
+    "daily_price":(daily_price, DailyPrice),
+    "weekly_price":(weekly_price, WeeklyPrice),
+}
+
+def _year_path(table:str, year:int, path=None):
+    return Path(STORE_PATH if path is None else path) / table / f"year={year}"
+
+def _db_years(DestClass, from_date=None, session=read_session):
+    """The years with prices in the db (from from_date)"""
+    query = session.query(func.min(DestClass.date), func.max(DestClass.date))
+    min_date, max_date = query.one()
+    if max_date is None:
+        return []
+    if from_date is not None:
+        min_date = max(pd.Timestamp(min_date), pd.Timestamp(from_date))
+    return list(range(pd.Timestamp(min_date).year, pd.Timestamp(max_date).year + 1))
+
+def _store_years(table:str, path=None):
+    """The years with a partition in the store"""
+    table_path = Path(STORE_PATH if path is None else path) / table
+    if not table_path.exists():
+        return []
+    return sorted(int(p.name.split("=")[1]) for p in table_path.iterdir() if p.is_dir() and p.name.startswith("year="))
+
+def write_year(table:str, year:int, df, path=None):
+    """Write one year of prices, replacing the existing partition. The new file
+    is written alongside the old one under a name readers ignore (pyarrow skips
+    files starting with _) then renamed over it, so readers see either the whole
+    old year or the whole new year."""
+    schema = SCHEMAS[table]
+    df = df.sort_values(["ticker_id","date"])
+    arrow_table = pa.Table.from_pandas(df[schema.names], schema=schema, preserve_index=False)
+    year_path = _year_path(table, year, path=path)
+    year_path.mkdir(parents=True, exist_ok=True)
+    tmp_file = year_path / "_part-0.parquet.tmp"
+    pq.write_table(arrow_table, tmp_file, row_group_size=ROW_GROUP_SIZE)
+    #Atomic on the same file system
+    os.replace(tmp_file, year_path / "part-0.parquet")
+    return arrow_table.num_rows
+
+def remove_year(table:str, year:int, path=None):
+    """Remove a year which no longer has prices in the db. The folder is renamed
+    out of the table first so readers never see a partly deleted partition."""
+    year_path = _year_path(table, year, path=path)
+    #Outside the table folder so it is never picked up as a partition
+    old_path = year_path.parent.parent / f"_old_{table}" / year_path.name
+    shutil.rmtree(old_path, ignore_errors=True)
+    old_path.parent.mkdir(parents=True, exist_ok=True)
+    year_path.rename(old_path)
+    shutil.rmtree(old_path)
+
+def sync_price_store(tables:list=["daily_price","weekly_price"], from_date=None, path=None, session=read_session):
+    """Bring the parquet mirror up to date with the db by rewriting every year
+    from from_date onwards (all years if None). Years in the store from from_date
+    onwards with no prices left in the db are removed. Run after each scrape.
+
+    args:
+    ----
+    tables - list:["daily_price","weekly_price"] - the tables to sync
+    from_date - datetime:None - the earliest date which may have changed
+    path - Path:None - the store folder (None for STORE_PATH)
+    session - sqla session:read_session - the db session to read from
+
+    returns:
+    ----
+    dict - table to rows written
+    """
+    out = {}
+    for table in tables:
+        table_cl, DestClass = TABLES[table]
+        out[table] = 0
+        written = set()
+        for year in _db_years(DestClass, from_date=from_date, session=session):
+            df = sqlaq_to_df(table_cl.fetch(
+                from_date=dt.date(year, 1, 1),
+                to_date=dt.date(year, 12, 31)
+                ), session=session)
+            if df.shape[0]:
+                out[table] += write_year(table, year, df, path=path)
+                written.add(year)
+        #Years before from_date were not checked so are kept
+        min_year = None if from_date is None else pd.Timestamp(from_date).year
+        for year in _store_years(table, path=path):
+            if year not in written and (min_year is None or year >= min_year):
+                log.info(f"Removing {year} from the {table} price store, it has no prices in the db")
+                remove_year(table, year, path=path)
+        log.info(f"Synced {out[table]} rows of {table} to the price store")
+    return out
+
+def read_prices(table:str="daily_price", columns:list=None, ticker_ids:list=None, from_date=None, to_date=None,
+    float_dtype=None, path=None):
+    """Read prices from the parquet mirror. Only the columns asked for are read and the
+    ticker and date filters are pushed down, so only the year partitions and row
+    groups which can match are read.
+
+    args:
+    ----
+    table - str:"daily_price" - the table to read
+    columns - list:None - the columns to read (None for all)
+    ticker_ids - list:None - the tickers to read (None for all)
+    from_date - datetime:None - the min date to read
+    to_date - datetime:None - the max date to read
+    float_dtype - numpy dtype:None - cast the price columns (EG np.float32)
+    path - Path:None - the store folder (None for STORE_PATH)
+
+    returns:
+    ----
+    pandas dataframe - sorted by ticker_id and date, dates as datetime64
+    """
+    schema = SCHEMAS[table]
+    columns = schema.names if columns is None else list(columns)
+    table_path = Path(STORE_PATH if path is None else path) / table
+    if not table_path.exists():
+        return schema.empty_table().select(columns).to_pandas(date_as_object=False)
+    dataset = ds.dataset(table_path, format="parquet", partitioning=PARTITIONING)
+    filters = []
+    if ticker_ids is not None and len(ticker_ids):
+        filters.append(ds.field("ticker_id").isin([int(v) for v in ticker_ids]))
+    if from_date is not None:
+        from_date = pd.Timestamp(from_date).date()
+        filters += [ds.field("year") >= from_date.year, ds.field("date") >= pa.scalar(from_date, pa.date32())]
+    if to_date is not None:
+        to_date = pd.Timestamp(to_date).date()
+        filters += [ds.field("year") <= to_date.year, ds.field("date") <= pa.scalar(to_date, pa.date32())]
+    expr = None
+    for f in filters:
+        expr = f if expr is None else expr & f
+    #The sort columns are needed even if not asked for
+    read_cols = columns + [c for c in ["ticker_id","date"] if c not in columns]
+    arrow_table = dataset.to_table(columns=read_cols, filter=expr)
+    #Table.sort_by needs pyarrow 7, sort_indices and take work from pyarrow 3
+    arrow_table = arrow_table.take(pc.sort_indices(arrow_table, sort_keys=[("ticker_id","ascending"), ("date","ascending")])) \
+        .select(columns)
+    if float_dtype is not None:
+        float_type = pa.from_numpy_dtype(float_dtype)
+        arrow_table = arrow_table.cast(pa.schema([
+            pa.field(f.name, float_type) if pa.types.is_floating(f.type) else f
+            for f in arrow_table.schema
+            ]))
+    return arrow_table.to_pandas(date_as_object=False, split_blocks=True)
@@ -0,0 +1,56 @@
+"""Functions for upserting data into the prices database"""
+import time
+from sqlalchemy.dialects.sqlite import insert
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.libs.logs import log
+
+from stock_trading_ml_modelling.database.models import Session as session
+from stock_trading_ml_modelling.database.add_data import _table_cols, _column_values
+
+def _upsert_df(df, DestClass, index_elements:list=["ticker_id","date"], session=session, batch_size:int=None, commit:bool=True):
+    """Insert records from a dataframe, updating the existing record where one
+    already exists with the same index_elements. Uses the SQLite
+    INSERT ... ON CONFLICT(...) DO UPDATE, so needs a unique index on index_elements.
+    Each batch is sent as a single executemany statement, all in one transaction.
+    With commit=False the transaction is left open so the caller can make more
+    changes before committing.
+
+    args:
+    ----
+    df - pandas dataframe - the records to be upserted
+    DestClass - sqla table class - the class of the receiving table
+    index_elements - list:["ticker_id","date"] - the columns of the unique index
+    session - sqla session:None - the db session object
+    batch_size - int:None - the rows per statement (None for CONFIG["db"]["insert_batch_size"])
+    commit - bool:True - commit the transaction once all the rows are sent
+
+    returns:
+    ----
+    int - the number of rows upserted
+    """
+    batch_size = CONFIG["db"]["insert_batch_size"] if batch_size is None else batch_size
+    #Ids are set by the db
+    cols = [c for c in _table_cols(df, DestClass) if c != "id"]
+    n_rows = df.shape[0]
+    if not n_rows:
+        return 0
+    st_time = time.perf_counter()
+    col_values = [_column_values(df[c]) for c in cols]
+    stmt = insert(DestClass.__table__)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=index_elements,
+        set_={c:stmt.excluded[c] for c in cols if c not in index_elements}
+        )
+    try:
+        for st in range(0, n_rows, batch_size):
+            batch = zip(*(v[st:st + batch_size] for v in col_values))
+            session.execute(stmt, [dict(zip(cols, r)) for r in batch])
+        if commit:
+            session.commit()
+    except:
+        session.rollback()
+        raise
+    secs = time.perf_counter() - st_time
+    log.info(f"{n_rows} rows upserted to {DestClass.__table__.name} in {secs:.2f}s - {n_rows / max(secs, 1e-9):.0f} rows/sec")
+    return n_rows
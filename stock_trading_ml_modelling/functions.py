@@ -5,11 +5,12 @@ from pathlib import Path
 from stock_trading_ml_modelling.database.models import engine
 from stock_trading_ml_modelling.database.models import Session as session
 from stock_trading_ml_modelling.database.models.prices import create_db
+from stock_trading_ml_modelling.database.price_store import sync_price_store
 from stock_trading_ml_modelling.scrapping import full_scrape
 from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.libs.stock_filtering import filter_stocks
 from stock_trading_ml_modelling.manage_data import remove_duplicate_daily_prices, remove_duplicate_weekly_prices, \
-    fill_price_gaps
+    fill_price_gaps, rebuild_weekly_prices
 
 from stock_trading_ml_modelling.config import CONFIG
 
@@ -20,12 +21,20 @@ def run_full_scrape():
     log.set_logger("_run_full_scrape")
     full_scrape()
 
-def remove_duplicate_prices():
+def remove_duplicate_prices(dry_run:bool=False):
     log.set_logger("_remove_duplicate_prices")
     #Remove daily price duplicates
-    remove_duplicate_daily_prices()
+    remove_duplicate_daily_prices(dry_run=dry_run)
     #Remove weekly price duplicates
-    remove_duplicate_weekly_prices()
+    remove_duplicate_weekly_prices(dry_run=dry_run)
+
+def rebuild_weekly_price_table():
+    log.set_logger("_rebuild_weekly_prices")
+    rebuild_weekly_prices()
+
+def build_price_store():
+    log.set_logger("_build_price_store")
+    sync_price_store()
 
 def fill_all_price_gaps():
     log.set_logger("_fill_price_gaps")
@@ -37,6 +46,14 @@ def find_buys():
     today_str = dt.datetime.strftime(dt.datetime.today(), "%Y%m%d")
     buy_df.to_csv(Path(f"out/buys{today_str}.csv"), index=None)
 
+def find_model_signals(folder:str="cnn", batch_size:int=1024):
+    log.set_logger("_find_model_signals")
+    #Imported here so tensorflow is only loaded when scoring
+    from stock_trading_ml_modelling.modelling.inference import SignalScorer
+    scores_df = SignalScorer(folder=folder, batch_size=batch_size).score()
+    today_str = dt.datetime.strftime(dt.datetime.today(), "%Y%m%d")
+    scores_df.to_csv(Path(f"out/signals{today_str}.csv"), index=None)
+
 if __name__ == "__main__":
     # create_database()
     # remove_duplicate_prices()
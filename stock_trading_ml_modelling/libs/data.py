@@ -1,9 +1,88 @@
 """File for self.data object. Computes and manipulates self.data"""
 import pandas as pd
 import numpy as np
+import warnings
 import pandas_ta as ta
 
-from stock_trading_ml_modelling.utils.ft_eng import calc_ema, calc_macd, calc_ema_macd
+from stock_trading_ml_modelling.utils.ft_eng import calc_ema, calc_macd, calc_ema_macd, calc_ema_array, sliding_windows
+
+def _ffill_block(block):
+    """Forward fill nans along the last axis of an array, leading nans are kept"""
+    idx = np.where(np.isnan(block), 0, np.arange(block.shape[-1]))
+    np.maximum.accumulate(idx, axis=-1, out=idx)
+    return np.take_along_axis(block, idx, axis=-1)
+
+def calc_macd_block(block, ema_sht:int, ema_lng:int, sig_period:int, fillna:int=0):
+    """Function to calculate the macd for a 2-D block (IE ticker x date) in one call.
+    Matches pandas_ta.macd - emas are seeded with the sma of the first period values
+    and the signal line starts from the first valid macd value.
+
+    Missing prices (nans after the first price) are forward filled first, as the
+    filter would otherwise carry a nan into every later value. This differs
+    slightly from pandas ewm, which reweights the values either side of a gap.
+
+    args:
+    ----
+    block - numpy array - price values, time runs along the last axis
+    ema_sht - int - the period of the short ema
+    ema_lng - int - the period of the long ema
+    sig_period - int - the period of the signal line ema
+    fillna - int:0 - the value used to fill nans (None to leave them)
+
+    returns:
+    ----
+    dict - keyed on the pandas_ta column names, numpy array values
+    """
+    if ema_lng < ema_sht:
+        ema_sht, ema_lng = ema_lng, ema_sht
+    block = _ffill_block(np.asarray(block, dtype=np.float64))
+    macd = calc_ema_array(block, ema_sht) - calc_ema_array(block, ema_lng)
+    signal = calc_ema_array(macd, sig_period, lead_nan=ema_lng - 1)
+    hist = macd - signal
+    props = f"_{ema_sht}_{ema_lng}_{sig_period}"
+    out = {f"MACD{props}":macd, f"MACDh{props}":hist, f"MACDs{props}":signal}
+    if fillna is not None:
+        out = {k:np.nan_to_num(v, nan=fillna) for k,v in out.items()}
+    return out
+
+def _safe_divide(num, den):
+    """Divide arrays, returning 0 where the denominator is 0"""
+    return np.divide(num, den, out=np.zeros(np.broadcast(num, den).shape, dtype=np.result_type(num, den)), where=den != 0)
+
+def norm_windows_max_value(arr):
+    """Normalises each window (last axis) of an array to the max item in that window.
+    Windows with a max of 0 are set to 0.
+
+    args:
+    ----
+    arr - numpy array - shape (n_windows, window)
+
+    returns:
+    ----
+    numpy array
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        max = np.nanmax(arr, axis=-1, keepdims=True)
+    return _safe_divide(arr, max)
+
+def norm_windows_max_min_value(arr):
+    """Normalises each window (last axis) of an array to between the min and max
+    item in that window. Flat windows are set to 0.
+
+    args:
+    ----
+    arr - numpy array - shape (n_windows, window)
+
+    returns:
+    ----
+    numpy array
+    """
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore", category=RuntimeWarning)
+        min = np.nanmin(arr, axis=-1, keepdims=True)
+        max = np.nanmax(arr, axis=-1, keepdims=True)
+    return _safe_divide(arr - min, max - min)
 
 class Data:
     """An object for an individual series set of data
@@ -73,15 +152,17 @@ class Data:
 
     def calc_ema(self, period, lead_nan:int=0):
         """Function to create an ema series from the data"""
-        # ema_data = calc_ema(self.data, period, self.lead_nan)
-        ema_data = ta.ema(self.data, period)
+        ema_data = pd.Series(calc_ema_array(self.data.values, period), index=self.data.index)
         ema_data = ema_data.fillna(0)
         return ema_data
 
     def calc_macd(self, ema_sht:int, ema_lng:int, sig_period:int, fillna:int=0):
         """Function to create a macd dataframe from the data"""
-        # macd_data = calc_macd(self.data, ema_lng, ema_sht, sig_period)
-        macd_data = ta.macd(self.data, ema_sht, ema_lng, sig_period, fillna=fillna)
+        #Too short for the longest period (as per pandas_ta)
+        if self.data.shape[0] < max(ema_sht, ema_lng, sig_period):
+            return None
+        macd_data = calc_macd_block(self.data.values[None, :], ema_sht, ema_lng, sig_period, fillna=fillna)
+        macd_data = pd.DataFrame({k:v[0] for k,v in macd_data.items()}, index=self.data.index)
         return macd_data
 
     def calc_rsi(self, length:int=14, fillna:int=50):
@@ -115,36 +196,45 @@ class Data:
         else:
             if s.shape[0] < window:
                 extra = window - s.shape[0]
-        a = pd.Series([bulk_val] * extra)
+        a = pd.Series([bulk_val] * extra, dtype=np.float64)
         data = pd.concat((a,s))
         #Calc the number of windows
         en_i = data.shape[0] - window + 1
         return data, en_i, window
 
-    def build_moving_window_data(self, window:int=None, bulk_start:bool=False, bulk_val:float=np.nan):
+    def build_moving_window_data(self, window:int=None, bulk_start:bool=False, bulk_val:float=np.nan, copy:bool=False, dtype=None):
         """Converts a dataset into a multi-layered numpy array of values, one value for
-        each movement of the moving window"""
-        data, en_i, window = self.bulk_data_for_moving_window(self.data, window=window, bulk_val=bulk_val)
-        #Iterate over self.data and create output
-        out = []
-        index = []
-        for j in range(en_i):
-            out.append(data.iloc[j:j+window])
-            index.append(data.index[j+window-1])
-        out = np.array(out)
+        each movement of the moving window
+
+        The windows are a read-only strided view over a single copy of the data so
+        no memory is used per window. Use copy=True to get a writeable array.
+
+        args:
+        ----
+        window - int:None - size of window
+        bulk_start - bool:False - should the data be bulked so that the first 
+            value is made to be the last item of the first window
+        bulk_val - float:np.nan - the value to bulk with
+        copy - bool:False - materialise the windows into a new writeable array
+        dtype - numpy dtype:None - cast the data before windowing (EG np.float32)
+
+        returns:
+        ----
+        numpy array, numpy array - index of the last item in each window, windows of shape (n, window)
+        """
+        data, en_i, window = self.bulk_data_for_moving_window(self.data, window=window, bulk_start=bulk_start, bulk_val=bulk_val)
+        values = data.values if dtype is None else data.values.astype(dtype)
+        out = sliding_windows(values, window)
+        index = data.index.values[window-1:]
+        if copy:
+            out = out.copy()
         return index, out
 
     def fetch_last_from_moving_window(self, window:int=None):
-        """Converts a dataset into a multi-layered numpy array of values, one value for
-        each movement of the moving window"""
+        """Fetches the last value from each movement of the moving window"""
         data, en_i, window = self.bulk_data_for_moving_window(self.data, window=window)
-        #Iterate over self.data and create output
-        out = []
-        index = []
-        for j in range(en_i):
-            out.append(data.iloc[j+window-1])
-            index.append(data.index[j+window-1])
-        out = np.array(out)
+        out = data.values[window-1:]
+        index = data.index.values[window-1:]
         return index, out
 
     #Mark minimums and maximums
@@ -1,12 +1,16 @@
 
 import datetime as dt
+import numpy as np
 import pandas as pd
+from sqlalchemy import and_, or_
 
-from stock_trading_ml_modelling.utils.date import create_full_year_days, calc_wk_st_date
+from stock_trading_ml_modelling.utils.date import create_full_year_days
 from stock_trading_ml_modelling.libs.logs import log
-from stock_trading_ml_modelling.scrapping.scrape_data import get_public_holidays
-from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df, query_dtypes, cast_df
 from stock_trading_ml_modelling.database import daily_price, weekly_price
+from stock_trading_ml_modelling.database.models import Session as session
+from stock_trading_ml_modelling.database.models.prices import DailyPrice
+from stock_trading_ml_modelling.libs.trading_calendar import TradingCalendar, load_holidays
 
 def filter_year_dates(year, year_dates):
     """Function to filter out weekends and bank holidays from year dates
@@ -19,21 +23,10 @@ def filter_year_dates(year, year_dates):
     ----
     pandas dataframe
     """
-    #Mark days as required
     year_dates = pd.DataFrame(year_dates, columns=["date"])
-    #Remove weekends
-    year_dates["weekday"] = [v.weekday() for v in year_dates.date]
-    year_dates = year_dates[~year_dates.weekday.isin([5,6])] \
-        .drop(columns=["weekday"])
-    #Remove bank holidays
-    #Get bank holidys in this year
-    public_holidays = get_public_holidays(year, )
-    public_holidays = pd.DataFrame(public_holidays, columns=["date"])
-    public_holidays["flag"] = True
-    year_dates = pd.merge(year_dates, public_holidays, on=["date"], how="left")
-    year_dates = year_dates[year_dates.flag.isnull()] \
-        .drop(columns=["flag"])
-    return year_dates
+    #Remove weekends and bank holidays (stored in the db after the first scrape)
+    calendar = TradingCalendar(load_holidays([year]))
+    return year_dates[calendar.is_trading_day(year_dates.date)]
 
 def create_filtered_year_dates(year, from_date=None, to_date=None):
     """Function to create a full year of dates fltering out days when the UKX 
@@ -53,133 +46,179 @@ def create_filtered_year_dates(year, from_date=None, to_date=None):
     year_dates = filter_year_dates(year, year_dates, )
     return year_dates
 
+WEEK_PRICE_COLUMNS = ['ticker_id','date','high','low','volume','open','close','change']
+
+def calc_week_start(dates):
+    """The monday of the week of each date
+
+    args:
+    ------
+    dates - pandas series - datetime64 dates
+
+    returns:
+    ------
+    pandas series - datetime64, normalised to midnight
+    """
+    dates = pd.to_datetime(dates)
+    return dates.dt.normalize() - pd.to_timedelta(dates.dt.weekday, unit="D")
+
 #Create a weekly table
 def daily_to_weekly_price_conversion(dp_df):
-    """Function to convert the daily prices into weekly prices
+    """Function to convert the daily prices into weekly prices. Prices are grouped by
+    ticker and the monday of the week, then aggregated in one pass - the first open,
+    last close, max high, min low and total volume. Non-positive values are ignored.
     
     args:
     ------
-    dp_df - pandas dataframe - the daily prices
+    dp_df - pandas dataframe - the daily prices (any number of tickers)
 
     returns:
     ------
-    pandas dataframe
+    bool, pandas dataframe - one row per ticker and week, dated the monday
     """
     log.info('Converting daily prices to weekly prices')
-    #Mark the week identifier
-    dp_df['isocalendar'] = [x.isocalendar()[:2] for x in dp_df['date']]
-    #Get highs and lows
-    high_df = dp_df.loc[dp_df['high'] > 0, ['high','ticker_id','isocalendar']] \
-        .groupby(['ticker_id','isocalendar'], as_index=False) \
-        .max()
-    low_df = dp_df.loc[dp_df['low'] > 0, ['low','ticker_id','isocalendar']] \
-        .groupby(['ticker_id','isocalendar'], as_index=False) \
-        .min()
-    #Get total volume for the week
-    vol_df = dp_df.loc[dp_df['volume'] > 0, ['volume','ticker_id','isocalendar']] \
-        .groupby(['ticker_id','isocalendar'], as_index=False) \
-        .sum()
-    #Get max and min week days
-    max_wk_day = dp_df.loc[dp_df['close'] > 0, ['date','ticker_id','isocalendar']] \
-        .groupby(['ticker_id','isocalendar'], as_index=False) \
-        .max()
-    min_wk_day = dp_df.loc[dp_df['open'] > 0, ['date','ticker_id','isocalendar']] \
-        .groupby(['ticker_id','isocalendar'], as_index=False) \
-        .min()
-    #Get open price
-    open_df = pd.merge(dp_df[['date','open']], min_wk_day, on='date')
-    #Get close price
-    close_df = pd.merge(dp_df[['date','close']], max_wk_day, on='date')
-    #Form the final df
-    wp_df = dp_df[['ticker_id','isocalendar']]
-    wp_df = pd.merge(wp_df, min_wk_day, on=['ticker_id','isocalendar'], how="left") #date
-    wp_df = pd.merge(wp_df, high_df, on=['ticker_id','isocalendar'], how="left") #high
-    wp_df = pd.merge(wp_df, low_df, on=['ticker_id','isocalendar'], how="left") #low
-    wp_df = pd.merge(wp_df, vol_df, on=['ticker_id','isocalendar'], how="left") #volume
-    wp_df = pd.merge(wp_df, open_df[['ticker_id','isocalendar','open']], on=['ticker_id','isocalendar'], how="left") #open
-    wp_df = pd.merge(wp_df, close_df[['ticker_id','isocalendar','close']], on=['ticker_id','isocalendar'], how="left") #close
+    if not dp_df.shape[0]:
+        return True, pd.DataFrame(columns=WEEK_PRICE_COLUMNS)
+    df = pd.DataFrame({
+        "ticker_id":dp_df.ticker_id.values,
+        "date":calc_week_start(dp_df.date).values,
+        "day":pd.to_datetime(dp_df.date).values,
+        })
+    #Missing prices are ignored by the aggregations
+    for c in ["open","high","low","close","volume"]:
+        df[c] = dp_df[c].where(dp_df[c] > 0).values
+    #Sort by day so first and last give the open and close
+    df = df.sort_values(["ticker_id","day"], kind="mergesort")
+    wp_df = df.groupby(["ticker_id","date"], sort=True) \
+        .agg(
+            high=("high","max"),
+            low=("low","min"),
+            volume=("volume","sum"),
+            open=("open","first"),
+            close=("close","last"),
+            ) \
+        .reset_index()
     wp_df['change'] = wp_df['close'] - wp_df['open']
-    wp_df = wp_df.drop_duplicates() \
-        .reset_index(drop=True)
-    #Get the monday of each week
-    wp_df['date'] = [calc_wk_st_date(x) for x in wp_df.date]
-    wp_df = wp_df.drop(columns=['isocalendar'])
     #Fill missing values
     wp_df = wp_df.fillna(0)
-    return True, wp_df
+    return True, wp_df[WEEK_PRICE_COLUMNS]
 
-def split_day_prices(new_dp_df, ticker_ids=[], from_date=None, to_date=None):
-    """Function to split daily prices into update and append records
+def calc_week_prices(ticker_ids=[], from_date=None, to_date=None, session=session):
+    """Function to convert the daily prices in the db into weekly prices
     
     args:
     ------
-    new_dp_df - pandas dataframe - the dataframe with daily prices which have been scraped
     ticker_ids - list:[] - the ids of tickers to be fetched (if [] then all are fetched)
     from_date - datetime:None - the min date of prices to be fetched (if None then all are fetched)
     to_date - datetime:None - the max date of prices to be fetched (if None then all are fetched)
+    session - sqla session:None - the db session object
 
     returns:
     ------
-    pandas dataframe, pandas dataframe
+    pandas dataframe
     """
-    #Grab the existing data from the table
-    dp_df = sqlaq_to_df(daily_price.fetch(
+    query = daily_price.fetch(
         ticker_ids=ticker_ids,
         from_date=from_date,
-        to_date=to_date
-        ))
-    dp_df["date"] = dp_df.date.astype("datetime64")
-    #Mark for insert or update
-    dp_df["flag"] = 1
-    new_dp_df = pd.merge(new_dp_df, dp_df[["ticker_id","date","id","flag"]], on=["ticker_id",'date'], how='left')
-    mask = new_dp_df.flag == 1
-    update_df = new_dp_df[mask]
-    append_df = new_dp_df[~mask]
-    return [
-        update_df,
-        append_df
-    ]
-
-def split_week_prices(ticker_ids=[], from_date=None, to_date=None):
-    """Function to convert the daily prices into weekly prices and then split
-    into update and append records
-    
+        to_date=to_date,
+        columns=["ticker_id","date","open","high","low","close","volume"]
+        )
+    dp_df = sqlaq_to_df(query, session=session, dtypes=query_dtypes(query))
+    _, wp_df = daily_to_weekly_price_conversion(dp_df, )
+    return wp_df
+
+def _week_runs(weeks_df):
+    """Merge the weeks of each ticker into runs of consecutive weeks
+
     args:
     ------
-    ticker_ids - list:[] - the ids of tickers to be fetched (if [] then all are fetched)
-    from_date - datetime:None - the min date of prices to be fetched (if None then all are fetched)
-    to_date - datetime:None - the max date of prices to be fetched (if None then all are fetched)
+    weeks_df - pandas dataframe - ticker_id and date (the monday of the week)
 
     returns:
     ------
-    pandas dataframe, pandas dataframe
+    list - (ticker_id, first monday, last monday) for each run
     """
-    dp_df = sqlaq_to_df(daily_price.fetch(
-        ticker_ids=ticker_ids,
-        from_date=from_date,
-        to_date=to_date
-        ))
-    _, new_wp_df = daily_to_weekly_price_conversion(dp_df, )
+    weeks_df = weeks_df.drop_duplicates().sort_values(["ticker_id","date"])
+    ticker_ids = weeks_df.ticker_id.values
+    dates = weeks_df.date.values
+    #A run starts at a new ticker or after a week with no new prices
+    new_run = np.ones(len(dates), dtype=bool)
+    new_run[1:] = (ticker_ids[1:] != ticker_ids[:-1]) | ((dates[1:] - dates[:-1]) > np.timedelta64(7, "D"))
+    starts = np.flatnonzero(new_run)
+    ends = np.append(starts[1:], len(dates)) - 1
+    return [(int(ticker_ids[s]), pd.Timestamp(dates[s]), pd.Timestamp(dates[e])) for s, e in zip(starts, ends)]
+
+def fetch_week_daily_prices(weeks_df, session=session, runs_per_query:int=200):
+    """Fetch the daily prices of only the given weeks. The query runs on the
+    session's connection so prices upserted but not yet committed are included.
 
-    #Grab the existing data from the table
-    wp_df = sqlaq_to_df(weekly_price.fetch(
-        ticker_ids=ticker_ids,
-        from_date=from_date,
-        to_date=to_date
-        ))
-    wp_df["date"] = wp_df.date.astype("datetime64")
-    #Mark for insert or update
-    wp_df["flag"] = 1
-    new_wp_df = pd.merge(new_wp_df, wp_df[["ticker_id","date","id","flag"]], on=["ticker_id",'date'], how='left')
-    mask = new_wp_df.flag == 1
-    update_df = new_wp_df[mask]
-    append_df = new_wp_df[~mask]
-    return [
-        update_df,
-        append_df
-    ]
+    args:
+    ------
+    weeks_df - pandas dataframe - ticker_id and date (the monday of the week)
+    session - sqla session:None - the db session object
+    runs_per_query - int:200 - runs of weeks per query (sqlite limits the depth of the where clause)
 
+    returns:
+    ------
+    pandas dataframe
+    """
+    runs = _week_runs(weeks_df)
+    columns = ["ticker_id","date","open","high","low","close","volume"]
+    dfs = []
+    for st in range(0, len(runs), runs_per_query):
+        query = session.query(*[getattr(DailyPrice, c) for c in columns]) \
+            .filter(or_(*[and_(
+                DailyPrice.ticker_id == ticker_id,
+                DailyPrice.date >= first.date(),
+                DailyPrice.date < (last + dt.timedelta(days=7)).date(),
+                ) for ticker_id, first, last in runs[st:st + runs_per_query]]))
+        dfs.append(cast_df(pd.read_sql(query.statement, con=session.connection()), query_dtypes(query)))
+    if not dfs:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(dfs, ignore_index=True)
+
+def update_weekly_prices(dp_df, session=session, commit:bool=True):
+    """Recalculate the weekly prices of only the weeks which the daily prices dp_df
+    fall in. Each week is rebuilt from all of its daily prices in the db, so the
+    cost is proportional to the new daily prices rather than the price history.
 
+    args:
+    ------
+    dp_df - pandas dataframe - daily prices which have been upserted, needs ticker_id and date
+    session - sqla session:None - the db session object
+    commit - bool:True - commit once upserted (False to leave the transaction open)
 
+    returns:
+    ------
+    int - the number of weekly prices upserted
+    """
+    if not dp_df.shape[0]:
+        return 0
+    weeks_df = pd.DataFrame({
+        "ticker_id":dp_df.ticker_id.values,
+        "date":calc_week_start(dp_df.date).values,
+        })
+    _, wp_df = daily_to_weekly_price_conversion(fetch_week_daily_prices(weeks_df, session=session))
+    return weekly_price.upsert_df(wp_df, session=session, commit=commit)
+
+def upsert_daily_prices(dp_df, session=session):
+    """Upsert daily prices and update the weekly prices of the weeks they fall in,
+    in one transaction so the two tables never disagree.
 
+    args:
+    ------
+    dp_df - pandas dataframe - the daily prices to be upserted
+    session - sqla session:None - the db session object
 
+    returns:
+    ------
+    int - the number of daily prices upserted
+    """
+    try:
+        n_rows = daily_price.upsert_df(dp_df, session=session, commit=False)
+        update_weekly_prices(dp_df, session=session, commit=False)
+        session.commit()
+    except:
+        session.rollback()
+        raise
+    return n_rows
@@ -8,9 +8,7 @@ from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.utils.date import create_sec_ref_li, conv_dt
 from stock_trading_ml_modelling.utils.str_formatting import str_to_float_format
 from stock_trading_ml_modelling.database import daily_price, weekly_price
-from stock_trading_ml_modelling.libs.manage_data import split_day_prices, split_week_prices
-
-from stock_trading_ml_modelling.scrapping.scrapes import ScrapePrices 
+from stock_trading_ml_modelling.libs.manage_data import calc_week_prices, upsert_daily_prices
 
 #Get the price history for a specific ticker
 def get_day_prices(ticker:str, st_date:None, en_date:None):
@@ -27,8 +25,24 @@ def get_day_prices(ticker:str, st_date:None, en_date:None):
 
     """
     log.info(f'Getting DAILY prices for -> {ticker} from {str(st_date)} to {str(en_date)}')
+    #Imported here as the scrapping package imports this module
+    from stock_trading_ml_modelling.scrapping.scrapes import ScrapePrices
     #Perform async scrapes
     tick_df = ScrapePrices(ticker, st_date, en_date).scrape()
+    return clean_day_prices(ticker, tick_df)
+
+def clean_day_prices(ticker:str, tick_df):
+    """Function for converting the scraped daily price strings into prices
+    
+    args:
+    ------
+    ticker - str - the identifier for the stock
+    tick_df - pandas dataframe - the rows scraped by ScrapePrices
+
+    returns:
+    ------
+    bool, pandas dataframe - False and None if there are no prices
+    """
     #Check for rows - if none then return
     if not tick_df.shape[0]:
         log.warning("Early exit due to no new records being found")
@@ -76,8 +90,7 @@ def process_daily_prices(
     split_to_date=None
     ):
     """Function to scrape prices for a ticker between selected dates, then
-    split into update and add records, then perform those split/add functions 
-    on the db.
+    upsert them into the db.
     
     args:
     ----
@@ -85,8 +98,8 @@ def process_daily_prices(
     ticker_id - int - the ticker id in the db
     st_date - datetime - the date to start the scrape
     en_date - datetime - the date to end the scrape
-    split_from_date - datetime - the date to start the split
-    split_to_date - datetime - the date to end the split
+    split_from_date - datetime - not used, existing records are found by the upsert
+    split_to_date - datetime - not used, existing records are found by the upsert
     log - logger
     """
     #Get new price data if neccesary
@@ -94,18 +107,9 @@ def process_daily_prices(
         check, new_prices_df = get_day_prices(ticker, st_date, en_date, )
         if check:
             new_prices_df['ticker_id'] = ticker_id
-            update_df, append_df = split_day_prices(
-                new_prices_df,
-                ticker_ids=[ticker_id],
-                from_date=split_from_date,
-                to_date=split_to_date
-            )
-            #Update existing prices in the sql database
-            daily_price.update_df(update_df)
-            log.info(f"\nUPDATED {update_df.shape[0]} RECORDS IN daily_price: \n\tFROM {update_df.date.min()} \n\tTO {update_df.date.max()}")
-            #Add new prices to the sql database
-            daily_price.add_df(append_df)
-            log.info(f"\nADDED {append_df.shape[0]} NEW RECORDS TO daily_price: \n\tFROM {append_df.date.min()} \n\tTO {append_df.date.max()}")
+            #Add new prices and update existing prices in the sql database
+            upsert_daily_prices(new_prices_df)
+            log.info(f"\nUPSERTED {new_prices_df.shape[0]} RECORDS IN daily_price: \n\tFROM {new_prices_df.date.min()} \n\tTO {new_prices_df.date.max()}")
         else:
             log.info('No new records found')
     else:
@@ -116,29 +120,23 @@ def process_weekly_prices(
     split_from_date=None,
     split_to_date=None
     ):
-    """Function to fetch prices for a ticker between selected dates, then
-    split into update and add records, then perform those split/add functions 
-    on the db.
+    """Function to convert the daily prices for a ticker between selected dates
+    into weekly prices, then upsert them into the db.
     
     args:
     ----
     ticker_id - int - the ticker id in the db
-    split_from_date - datetime - the date to start the split
-    split_to_date - datetime - the date to end the split
+    split_from_date - datetime - the date to start the weekly conversion
+    split_to_date - datetime - the date to end the weekly conversion
     log - logger
     """
-    #Get new price data if neccesary
-    update_df, append_df = split_week_prices(
+    #Re-calculate the weeks from the daily prices
+    wp_df = calc_week_prices(
         ticker_ids=[ticker_id],
         from_date=split_from_date,
         to_date=split_to_date,
-        
     )
 
-    #Update existing records
-    weekly_price.update_df(update_df)
-    log.info(f"\nUPDATED {update_df.shape[0]} RECORDS IN weekly_price: \n\tFROM {update_df.date.min()} \n\tTO {update_df.date.max()}")
-
-    #Add new prices to the sql database
-    weekly_price.add_df(append_df)
-    log.info(f"\nADDED {append_df.shape[0]} NEW RECORDS TO weekly_price: \n\tFROM {append_df.date.min()} \n\tTO {append_df.date.max()}")
+    #Add new prices and update existing prices in the sql database
+    weekly_price.upsert_df(wp_df)
+    log.info(f"\nUPSERTED {wp_df.shape[0]} RECORDS IN weekly_price: \n\tFROM {wp_df.date.min()} \n\tTO {wp_df.date.max()}")
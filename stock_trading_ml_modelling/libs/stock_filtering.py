@@ -1,9 +1,12 @@
 import pandas as pd
 from tqdm import tqdm
+from sqlalchemy import func
 
 from stock_trading_ml_modelling.libs.logs import log
-from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df, sqlaq_to_ticker_dfs
+from stock_trading_ml_modelling.database.models import ReadSession as read_session
 from stock_trading_ml_modelling.database import ticker, ticker_market, daily_price, weekly_price
+from stock_trading_ml_modelling.database.models.prices import DailyPrice
 from stock_trading_ml_modelling.libs.data import DataSet
 
 def filter_stocks(from_date=None, to_date=None):
@@ -18,28 +21,25 @@ def filter_stocks(from_date=None, to_date=None):
     ----
     pandas dataframe
     """
-    #Fetch prices
-    prices_df = sqlaq_to_df(daily_price.fetch(from_date=from_date, to_date=to_date))
-    ticker_df = sqlaq_to_df(ticker.fetch()) \
-        .rename(columns={"id":"ticker_id"})
-
-    #Filter to keep only items which are current
-    max_date = prices_df.date.max()
-    ticks = prices_df[prices_df.date == max_date] \
-        .ticker_id \
-        .drop_duplicates()
-    ticks = pd.merge(ticks.to_frame(), ticker_df[["ticker_id","ticker"]], on=["ticker_id"])
+    #Only items which have a price on the latest date are current
+    max_date_query = read_session.query(func.max(DailyPrice.date))
+    if from_date is not None:
+        max_date_query = max_date_query.filter(DailyPrice.date >= from_date)
+    if to_date is not None:
+        max_date_query = max_date_query.filter(DailyPrice.date <= to_date)
+    max_date = pd.Timestamp(max_date_query.scalar())
+    ticker_df = sqlaq_to_df(ticker.fetch(), session=read_session)
+    ticker_names = dict(zip(ticker_df.id, ticker_df.ticker))
 
     #Setup variables
     buy = []
     sell = []
-    
-    prices_df = prices_df.sort_values(['ticker_id','date']) \
-        .reset_index(drop=True)
 
-    #Loop ticks and get results
-    for _,r in tqdm(ticks.iterrows(), total=ticks.shape[0], desc="Loop stock to find buy signals"):
-        tick_prices = prices_df[prices_df.ticker_id == r.ticker_id]
+    #Stream the prices one ticker at a time
+    prices_query = daily_price.fetch(from_date=from_date, to_date=to_date, columns=["ticker_id","date","close"], order=True)
+    for ticker_id, tick_prices in tqdm(sqlaq_to_ticker_dfs(prices_query, session=read_session), total=len(ticker_names), desc="Loop stock to find buy signals"):
+        if tick_prices.date.iloc[-1] != max_date or ticker_id not in ticker_names:
+            continue
         dataset = DataSet()
         dataset.add_dataset(tick_prices.close, "close")
         #Calculate the short macd
@@ -69,8 +69,8 @@ def filter_stocks(from_date=None, to_date=None):
             and dataset.grad_macd_long.data.iloc[-1] > 0)
         if check1:
             buy.append({
-                "ticker":r.ticker,
-                "ticker_id":r.ticker_id,
+                "ticker":ticker_names[ticker_id],
+                "ticker_id":ticker_id,
                 "short_grad_pre":dataset.grad_macd_short.data.iloc[-2],
                 "short_grad_post":dataset.grad_macd_short.data.iloc[-1],
                 "short_grad_change":abs(dataset.grad_macd_short.data.iloc[-2]) + abs(dataset.grad_macd_short.data.iloc[-1]),
@@ -0,0 +1,204 @@
+"""The LSE trading calendar
+
+The exchange is open on weekdays which are not bank holidays. Holidays are
+scraped once per year and stored in the market_holiday table (with the years
+scraped in market_holiday_year), so later runs only read them from the db (the
+current year is scraped again after the holidays ttl). The trading days are then a numpy busdaycalendar and finding
+the dates with no prices is array set operations rather than merges of
+dataframes.
+
+find_price_gaps finds the missing prices of every ticker in the db itself - the
+trading days are loaded into a temporary trading_day table and the runs of
+missing days are found with one gaps-and-islands query.
+"""
+import datetime as dt
+import numpy as np
+import pandas as pd
+from sqlalchemy import text
+
+from stock_trading_ml_modelling.config import CONFIG
+
+from stock_trading_ml_modelling.libs.logs import log
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database import market_holiday
+from stock_trading_ml_modelling.database.models import Session as session
+
+#Monday to Friday
+WEEKMASK = "1111100"
+
+def _to_days(dates):
+    """Dates (datetime, date, str or arrays of them) as datetime64[D]"""
+    if isinstance(dates, (pd.Series, pd.Index)):
+        dates = dates.values
+    return np.asarray(dates, dtype="datetime64[D]") if np.ndim(dates) else np.datetime64(pd.Timestamp(dates).date(), "D")
+
+def load_holidays(years, session=session):
+    """The holidays in the years from the market_holiday table. Past years which
+    have not been scraped are scraped and stored first, and the current year is
+    scraped again once it was scraped longer ago than the holidays ttl (so holidays
+    added or moved during the year are picked up). The years scraped are recorded in
+    the market_holiday_year table, so years with no holidays are not scraped again.
+
+    args:
+    ----
+    years - list - the years (ints) to get the holidays of
+    session - sqla session:None - the db session object
+
+    returns:
+    ----
+    numpy array - datetime64[D] holidays, sorted
+    """
+    #Imported here as the scrapping package imports this module
+    from stock_trading_ml_modelling.scrapping.http_cache import source_ttl
+    from stock_trading_ml_modelling.scrapping.scrape_data import get_named_public_holidays
+    years = sorted(set(years))
+    if not years:
+        return np.array([], dtype="datetime64[D]")
+    today = dt.date.today()
+    stored = sqlaq_to_df(market_holiday.fetch(
+        from_date=dt.date(years[0], 1, 1),
+        to_date=dt.date(years[-1], 12, 31),
+        ), session=session)
+    stored_days = _to_days(pd.to_datetime(stored.date))
+    stored_years = stored_days.astype("datetime64[Y]").astype(int) + 1970
+    fetched = sqlaq_to_df(market_holiday.fetch_years(from_year=years[0], to_year=years[-1]), session=session)
+    fetched = dict(zip(fetched.year, pd.to_datetime(fetched.fetched_date).dt.date))
+    #Years with holidays stored before the scrapes were recorded count as scraped
+    scraped_years = set(fetched) | set(stored_years)
+    ttl = dt.timedelta(seconds=source_ttl("holidays"))
+    #Future years are not scraped as the holidays may not be announced
+    scrape_years = [
+        y for y in years
+        if y not in scraped_years and y <= today.year
+        or y == today.year and (y not in fetched or today - fetched[y] > ttl)
+    ]
+    if not scrape_years:
+        return np.sort(stored_days)
+    new_holidays = pd.DataFrame(
+        [(d.date(), name) for year in scrape_years for d, name in get_named_public_holidays(year)],
+        columns=["date","name"])
+    new_days = _to_days(new_holidays.date)
+    log.info(f"Storing {new_holidays.shape[0]} holidays for {len(scrape_years)} years")
+    market_holiday.replace_years(new_holidays, scrape_years, fetched_date=today, session=session)
+    #Years the scrape found no holidays for keep the stored ones
+    kept_days = stored_days[~np.isin(stored_years, new_days.astype("datetime64[Y]").astype(int) + 1970)]
+    return np.unique(np.concatenate([kept_days, new_days]))
+
+class TradingCalendar:
+    def __init__(self, holidays=[]):
+        """The days the market is open, weekdays other than the holidays
+
+        args:
+        ----
+        holidays - list:[] - the dates the market is closed on weekdays
+        """
+        self.holidays = np.unique(_to_days(list(holidays)))
+        self.busdaycal = np.busdaycalendar(weekmask=WEEKMASK, holidays=self.holidays)
+
+    @classmethod
+    def from_db(cls, from_date, to_date, session=session):
+        """The calendar with the stored holidays between two dates (see load_holidays)"""
+        return cls(load_holidays(range(from_date.year, to_date.year + 1), session=session))
+
+    def is_trading_day(self, dates):
+        """Boolean array, True for dates the market is open"""
+        return np.is_busday(_to_days(dates), busdaycal=self.busdaycal)
+
+    def trading_dates(self, from_date, to_date):
+        """The days the market is open between two dates (inclusive)
+
+        returns:
+        ----
+        numpy array - datetime64[D]
+        """
+        days = np.arange(_to_days(from_date), _to_days(to_date) + 1, dtype="datetime64[D]")
+        return days[np.is_busday(days, busdaycal=self.busdaycal)]
+
+    def missing_dates(self, dates, from_date, to_date):
+        """The trading days between two dates which are not in dates
+
+        args:
+        ----
+        dates - array - the dates there are prices for
+        from_date - datetime - the first date prices are expected
+        to_date - datetime - the last date prices are expected
+
+        returns:
+        ----
+        numpy array - datetime64[D]
+        """
+        return np.setdiff1d(self.trading_dates(from_date, to_date), _to_days(dates))
+
+#Each run of consecutive missing trading days (an island) has a constant
+#idx - ROW_NUMBER(), runs are then split into chunks spanning at most max_days
+PRICE_GAPS_SQL = """
+WITH first_price AS (
+    SELECT ticker_id, MIN(date) AS first_date
+    FROM daily_price
+    WHERE date >= :from_date AND date <= :to_date {ticker_filter}
+    GROUP BY ticker_id
+), missing AS (
+    SELECT f.ticker_id, t.day, t.idx
+    FROM first_price f
+    JOIN temp.trading_day t ON t.day > f.first_date
+    WHERE NOT EXISTS (
+        SELECT 1 FROM daily_price d WHERE d.ticker_id = f.ticker_id AND d.date = t.day
+        )
+), islands AS (
+    SELECT ticker_id, day, idx - ROW_NUMBER() OVER (PARTITION BY ticker_id ORDER BY idx) AS island
+    FROM missing
+), chunks AS (
+    SELECT ticker_id, day, island,
+        CAST((julianday(day) - julianday(MIN(day) OVER (PARTITION BY ticker_id, island))) / (:max_days + 1) AS INTEGER) AS chunk
+    FROM islands
+)
+SELECT ticker_id, MIN(day) AS st_date, MAX(day) AS en_date, COUNT(*) AS missing_days
+FROM chunks
+GROUP BY ticker_id, island, chunk
+ORDER BY ticker_id, st_date
+"""
+
+def _load_trading_days(conn, days):
+    """(Re)fill the temporary trading_day table on a connection"""
+    conn.execute(text("CREATE TEMP TABLE IF NOT EXISTS trading_day (idx INTEGER PRIMARY KEY, day DATE NOT NULL UNIQUE)"))
+    conn.execute(text("DELETE FROM temp.trading_day"))
+    conn.execute(
+        text("INSERT INTO temp.trading_day (idx, day) VALUES (:idx, :day)"),
+        [{"idx":i, "day":str(d)} for i, d in enumerate(days)]
+        )
+
+def find_price_gaps(calendar:TradingCalendar, from_date, to_date, ticker_ids=[], max_days:int=None, session=session):
+    """Find the trading days each ticker has no daily prices for (after its first
+    price) as date ranges to scrape, in one query over the whole table.
+
+    args:
+    ----
+    calendar - TradingCalendar - the days prices are expected
+    from_date - datetime - the first date prices are expected
+    to_date - datetime - the last date prices are expected
+    ticker_ids - list:[] - only these tickers (if [] then all are checked)
+    max_days - int:None - the max days a range spans (None for CONFIG["scrape"]["max_days"])
+    session - sqla session:None - the db session object
+
+    returns:
+    ----
+    pandas dataframe - ticker_id, st_date, en_date and missing_days of each range
+    """
+    max_days = CONFIG["scrape"]["max_days"] if max_days is None else max_days
+    ticker_filter = ""
+    params = {
+        "from_date":str(_to_days(from_date)),
+        "to_date":str(_to_days(to_date)),
+        "max_days":max_days,
+    }
+    if len(ticker_ids):
+        ticker_filter = f"AND ticker_id IN ({', '.join(f':t{i}' for i in range(len(ticker_ids)))})"
+        params.update({f"t{i}":int(t) for i, t in enumerate(ticker_ids)})
+    #The temporary table only exists on this connection
+    with session.bind.connect() as conn:
+        _load_trading_days(conn, calendar.trading_dates(from_date, to_date))
+        gaps = pd.read_sql(text(PRICE_GAPS_SQL.format(ticker_filter=ticker_filter)), con=conn, params=params)
+    gaps["st_date"] = pd.to_datetime(gaps.st_date)
+    gaps["en_date"] = pd.to_datetime(gaps.en_date)
+    log.info(f"{gaps.missing_days.sum()} missing prices in {gaps.shape[0]} ranges over {gaps.ticker_id.nunique()} tickers")
+    return gaps
@@ -1,6 +1,8 @@
 
+import json
 import numpy as np
 from pathlib import Path
+import tensorflow as tf
 from tensorflow.keras.metrics import SparseCategoricalAccuracy
 from tensorflow.keras.losses import SparseCategoricalCrossentropy
 from tensorflow.keras.callbacks import EarlyStopping
@@ -11,6 +13,16 @@ from stock_trading_ml_modelling.utils.data import np_count_values
 
 from stock_trading_ml_modelling.modelling.resnet_model import FunnyResNet
 
+LABELS_FILE = "labels.json"
+
+def load_labels(path):
+    """Read the labels saved with a model, None if there are not any"""
+    path = Path(path) / LABELS_FILE
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.loads(f.read())
+
 class ClassifierModel:
     def __init__(self,
         num_classes:int,
@@ -19,7 +31,11 @@ class ClassifierModel:
         folder:str="default",
         epochs:int=50,
         validation_split:float=0.2,
-        batch_size:int=32
+        batch_size:int=32,
+        shuffle_block:int=16,
+        num_parallel_calls:int=tf.data.AUTOTUNE,
+        normalise:callable=None,
+        seed:int=42
         ):
         self.learning_rate = learning_rate
         self.model = FunnyResNet(num_classes)
@@ -29,14 +45,21 @@ class ClassifierModel:
         self.epochs = epochs
         self.validation_split = validation_split
         self.batch_size = batch_size
+        self.shuffle_block = shuffle_block
+        self.num_parallel_calls = num_parallel_calls
+        self.normalise = normalise
+        self.seed = seed
+        self.labels = None
 
     def train(self,
         X,
         y,
-        labels
+        labels,
+        idx=None
         ):
+        self.labels = labels
         self.compile()
-        self.fit(X, y, labels=labels)
+        self.fit(X, y, labels=labels, idx=idx)
 
     def compile(self):
         self.model.compile(
@@ -54,42 +77,136 @@ class ClassifierModel:
             for k,v in labels.items()
             }
 
+    def shuffled_batches(self, idx, rng):
+        """The batches of row indexes for one epoch of training. Rows are shuffled in
+        contiguous blocks of shuffle_block rows, so each batch reads a few runs of
+        neighbouring rows from X rather than batch_size scattered rows.
+
+        args:
+        ----
+        idx - numpy array - the rows to use
+        rng - numpy Generator - the random state, advanced each epoch
+
+        returns:
+        ----
+        generator - int64 numpy arrays of row indexes, sorted within each batch
+        """
+        idx = np.sort(idx)
+        n_blocks = -(-idx.shape[0] // self.shuffle_block)
+        rows = (rng.permutation(n_blocks)[:, None] * self.shuffle_block + np.arange(self.shuffle_block)).ravel()
+        idx = idx[rows[rows < idx.shape[0]]]
+        for st in range(0, idx.shape[0], self.batch_size):
+            yield np.sort(idx[st:st + self.batch_size])
+
+    def make_dataset(self, X, y, idx=None, shuffle:bool=False):
+        """Create a tf.data pipeline which streams batches of rows from X and y.
+        
+        Only the row indexes are held by the pipeline, they are batched before rows
+        are read from X (a numpy array, memmap or ShardedArray) a batch at a time in
+        parallel and prefetched. When shuffled, rows are shuffled in blocks each
+        epoch (see shuffled_batches).
+
+        args:
+        ----
+        X - array like - the windows
+        y - numpy array - the encoded labels
+        idx - numpy array:None - the rows to use (None for all)
+        shuffle - bool:False - shuffle the rows each epoch
+
+        returns:
+        ----
+        tf.data.Dataset
+        """
+        idx = np.arange(y.shape[0]) if idx is None else np.asarray(idx)
+        idx = idx.astype(np.int64)
+        row_shape = tuple(X.shape[1:])
+        def load_batch(batch_idx):
+            return np.asarray(X[batch_idx], dtype=np.float32), np.asarray(y[batch_idx], dtype=np.int64)
+        def tf_load_batch(batch_idx):
+            batch_X, batch_y = tf.numpy_function(load_batch, [batch_idx], [tf.float32, tf.int64])
+            batch_X.set_shape((None,) + row_shape)
+            batch_y.set_shape((None,))
+            return batch_X, batch_y
+        if shuffle:
+            #The generator is called again for each epoch
+            rng = np.random.default_rng(self.seed)
+            dataset = tf.data.Dataset.from_generator(
+                lambda: self.shuffled_batches(idx, rng),
+                output_signature=tf.TensorSpec(shape=(None,), dtype=tf.int64)
+                )
+        else:
+            dataset = tf.data.Dataset.from_tensor_slices(idx).batch(self.batch_size)
+        dataset = dataset.map(tf_load_batch, num_parallel_calls=self.num_parallel_calls)
+        #Normalise on the fly
+        if self.normalise is not None:
+            dataset = dataset.map(self.normalise, num_parallel_calls=self.num_parallel_calls)
+        return dataset.prefetch(tf.data.AUTOTUNE)
+
+    def split_validation(self, idx):
+        """Split rows into training and validation, the last validation_split of rows
+        are used for validation (as keras does)"""
+        n_val = int(idx.shape[0] * self.validation_split)
+        return idx[:idx.shape[0] - n_val], idx[idx.shape[0] - n_val:]
+
     def fit(self,
         X,
         y,
-        labels
+        labels,
+        idx=None,
+        val_idx=None
         ):
+        """Fit the model streaming batches from X and y.
+
+        args:
+        ----
+        X - array like - the windows, can be a memmap or ShardedArray
+        y - numpy array - the encoded labels
+        labels - dict - label to encoded value
+        idx - numpy array:None - the rows to train on (None for all)
+        val_idx - numpy array:None - the rows to validate on, if None validation_split 
+            of idx is used
+        """
         if not self.compiled:
             self.compile()
+        idx = np.arange(y.shape[0]) if idx is None else np.asarray(idx)
+        if val_idx is None:
+            idx, val_idx = self.split_validation(idx)
         #Add early stopping
         early_stopping = EarlyStopping()
         #Create the loss weightings
-        class_weight = self.create_class_weighting(y, labels)
+        class_weight = self.create_class_weighting(y[idx], labels)
         print(f"class_weight -> {class_weight}")
         #Fit the model
         self.model.fit(
-            X,
-            y,
+            self.make_dataset(X, y, idx, shuffle=True),
+            validation_data=self.make_dataset(X, y, val_idx) if len(val_idx) else None,
             epochs=self.epochs,
-            validation_split=self.validation_split,
-            batch_size=self.batch_size,
             callbacks=[early_stopping],
             class_weight=class_weight
             )
 
     def save_model(self):
         self.model.save(self.path)
+        #Keep the labels with the model so predictions can be decoded
+        if self.labels is not None:
+            with open(self.path / LABELS_FILE, "w+") as f:
+                f.write(json.dumps(self.labels))
 
     def load_model(self):
         self.model = load_model(self.path)
         self.compiled = True
+        self.labels = load_labels(self.path)
 
-    def eval_model(self, X, y, labels:dict):
+    def eval_model(self, X, y, labels:dict, idx=None):
+        #Rows are read in order so the predictions line up with y
+        idx = np.arange(y.shape[0]) if idx is None else np.sort(idx)
+        dataset = self.make_dataset(X, y, idx)
+        y = y[idx]
         #Evaluate the model
-        val_loss, val_acc = self.model.evaluate(X, y)
+        val_loss, val_acc = self.model.evaluate(dataset)
         print(f"val_loss:{val_loss} - val_acc:{val_acc}")
 
-        preds = self.model.predict(X)
+        preds = self.model.predict(dataset)
         preds = np.argmax(preds, axis=1)
 
         act_val_counts = np_count_values(y)
@@ -107,8 +224,8 @@ class ClassifierModel:
             ppv = tp / (tp + fp)
             print(f"ppv of {k} - {ppv:.4f} - tp {tp} - fp {fp} - tp + fn {(y == v).sum()}")
 
-    def predict(*args, **kwargs):
-        self.model.predict(*args, **kwargs)
+    def predict(self, *args, **kwargs):
+        return self.model.predict(*args, **kwargs)
 
-    def evaluate(*args, **kwargs):
-        self.model.evaluate(*args, **kwargs)
\ No newline at end of file
+    def evaluate(self, *args, **kwargs):
+        return self.model.evaluate(*args, **kwargs)
@@ -0,0 +1,216 @@
+"""On disk format for training datasets
+
+A dataset folder holds one shard per ticker plus a manifest:
+- manifest.json - shapes, dtypes, labels and the ticker/date range of every shard
+- X_<ticker_id>.npy - the windows for the ticker, shape (rows, channels, window)
+- y_<ticker_id>.npy - the encoded labels for the ticker, shape (rows,)
+- date_<ticker_id>.npy - the date of the last price in each window, datetime64[D]
+
+Shards are loaded with mmap_mode='r' so nothing is read until it is indexed.
+"""
+import json
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+MANIFEST_FILE = "manifest.json"
+FORMAT_VERSION = 1
+
+class ShardedArray:
+    """A read-only (unless the shards are writeable) array made up of row shards,
+    EG memmapped per-ticker files. Rows are only read when they are indexed."""
+    def __init__(self, shards:list, row_shape:tuple=None, dtype=None):
+        self.shards = list(shards)
+        if len(self.shards):
+            row_shape = self.shards[0].shape[1:]
+            dtype = self.shards[0].dtype
+        self.row_shape = tuple(row_shape)
+        self.dtype = np.dtype(dtype)
+        self.offsets = np.cumsum([0] + [s.shape[0] for s in self.shards])
+
+    @property
+    def shape(self):
+        return (int(self.offsets[-1]),) + self.row_shape
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    def __len__(self):
+        return self.shape[0]
+
+    def _to_idx(self, key):
+        """Convert a row key (int, slice, bool mask or int array) into row numbers"""
+        if isinstance(key, slice):
+            return np.arange(*key.indices(len(self)))
+        idx = np.asarray(key)
+        if idx.dtype == bool:
+            return np.flatnonzero(idx)
+        idx = idx.astype(np.int64)
+        return np.where(idx < 0, idx + len(self), idx)
+
+    def _shard_groups(self, idx):
+        """Yield the shard number, the local rows and a mask of positions in idx for each shard hit"""
+        shard_i = np.searchsorted(self.offsets, idx, side="right") - 1
+        for si in np.unique(shard_i):
+            mask = shard_i == si
+            yield si, idx[mask] - self.offsets[si], mask
+
+    def __getitem__(self, key):
+        if isinstance(key, tuple):
+            return self[key[0]][(slice(None),) + key[1:]]
+        if isinstance(key, (int, np.integer)):
+            idx = self._to_idx([key])
+            return self[idx][0]
+        idx = self._to_idx(key)
+        out = np.empty((idx.shape[0],) + self.row_shape, dtype=self.dtype)
+        for si, local, mask in self._shard_groups(idx):
+            out[mask] = self.shards[si][local]
+        return out
+
+    def __setitem__(self, key, value):
+        idx = self._to_idx(key)
+        value = np.broadcast_to(value, (idx.shape[0],) + self.row_shape)
+        for si, local, mask in self._shard_groups(idx):
+            self.shards[si][local] = value[mask]
+
+    def __array__(self, dtype=None):
+        out = self[:]
+        return out if dtype is None else out.astype(dtype)
+
+    def flush(self):
+        for s in self.shards:
+            if isinstance(s, np.memmap):
+                s.flush()
+
+def shard_files(ticker_id):
+    """The file names for a ticker's shard"""
+    return {
+        "X":f"X_{ticker_id}.npy",
+        "y":f"y_{ticker_id}.npy",
+        "date":f"date_{ticker_id}.npy",
+    }
+
+def open_shard(path, ticker_id, shape:tuple, dtype):
+    """Create an empty writeable memmapped X shard"""
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    return np.lib.format.open_memmap(path / shard_files(ticker_id)["X"], mode="w+", dtype=dtype, shape=shape)
+
+def _is_shard_file(X, st, en, file):
+    """Check if rows st:en of X are already the whole of the memmapped file"""
+    if not isinstance(X, ShardedArray) or not Path(file).exists():
+        return False
+    file = Path(file).resolve()
+    for si, shard in enumerate(X.shards):
+        shard_file = getattr(shard, "filename", None)
+        if shard_file is None or Path(shard_file).resolve() != file:
+            continue
+        if X.offsets[si] == st and X.offsets[si + 1] == en \
+            and np.lib.format.open_memmap(file, mode="r").shape[0] == en - st:
+            return True
+        raise ValueError(f"Can not overwrite {file} with part of itself, save to a different folder")
+    return False
+
+def write_dataset(path, X, y, row_index, labels:dict, window:int):
+    """Write a dataset in the sharded format, one shard per ticker.
+
+    args:
+    ----
+    path - Path - the dataset folder
+    X - numpy array or ShardedArray - the windows, rows must be grouped by ticker
+    y - numpy array - the encoded labels
+    row_index - pandas dataframe - ticker_id and date for each row of X
+    labels - dict - label to encoded value
+    window - int - the window size
+
+    returns:
+    ----
+    dict - the manifest
+    """
+    path = Path(path)
+    path.mkdir(parents=True, exist_ok=True)
+    dates = row_index.date.values.astype("datetime64[D]")
+    #Rows for each ticker are contiguous
+    ticker_ids = row_index.ticker_id.values
+    starts = np.flatnonzero(np.r_[True, ticker_ids[1:] != ticker_ids[:-1]]) if ticker_ids.shape[0] else np.array([], dtype=int)
+    ends = np.r_[starts[1:], ticker_ids.shape[0]]
+    shards = []
+    for st, en in zip(starts, ends):
+        ticker_id = int(ticker_ids[st])
+        files = shard_files(ticker_id)
+        #Shards written in place (memmapped build) do not need writing again
+        if not _is_shard_file(X, st, en, path / files["X"]):
+            np.save(path / files["X"], X[st:en])
+        np.save(path / files["y"], y[st:en])
+        np.save(path / files["date"], dates[st:en])
+        shards.append({
+            "ticker_id":ticker_id,
+            "rows":int(en - st),
+            "st_date":str(dates[st]),
+            "en_date":str(dates[en - 1]),
+            **files
+        })
+    manifest = {
+        "format_version":FORMAT_VERSION,
+        "n_rows":int(y.shape[0]),
+        "window":window,
+        "row_shape":list(X.shape[1:]),
+        "dtype":np.dtype(X.dtype).str,
+        "y_dtype":np.dtype(y.dtype).str,
+        "labels":labels,
+        "shards":shards,
+    }
+    with open(path / MANIFEST_FILE, "w+") as f:
+        f.write(json.dumps(manifest, indent=1))
+    return manifest
+
+def read_manifest(path):
+    """Read the manifest of a dataset folder, None if there is not one"""
+    path = Path(path) / MANIFEST_FILE
+    if not path.exists():
+        return None
+    with open(path, "r") as f:
+        return json.loads(f.read())
+
+def load_dataset(path, ticker_ids=None, from_date=None, to_date=None):
+    """Lazily load a sharded dataset, optionally limited to some tickers and/or a
+    date range. X shards are memmapped and only sliced, so no X data is read.
+
+    args:
+    ----
+    path - Path - the dataset folder
+    ticker_ids - list:None - the tickers to load (None for all)
+    from_date - datetime:None - the min window date to load
+    to_date - datetime:None - the max window date to load
+
+    returns:
+    ----
+    ShardedArray, numpy array, pandas dataframe, dict - X, y, row_index, manifest
+    """
+    path = Path(path)
+    manifest = read_manifest(path)
+    from_date = None if from_date is None else np.datetime64(pd.Timestamp(from_date).date())
+    to_date = None if to_date is None else np.datetime64(pd.Timestamp(to_date).date())
+    if ticker_ids is not None:
+        ticker_ids = set(int(t) for t in ticker_ids)
+    X_shards, y, row_index = [], [], []
+    for shard in manifest["shards"]:
+        if ticker_ids is not None and shard["ticker_id"] not in ticker_ids:
+            continue
+        #Skip shards outside the date range without opening them
+        if (from_date is not None and np.datetime64(shard["en_date"]) < from_date) \
+            or (to_date is not None and np.datetime64(shard["st_date"]) > to_date):
+            continue
+        dates = np.load(path / shard["date"])
+        st = 0 if from_date is None else np.searchsorted(dates, from_date, side="left")
+        en = dates.shape[0] if to_date is None else np.searchsorted(dates, to_date, side="right")
+        if en <= st:
+            continue
+        X_shards.append(np.load(path / shard["X"], mmap_mode="r")[st:en])
+        y.append(np.load(path / shard["y"])[st:en])
+        row_index.append(pd.DataFrame({"ticker_id":shard["ticker_id"], "date":dates[st:en]}))
+    X = ShardedArray(X_shards, row_shape=manifest["row_shape"], dtype=manifest["dtype"])
+    y = np.concatenate(y) if len(y) else np.empty(0, dtype=manifest["y_dtype"])
+    row_index = pd.concat(row_index, ignore_index=True) if len(row_index) else pd.DataFrame(columns=["ticker_id","date"])
+    return X, y, row_index, manifest
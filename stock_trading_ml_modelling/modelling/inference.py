@@ -0,0 +1,89 @@
+"""Score the latest window of every ticker with a saved classifier
+
+The model is loaded once and only the tail of each ticker's prices is fetched,
+the last window for every ticker is then scored in a single batched predict.
+"""
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+from stock_trading_ml_modelling.libs.logs import log
+from stock_trading_ml_modelling.utils.timing import ProcessTime
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.models import ReadSession as read_session
+from stock_trading_ml_modelling.database import ticker
+
+from stock_trading_ml_modelling.modelling.training_data import TrainingData
+from stock_trading_ml_modelling.modelling.classifier_model import ClassifierModel, load_labels
+
+class SignalScorer:
+    """Loads a saved classifier once and scores the current window of each ticker
+
+    args:
+    ----
+    folder - str:"cnn" - the folder the model was saved under
+    batch_size - int:1024 - the number of windows scored per batch
+    training_data - TrainingData:None - the settings (window, macds) the model was
+        trained with, defaults to TrainingData(folder=folder)
+    """
+    def __init__(self, folder:str="cnn", batch_size:int=1024, training_data:TrainingData=None):
+        self.folder = folder
+        self.batch_size = batch_size
+        self.training_data = TrainingData(folder=folder) if training_data is None else training_data
+        self.timer = ProcessTime(name="signal scoring")
+        labels = load_labels(Path("data", "models", folder)) or self.training_data.labels
+        if not labels:
+            raise ValueError(f"No labels saved with the model in folder {folder}, re-save the model after training")
+        self.cls_model = ClassifierModel(len(labels), folder=folder)
+        self.cls_model.load_model()
+        self.cls_model.labels = labels
+        self._log_stage("Load model")
+
+    def _log_stage(self, stage:str):
+        self.timer.lap()
+        for msg in self.timer.show_latest_lap_time():
+            log.info(f"{stage} - {msg}")
+
+    def score(self, prices=None, current_only:bool=True):
+        """Score the last window of every ticker
+
+        args:
+        ----
+        prices - pandas dataframe:None - prices sorted by ticker_id and date, fetched if None
+        current_only - bool:True - only score tickers with a price on the latest date
+
+        returns:
+        ----
+        pandas dataframe - one row per ticker ranked by the buy probability
+        """
+        self.timer = ProcessTime(name="signal scoring")
+        if prices is None:
+            prices = self.training_data.get_latest_prices()
+            self._log_stage("Fetch prices")
+        if current_only:
+            last_dates = prices.groupby("ticker_id").date.transform("max")
+            prices = prices[last_dates == prices.date.max()]
+        row_index, X = self.training_data.create_latest_data(prices)
+        self._log_stage(f"Build {X.shape[0]} windows")
+        probs = self.cls_model.predict(X, batch_size=self.batch_size)
+        self._log_stage("Predict")
+        scores_df = self.rank(row_index, probs)
+        self._log_stage("Rank")
+        log.info(self.timer.end()[0])
+        return scores_df
+
+    def rank(self, row_index, probs):
+        """Combine the predictions with the tickers and rank them (buys first)"""
+        rev_labels = {v:k for k,v in self.cls_model.labels.items()}
+        scores_df = row_index.copy()
+        scores_df["signal"] = [rev_labels[v] for v in np.argmax(probs, axis=1)]
+        for v, k in sorted(rev_labels.items()):
+            scores_df[f"prob_{k}"] = probs[:, v]
+        ticker_df = sqlaq_to_df(ticker.fetch(), session=read_session) \
+            .rename(columns={"id":"ticker_id"})
+        scores_df = pd.merge(ticker_df[["ticker_id","ticker"]], scores_df, on=["ticker_id"])
+        sort_col = "prob_buy" if "prob_buy" in scores_df.columns else "signal"
+        scores_df = scores_df.sort_values([sort_col], ascending=[False]) \
+            .reset_index(drop=True)
+        log.info(f"{scores_df.shape[0]} tickers scored - {scores_df.signal.value_counts().to_dict()}")
+        return scores_df
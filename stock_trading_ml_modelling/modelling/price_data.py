@@ -1,21 +1,44 @@
-
+import numpy as np
 from datetime import datetime, timedelta
 
 from stock_trading_ml_modelling.database import daily_price
 from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.models import ReadSession as read_session
+from stock_trading_ml_modelling.database.price_store import read_prices
+
+PRICE_COLUMNS = ["ticker_id","date","open","high","low","close","volume"]
 
 class PriceData:
-    def __init__(self):
-        pass
+    def __init__(self, use_store:bool=False):
+        #Read from the parquet price store rather than the db
+        self.use_store = use_store
+
+    def get_prices(self, ticker_ids=[], weeks=52*10, columns:list=PRICE_COLUMNS, price_dtype=np.float32):
+        """Function to fetch the pricing data. Only the last weeks of prices and the
+        columns asked for are read, sorted by ticker_id and date.
+
+        args:
+        ----
+        ticker_ids - list:[] - the tickers to fetch (all if empty)
+        weeks - int:520 - the number of weeks of prices to fetch
+        columns - list:PRICE_COLUMNS - the columns to fetch (None for all)
+        price_dtype - numpy dtype:np.float32 - the dtype for the price columns
 
-    def get_prices(self, ticker_ids=[], weeks=52*10):
-        """Function to fetch the pricing data"""
-        #Get the price data
-        prices = sqlaq_to_df(daily_price.fetch(ticker_ids=ticker_ids))
-        #Limit dates
-        st_date = (datetime.now() - timedelta(weeks=weeks)).date()
-        prices = prices[prices.date > st_date]
-        #Ensure they are in date order - async fetching may have prevented this
-        prices = prices.sort_values(["ticker_id","date"]) \
-            .reset_index(drop=True)
+        returns:
+        ----
+        pandas dataframe - ticker_id as int32, date as datetime64
+        """
+        #Dates after st_date
+        from_date = (datetime.now() - timedelta(weeks=weeks)).date() + timedelta(days=1)
+        if self.use_store:
+            prices = read_prices("daily_price", columns=columns, ticker_ids=ticker_ids, from_date=from_date, float_dtype=price_dtype)
+        else:
+            query = daily_price.fetch(ticker_ids=ticker_ids, from_date=from_date, columns=columns, order=True)
+            prices = sqlaq_to_df(query, session=read_session, dtypes={
+                "date":"datetime64[ns]",
+                "week_start_date":"datetime64[ns]",
+                **{c:price_dtype for c in ["open","high","low","close","change","volume"]}
+                })
+        if "ticker_id" in prices.columns:
+            prices["ticker_id"] = prices.ticker_id.astype(np.int32)
         return prices
@@ -41,9 +41,9 @@ All model must have:
 methods
 """
 cls_model = ClassifierModel(3, folder="cnn")
-cls_model.train(training_data.X_train, training_data.y_train, training_data.labels)
+cls_model.train(training_data.X, training_data.y, training_data.labels, idx=training_data.train_idx)
 cls_model.save_model()
-cls_model.eval_model(training_data.X_test, training_data.y_test, training_data.labels)
+cls_model.eval_model(training_data.X, training_data.y, training_data.labels, idx=training_data.test_idx)
 
 #########################################
 ### RUN VALIDATION DATA THROUGH MODEL ###
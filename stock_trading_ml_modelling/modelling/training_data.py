@@ -5,10 +5,37 @@ from tqdm import tqdm
 from pathlib import Path
 from sklearn.model_selection import train_test_split
 import json
+from copy import copy
+from collections import deque
+from itertools import islice
+import os
+from concurrent.futures import ProcessPoolExecutor
 
-from stock_trading_ml_modelling.libs.data import Data
+from stock_trading_ml_modelling.libs.data import Data, norm_windows_max_min_value, norm_windows_max_value
 
 from stock_trading_ml_modelling.modelling.price_data import PriceData
+from stock_trading_ml_modelling.modelling.dataset_store import ShardedArray, open_shard, write_dataset, read_manifest, load_dataset
+
+
+def bounded_map(executor, func, iterable, in_flight:int):
+    """Like executor.map but only in_flight items are submitted at a time, so the
+    pickled inputs and finished results of the whole iterable are never held at once.
+    Results are yielded in order.
+
+    args:
+    ----
+    executor - Executor - the pool to run func in
+    func - function - called on each item
+    iterable - iterable - the items, only read as results are consumed
+    in_flight - int - the max number of submitted items not yet yielded
+    """
+    iterable = iter(iterable)
+    futures = deque(executor.submit(func, item) for item in islice(iterable, in_flight))
+    while futures:
+        result = futures.popleft().result()
+        for item in islice(iterable, 1):
+            futures.append(executor.submit(func, item))
+        yield result
 
 
 class TrainingData:
@@ -18,7 +45,10 @@ class TrainingData:
         macd_lng=[60, 130, 45],
         limit_id=None,
         folder:str="default",
-        window:int=256
+        window:int=256,
+        dtype=np.float32,
+        n_jobs:int=1,
+        use_store:bool=False
         ):
         #Turn off annoying warning
         pd.options.mode.chained_assignment = None  # default='warn'
@@ -30,48 +60,176 @@ class TrainingData:
         self.y = None
         self.labels = {}
         self.signals = None
-        self.X_train = None
-        self.X_test = None
-        self.y_train = None
-        self.y_test = None
+        self.row_index = None
+        self.train_idx = None
+        self.test_idx = None
         self.folder = folder
         self.window = window
+        self.dtype = dtype
+        self.n_jobs = n_jobs
+        self.use_store = use_store
         self.ticker_ids = range(limit_id) if limit_id is not None else []
 
     def get_price_data(self, weeks=52*10, force:bool=False):
         if self.prices is None or force:
-            price_data = PriceData()
+            price_data = PriceData(use_store=self.use_store)
             self.prices = price_data.get_prices(ticker_ids=self.ticker_ids, weeks=weeks)
 
-    def create_data(self, weeks=52*10, force=False):
+    def create_data(self, weeks=52*10, force=False, memmap:bool=False):
+        """Create the training data. Rows are counted for each ticker first so X and y
+        can be preallocated and each ticker's windows written straight into place.
+
+        args:
+        ----
+        weeks - int:520 - the number of weeks of prices to use
+        force - bool:False - refetch the prices even if already loaded
+        memmap - bool:False - write X straight into memmapped per-ticker shards in data/<folder>/ rather than RAM
+
+        Tickers are processed in a pool of n_jobs processes when n_jobs is not 1 (-1 uses all cores),
+        with at most 2 x n_jobs tickers in flight
+        """
         self.get_price_data(weeks=weeks, force=force)
+        #The signals, windows and row_index need each ticker's prices together and in date order
+        if not pd.MultiIndex.from_frame(self.prices[["ticker_id","date"]]).is_monotonic_increasing:
+            self.prices = self.prices.sort_values(["ticker_id","date"], kind="mergesort").reset_index(drop=True)
         #Create labels
         self.prices["signal"] = self.identify_signals_gain_loss(self.prices.close, self.period)
         self.prices["encoded_signal"], self.labels = self.encode_labels(self.prices.signal)
-        #Loop tickers
+        #Count the rows for each ticker
         ticker_ids = self.prices.ticker_id.unique()
-        for tick_id in tqdm(ticker_ids, total=ticker_ids.shape[0], desc="Create data for tickers"):
-            #Get all the values from df
-            tick_prices = self.prices[self.prices.ticker_id == tick_id]
-            encoded_signal, close, _open, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi = \
-                self.create_ticker_data(tick_prices)
-            tick_X = self.zip_data([_open, close, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi])
-            #Append data
-            self.X = tick_X if self.X is None else np.concatenate((self.X, tick_X), axis=0)
-            self.y = encoded_signal if self.y is None else np.concatenate((self.y, encoded_signal), axis=None)
-        self.X_train, self.X_test, self.y_train, self.y_test = self.test_train_split(self.X, self.y)
+        tick_rows = self.count_windows(self.prices.groupby("ticker_id").size().loc[ticker_ids].values)
+        tick_ends = np.cumsum(tick_rows)
+        #Ticker and date of the last price of each window
+        rows_from_end = self.prices.groupby("ticker_id", sort=False).cumcount(ascending=False).values
+        row_mask = rows_from_end < self.prices.ticker_id.map(dict(zip(ticker_ids, tick_rows))).values
+        self.row_index = self.prices.loc[row_mask, ["ticker_id","date"]].reset_index(drop=True)
+        #Preallocate
+        self.X, self.y = self.allocate_data(ticker_ids, tick_rows, memmap=memmap)
+        #Split prices by ticker (in the same order as ticker_ids), keeping only the columns needed
+        tick_prices_gen = (
+            tick_prices[["open","close","high","low","encoded_signal"]]
+            for _, tick_prices in self.prices.groupby("ticker_id", sort=False)
+        )
+        #Loop tickers - in parallel results still come back in ticker order
+        if self.n_jobs == 1:
+            self.fill_data(map(self.create_ticker_windows, tick_prices_gen), tick_ends, tick_rows)
+        else:
+            workers = os.cpu_count() if self.n_jobs < 0 else self.n_jobs
+            #Keep about 2 tickers per worker in flight so workers stay busy without
+            #every ticker's prices and windows waiting in memory
+            with ProcessPoolExecutor(max_workers=workers) as executor:
+                self.fill_data(bounded_map(executor, self.worker_copy().create_ticker_windows, tick_prices_gen, 2 * workers), tick_ends, tick_rows)
+        if memmap:
+            self.X.flush()
+        self.train_idx, self.test_idx = self.test_train_split_idx(self.y.shape[0])
         self.signals, _ = self.decode_labels(self.y)
 
+    def count_windows(self, n_rows):
+        """Number of windows created from a ticker with n_rows prices (short tickers
+        are bulked to make a single window)"""
+        return np.maximum(n_rows, self.window) - self.window + 1
+
+    def allocate_data(self, ticker_ids, tick_rows, memmap:bool=False):
+        """Create empty X and y arrays to be filled ticker by ticker"""
+        n_rows = int(np.sum(tick_rows))
+        if memmap:
+            path = Path("data", self.folder)
+            X = ShardedArray(
+                [open_shard(path, tick_id, (rows, 9, self.window), self.dtype) for tick_id, rows in zip(ticker_ids, tick_rows)],
+                row_shape=(9, self.window),
+                dtype=self.dtype
+                )
+        else:
+            X = np.empty((n_rows, 9, self.window), dtype=self.dtype)
+        y = np.empty(n_rows, dtype=self.prices.encoded_signal.dtype)
+        return X, y
+
+    def fill_data(self, results, tick_ends, tick_rows):
+        """Write each ticker's windows into the preallocated X and y"""
+        for (encoded_signal, tick_X), en, rows in tqdm(zip(results, tick_ends, tick_rows), total=tick_ends.shape[0], desc="Create data for tickers"):
+            self.X[en-rows:en] = tick_X
+            self.y[en-rows:en] = encoded_signal
+
+    def worker_copy(self):
+        """A copy of this object without any data attached, sent to worker processes"""
+        worker = copy(self)
+        worker.prices = worker.X = worker.y = worker.signals = worker.row_index = None
+        return worker
+
+    def create_ticker_windows(self, tick_prices):
+        """Create the labels and stacked windows for a single ticker"""
+        _, encoded_signal = self.fetch_last_from_moving_window(tick_prices.encoded_signal)
+        return encoded_signal, self.create_ticker_X(tick_prices)
+
+    def create_ticker_X(self, tick_prices, last_only:bool=False):
+        """Create the stacked windows for a single ticker, no labels are needed
+
+        args:
+        ----
+        tick_prices - pandas dataframe - open, close, high and low of the ticker
+        last_only - bool:False - only create the final window (the indicators are
+            still calculated over all the prices to warm them up)
+        """
+        close, _open, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi = \
+            self.create_ticker_features(tick_prices, last_only=last_only)
+        tick_X = self.zip_data([_open, close, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi])
+        return tick_X.astype(self.dtype, copy=False)
+
     def create_ticker_data(self, tick_prices):
-        _, close = self.create_data_max_min_norm(tick_prices.close, name="close")
-        _, _open = self.create_data_max_min_norm(tick_prices.open, name="_open")
-        _, tail = self.create_data_intraday(tick_prices, head_tail="tail")
-        _, head = self.create_data_intraday(tick_prices, head_tail="head")
         _, encoded_signal = self.fetch_last_from_moving_window(tick_prices.encoded_signal)
-        macd_sht_pos, macd_sht_neg = self.create_macd(tick_prices, *self.macd_sht)
-        macd_lng_pos, macd_lng_neg = self.create_macd(tick_prices, *self.macd_lng)
-        rsi = self.create_rsi(tick_prices)
-        return encoded_signal, close, _open, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi
+        return (encoded_signal,) + self.create_ticker_features(tick_prices)
+
+    def create_ticker_features(self, tick_prices, last_only:bool=False):
+        _, close = self.create_data_max_min_norm(tick_prices.close, name="close", last_only=last_only)
+        _, _open = self.create_data_max_min_norm(tick_prices.open, name="_open", last_only=last_only)
+        _, tail = self.create_data_intraday(tick_prices, head_tail="tail", last_only=last_only)
+        _, head = self.create_data_intraday(tick_prices, head_tail="head", last_only=last_only)
+        macd_sht_pos, macd_sht_neg = self.create_macd(tick_prices, *self.macd_sht, last_only=last_only)
+        macd_lng_pos, macd_lng_neg = self.create_macd(tick_prices, *self.macd_lng, last_only=last_only)
+        rsi = self.create_rsi(tick_prices, last_only=last_only)
+        return close, _open, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi
+
+    @property
+    def inference_rows(self):
+        """The number of prices needed to build the last window of a ticker - the
+        window plus enough history to warm up the long macd"""
+        return self.window + 3 * (self.macd_lng[1] + self.macd_lng[2])
+
+    def get_latest_prices(self, rows:int=None):
+        """Fetch only the tail of the prices needed to build the last window of each ticker
+
+        args:
+        ----
+        rows - int:None - the number of prices to keep per ticker (None for inference_rows)
+
+        returns:
+        ----
+        pandas dataframe
+        """
+        rows = self.inference_rows if rows is None else rows
+        #5 trading days a week with some room for bank holidays
+        weeks = int(np.ceil(rows / 5 * 1.1)) + 1
+        prices = PriceData(use_store=self.use_store).get_prices(ticker_ids=self.ticker_ids, weeks=weeks)
+        return prices.groupby("ticker_id", sort=False).tail(rows).reset_index(drop=True)
+
+    def create_latest_data(self, prices):
+        """Create the last window for each ticker, used for scoring the current day.
+        Only the final window is normalised and stacked rather than every window.
+
+        args:
+        ----
+        prices - pandas dataframe - prices sorted by ticker_id and date
+
+        returns:
+        ----
+        pandas dataframe, numpy array - ticker_id and date of each window, X of shape (tickers, 9, window)
+        """
+        groups = prices.groupby("ticker_id", sort=False)
+        X = np.empty((groups.ngroups, 9, self.window), dtype=self.dtype)
+        for i, (_, tick_prices) in enumerate(tqdm(groups, total=groups.ngroups, desc="Create latest windows")):
+            X[i] = self.create_ticker_X(tick_prices[["open","close","high","low"]], last_only=True)[0]
+        row_index = groups.tail(1)[["ticker_id","date"]].reset_index(drop=True)
+        return row_index, X
 
     def identify_signals_gain_loss(self, s, gain:float=0.05, period1:int=5, period2:int=10):
         """Identify signals based on future performance
@@ -118,17 +276,22 @@ class TrainingData:
         index, arr = data.fetch_last_from_moving_window(window=self.window)
         return index, arr
 
-    def create_data_max_min_norm(self, s, name:str="UNDEFINED"):
-        data = Data(s)
-        index, arr = data.build_moving_window_data(window=self.window, bulk_val=0)
+    def build_windows(self, s, bulk_val:float=0, last_only:bool=False):
+        """The moving windows of a series (a strided view), only the final window if last_only"""
+        index, arr = Data(s).build_moving_window_data(window=self.window, bulk_val=bulk_val, dtype=self.dtype)
+        if last_only:
+            index, arr = index[-1:], arr[-1:]
+        return index, arr
+
+    def create_data_max_min_norm(self, s, name:str="UNDEFINED", last_only:bool=False):
+        index, arr = self.build_windows(s, bulk_val=0, last_only=last_only)
         #Normalise the data
-        for i,x in enumerate(arr):
-            arr[i] = Data(x).norm_data_max_min_value()
+        arr = norm_windows_max_min_value(arr)
         #Fill nan with 0
         arr = np.nan_to_num(arr, nan=0)
         return index, arr
 
-    def create_data_intraday(self, prices, head_tail:str="tail"):
+    def create_data_intraday(self, prices, head_tail:str="tail", last_only:bool=False):
         if head_tail == "tail":
             mask = prices.close < prices.open
         else:
@@ -144,14 +307,13 @@ class TrainingData:
         outlier.loc[outlier > 1] = 1 #Impossible vaues
         outlier.loc[outlier < 1] = 0 #Impossible vaues
         #Create windows
-        outlier = Data(outlier)
-        index, arr = outlier.build_moving_window_data(window=self.window, bulk_val=0)
+        index, arr = self.build_windows(outlier, bulk_val=0, last_only=last_only)
         #Fill nan with 0
         arr = np.nan_to_num(arr, nan=0.0, posinf=0.0, neginf=0.0)
         assert not np.any(np.isnan(arr))
         return index, arr
 
-    def create_windows(self, pos_neg, macd_hist, sht, lng, sig):
+    def create_windows(self, pos_neg, macd_hist, sht, lng, sig, last_only:bool=False):
         macd2 = macd_hist.copy()
         if pos_neg == "pos":
             #Positive
@@ -164,14 +326,12 @@ class TrainingData:
             #Reverse sign
             macd2 = macd2.apply(lambda x: abs(x))
         #Create windows
-        macd2 = Data(macd2)
-        _, macd2 = macd2.build_moving_window_data(window=self.window, bulk_val=0)
+        _, macd2 = self.build_windows(macd2, bulk_val=0, last_only=last_only)
         #Normalise the data to max value
-        for i,x in enumerate(macd2):
-            macd2[i] = Data(x).norm_data_max_value()
+        macd2 = norm_windows_max_value(macd2)
         return macd2
         
-    def create_macd(self, prices, sht, lng, sig):
+    def create_macd(self, prices, sht, lng, sig, last_only:bool=False):
         # _, _, _, _, macd_hist = Data(prices.close).calc_macd(sht, lng, sig)
         #Catch if too short
         if prices.shape[0] < (lng + sig):
@@ -179,16 +339,17 @@ class TrainingData:
         else:
             macd_df = Data(prices.close).calc_macd(sht, lng, sig)
             macd_hist = macd_df[f"MACDh_{sht}_{lng}_{sig}"]
-        pos, neg = self.create_windows("pos", macd_hist, sht, lng, sig), self.create_windows("neg", macd_hist, sht, lng, sig)
+        pos = self.create_windows("pos", macd_hist, sht, lng, sig, last_only=last_only)
+        neg = self.create_windows("neg", macd_hist, sht, lng, sig, last_only=last_only)
         pos, neg = np.nan_to_num(pos), np.nan_to_num(neg)
         return pos, neg
         
-    def create_rsi(self, prices, length:int=14):
+    def create_rsi(self, prices, length:int=14, last_only:bool=False):
         # _, _, _, _, macd_hist = Data(prices.close).calc_macd(sht, lng, sig)
         rsi_s = Data(prices.close).calc_rsi(length)
         #Normalise
         rsi_s = rsi_s / 100
-        _, rsi =  Data(rsi_s).build_moving_window_data(window=self.window, bulk_val=0.5)
+        _, rsi = self.build_windows(rsi_s, bulk_val=0.5, last_only=last_only)
         return rsi
     
     def zip_data(self, datasets:list):
@@ -203,12 +364,13 @@ class TrainingData:
 
     def encode_labels(self, s):
         labels = self.create_labels(s)
-        encoded_s = np.vectorize(labels.get)(s.values)
+        #vectorize can not infer the output type of an empty array
+        encoded_s = np.vectorize(labels.get)(s.values) if s.shape[0] else np.empty(0, dtype=int)
         return encoded_s, labels
 
     def decode_labels(self, np_array):
         rev_labels = {v:k for k,v in self.labels.items()}
-        decoded_s = np.vectorize(rev_labels.get)(np_array)
+        decoded_s = np.vectorize(rev_labels.get)(np_array) if np_array.shape[0] else np.empty(0, dtype=str)
         return decoded_s, rev_labels
 
     def test_train_split(self, X, y):
@@ -217,20 +379,58 @@ class TrainingData:
             test_size=0.8, random_state=42
             )
 
+    def test_train_split_idx(self, n_rows:int):
+        """Split row indexes rather than copying the data, gives the same split as test_train_split.
+        An empty dataset (EG a load_data subset with no rows) gives empty splits."""
+        if n_rows == 0:
+            return np.empty(0, dtype=int), np.empty(0, dtype=int)
+        return train_test_split(
+            np.arange(n_rows),
+            test_size=0.8, random_state=42
+            )
+
+    @property
+    def X_train(self):
+        return None if self.X is None else self.X[self.train_idx]
+
+    @property
+    def X_test(self):
+        return None if self.X is None else self.X[self.test_idx]
+
+    @property
+    def y_train(self):
+        return None if self.y is None else self.y[self.train_idx]
+
+    @property
+    def y_test(self):
+        return None if self.y is None else self.y[self.test_idx]
+
     def save_data(self):
+        """Save the data as per-ticker shards with a manifest (see dataset_store)"""
         path = Path("data", self.folder)
-        path.mkdir(parents=True, exist_ok=True)
-        np.save(path / "X.npy", self.X)
-        np.save(path / "y.npy", self.y)
-        np.save(path / "signals.npy", self.signals, allow_pickle=True)
-        with open(path / "labels.txt", "w+") as f:
-            f.write(json.dumps(self.labels))
-
-    def load_data(self):
+        if isinstance(self.X, ShardedArray):
+            self.X.flush()
+        write_dataset(path, self.X, self.y, self.row_index, self.labels, self.window)
+
+    def load_data(self, ticker_ids=None, from_date=None, to_date=None):
+        """Load saved data. X is memmapped and only read when it is indexed.
+
+        args:
+        ----
+        ticker_ids - list:None - only load these tickers
+        from_date - datetime:None - only load windows ending on or after this date
+        to_date - datetime:None - only load windows ending on or before this date
+        """
         path = Path("data", self.folder)
-        self.X = np.load(path / "X.npy")
-        self.y = np.load(path / "y.npy")
-        self.signals = np.load(path / "signals.npy", allow_pickle=True)
-        with open(path / "labels.txt", "r") as f:
-            self.labels = json.loads(f.read())
-        self.X_train, self.X_test, self.y_train, self.y_test = self.test_train_split(self.X, self.y)
\ No newline at end of file
+        if read_manifest(path) is None:
+            #Data saved before the sharded format
+            self.X = np.load(path / "X.npy", mmap_mode="r")
+            self.y = np.load(path / "y.npy")
+            self.row_index = None
+            with open(path / "labels.txt", "r") as f:
+                self.labels = json.loads(f.read())
+        else:
+            self.X, self.y, self.row_index, manifest = load_dataset(path, ticker_ids=ticker_ids, from_date=from_date, to_date=to_date)
+            self.labels = manifest["labels"]
+        self.signals, _ = self.decode_labels(self.y)
+        self.train_idx, self.test_idx = self.test_train_split_idx(self.y.shape[0])
\ No newline at end of file
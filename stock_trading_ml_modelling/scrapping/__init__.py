@@ -41,10 +41,13 @@ from stock_trading_ml_modelling.utils.date import calc_en_date, calc_st_date
 from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
 from stock_trading_ml_modelling.database import ticker, daily_price, weekly_price
 from stock_trading_ml_modelling.database.models import Session as session
+from stock_trading_ml_modelling.database.price_store import sync_price_store
 
 from stock_trading_ml_modelling.scrapping.scrape_data import get_tickers
-from stock_trading_ml_modelling.libs.scrapping import process_daily_prices, process_weekly_prices
+from stock_trading_ml_modelling.libs.scrapping import process_weekly_prices
+from stock_trading_ml_modelling.libs.manage_data import calc_week_start
 from stock_trading_ml_modelling.scrapping.database import create_new_tickers, create_new_ticker_markets
+from stock_trading_ml_modelling.scrapping.multi_scrape import MultiTickerScrape
 
 def full_scrape():
     """Function to perform a full scrape of all available prices"""
@@ -74,66 +77,62 @@ def full_scrape():
     latest_dates_df["max_date"] = latest_dates_df.max_date.astype("datetime64")
     #Calc the en_date for today
     en_date = calc_en_date()
+    #The earliest date which may change in the price store (None to resync everything)
+    sync_from_date = None
     if str(CONFIG['web_scrape']['mode']).lower() == 'update':
         latest_dates_df["st_date"] = [calc_st_date(v) for v in latest_dates_df.max_date]
+        #New tickers (with no prices) get their full history
+        if not latest_dates_df.max_date.isnull().any():
+            #Weeks are re-calculated from the monday of the week
+            sync_from_date = latest_dates_df.max_date.min() - dt.timedelta(days=7)
     else:
         latest_dates_df["st_date"] = dt.datetime(1970,1,1)
         #Delete existing data
         daily_price.remove()
 
-    #Loop through the tickers in tick_ftse and for each one get the latest date of scrape.
-    #Convert this date into a timestamp.
-    #Scrape all new data and add to the database.
-    dp_errors = []
+    #Scrape all new data for every ticker concurrently, prices are added to the
+    #database by a single writer as each ticker completes
+    latest_dates_df = latest_dates_df[latest_dates_df.st_date.isnull() | (latest_dates_df.st_date < en_date)]
+    jobs = [{
+        "ticker":r.ticker,
+        "ticker_id":r.id,
+        "st_date":r.st_date,
+        "en_date":en_date,
+        } for r in latest_dates_df.itertuples()]
     run_time = ProcessTime()
-    for _,r in tqdm(latest_dates_df.iterrows(), total=latest_dates_df.shape[0], desc="Scrape daily prices"):
-        log.info(f'\n{len(run_time.lap_li)} RUNNING FOR -> {r.id}, {r.ticker}')
-        log.info(f'Latst date - {r.max_date}')
-        try:
-            #Get new price data if neccesary and add/update the database
-            process_daily_prices(
-                r.ticker,
-                r.id,
-                st_date=r.st_date,
-                en_date=en_date,
-                split_from_date=r.max_date,
-                split_to_date=None
-                )
-        except Exception as e:
-            log.error(e)
-            dp_errors.append({'ticker':r.ticker, "error":e})
-        #Lap
-        log.info(run_time.lap())
-        log.info(run_time.show_latest_lap_time(show_time=True))
+    dp_errors = MultiTickerScrape(jobs).run()
     log.info(f"DAILY SCRAPE RUN TIME - {run_time.end()}")
 
     #####################
     ### WEEKLY PRICES ###
     #####################
-    log.info("\nSCRAPPING WEEKLY PRICES")
+    log.info("\nCHECKING WEEKLY PRICES")
 
-    #Make a call for all the latest dates
+    #Weekly prices are updated with the daily prices as they are written, only
+    #tickers whose weeks are behind their daily prices (EG from before the weekly
+    #prices were maintained incrementally) are caught up here
     latest_dates_df = sqlaq_to_df(weekly_price.fetch_latest(session, ticker_ids=ticker_ids))
     latest_dates_df["max_date"] = latest_dates_df.max_date.astype("datetime64")
+    latest_daily_df = sqlaq_to_df(daily_price.fetch_latest(session, ticker_ids=ticker_ids))
+    latest_dates_df = pd.merge(
+        latest_dates_df,
+        pd.DataFrame({
+            "id":latest_daily_df.id.values,
+            "daily_week":calc_week_start(latest_daily_df.max_date.astype("datetime64")).values,
+            }),
+        on="id")
+    latest_dates_df = latest_dates_df[latest_dates_df.daily_week.notnull()
+        & (latest_dates_df.max_date.isnull() | (latest_dates_df.max_date < latest_dates_df.daily_week))]
 
-    #Loop through the tickers in tick_ftse and for each one get the latest date of scrape.
-    #Convert this date into a timestamp.
-    #Scrape all new data and add to the database.
     wp_errors = []
     run_time = ProcessTime()
-    for _,r in tqdm(latest_dates_df.iterrows(), total=latest_dates_df.shape[0], desc="Process weekly prices"):
+    for _,r in tqdm(latest_dates_df.iterrows(), total=latest_dates_df.shape[0], desc="Catch up weekly prices"):
         log.info(f'\n{len(run_time.lap_li)} RUNNING FOR -> {r.id}, {r.ticker}')
         try:
-            #Get new price data if neccesary
-            if r.max_date < en_date:
-                process_weekly_prices(
-                    r.id,
-                    split_from_date=r.max_date,
-                    
-                    )
-            else:
-                log.info('No new records to collect')
-                continue
+            process_weekly_prices(
+                r.id,
+                split_from_date=None if pd.isnull(r.max_date) else r.max_date,
+                )
         except Exception as e:
             log.error(e)
             wp_errors.append({'ticker':r.ticker,"error":e})
@@ -141,7 +140,13 @@ def full_scrape():
         log.info(run_time.lap())
         log.info(run_time.show_latest_lap_time(show_time=True))
     log.info('\n\n')
-    log.info(f"WEEKLY SCRAPE RUN TIME - {run_time.end()}")
+    log.info(f"WEEKLY CATCH UP RUN TIME - {run_time.end()}")
+
+    ########################
+    ### SYNC PRICE STORE ###
+    ########################
+    log.info("\nSYNCING PRICE STORE")
+    sync_price_store(from_date=sync_from_date)
 
     ####################
     ### PRINT ERRORS ###
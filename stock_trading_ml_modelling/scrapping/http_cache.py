@@ -0,0 +1,129 @@
+"""On-disk cache of scraped pages
+
+Responses are stored in a sqlite db (CONFIG["files"]["http_cache"]) keyed by the
+sha256 of the url, with the body zlib compressed. A cached page is served without
+a request while it is younger than its ttl, after that it is revalidated with
+If-None-Match / If-Modified-Since when the server sent an ETag / Last-Modified.
+
+Modes (CONFIG["scrape"]["cache"]["mode"]):
+- "normal" - serve fresh pages from the cache, fetch and store the rest
+- "offline" - replay every page from the cache whatever its age, never make a request
+- "off" - no caching
+"""
+import math
+import time
+import zlib
+import sqlite3
+import hashlib
+from collections import namedtuple
+from pathlib import Path
+
+from stock_trading_ml_modelling.config import CONFIG
+
+#A ttl for pages which can never change
+NEVER_EXPIRES = math.inf
+
+CachedResponse = namedtuple("CachedResponse", ["url", "body", "etag", "last_modified", "fetched_at"])
+
+class HttpCache:
+    def __init__(self, path=None, mode:str=None, clock=time.time):
+        """
+        args:
+        ----
+        path - Path:None - the cache db (None for store_path / CONFIG["files"]["http_cache"])
+        mode - str:None - "normal" or "offline" (None for CONFIG["scrape"]["cache"]["mode"])
+        clock - callable:time.time - returns the current time in seconds
+        """
+        self.path = Path(CONFIG["files"]["store_path"] / CONFIG["files"]["http_cache"] if path is None else path)
+        self.mode = CONFIG["scrape"]["cache"]["mode"] if mode is None else mode
+        self.clock = clock
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.conn = sqlite3.connect(str(self.path), check_same_thread=False)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("""CREATE TABLE IF NOT EXISTS response (
+            key TEXT PRIMARY KEY,
+            url TEXT NOT NULL,
+            body BLOB NOT NULL,
+            etag TEXT,
+            last_modified TEXT,
+            fetched_at REAL NOT NULL
+            )""")
+        self.conn.commit()
+
+    @property
+    def offline(self):
+        return self.mode == "offline"
+
+    @staticmethod
+    def key(url:str):
+        return hashlib.sha256(url.encode("utf-8")).hexdigest()
+
+    def get(self, url:str):
+        """The cached response for a url, None if there is not one"""
+        row = self.conn.execute(
+            "SELECT url, body, etag, last_modified, fetched_at FROM response WHERE key = ?", (self.key(url),)
+            ).fetchone()
+        if row is None:
+            return None
+        return CachedResponse(row[0], zlib.decompress(row[1]).decode("utf-8"), *row[2:])
+
+    def is_fresh(self, entry:CachedResponse, ttl:float):
+        """If the entry can be served without revalidating"""
+        return self.clock() - entry.fetched_at < ttl
+
+    def put(self, url:str, body:str, etag:str=None, last_modified:str=None):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO response (key, url, body, etag, last_modified, fetched_at) VALUES (?, ?, ?, ?, ?, ?)",
+            (self.key(url), url, zlib.compress(body.encode("utf-8")), etag, last_modified, self.clock())
+            )
+        self.conn.commit()
+
+    def touch(self, url:str):
+        """Mark a cached response as fresh again (after a 304 Not Modified)"""
+        self.conn.execute("UPDATE response SET fetched_at = ? WHERE key = ?", (self.clock(), self.key(url)))
+        self.conn.commit()
+
+    def delete(self, url:str):
+        """Remove a cached response (EG a page which could not be processed)"""
+        self.conn.execute("DELETE FROM response WHERE key = ?", (self.key(url),))
+        self.conn.commit()
+
+    @staticmethod
+    def conditional_headers(entry:CachedResponse):
+        """Headers to revalidate a cached response with"""
+        headers = {}
+        if entry is None:
+            return headers
+        if entry.etag:
+            headers["If-None-Match"] = entry.etag
+        if entry.last_modified:
+            headers["If-Modified-Since"] = entry.last_modified
+        return headers
+
+    def clear(self, older_than:float=None):
+        """Remove cached responses, only those fetched more than older_than seconds ago if set"""
+        if older_than is None:
+            self.conn.execute("DELETE FROM response")
+        else:
+            self.conn.execute("DELETE FROM response WHERE fetched_at < ?", (self.clock() - older_than,))
+        self.conn.commit()
+
+    def close(self):
+        self.conn.close()
+
+_default_cache = None
+
+def default_cache():
+    """The shared cache from CONFIG, None if caching is off"""
+    global _default_cache
+    mode = CONFIG["scrape"]["cache"]["mode"]
+    if mode == "off":
+        return None
+    if _default_cache is None:
+        _default_cache = HttpCache(mode=mode)
+    _default_cache.mode = mode
+    return _default_cache
+
+def source_ttl(source:str):
+    """The ttl in seconds for pages from a source in CONFIG["web_addr"]"""
+    return CONFIG["scrape"]["cache"]["ttl"].get(source, 0)
@@ -0,0 +1,115 @@
+"""Scrape the daily prices of many tickers concurrently
+
+All the pages of all the tickers are fetched on one event loop through a single
+shared aiohttp session. The open connections are capped by the session's
+connector (CONFIG["scrape"]["concurrency"] and ["limit_per_host"]) and the
+request rate to each host by a shared HostRateLimiter (["host_rate"]).
+
+Cleaned prices are put on a bounded queue and written by a single writer task
+on its own thread, so the db sees one writer and fetching carries on while
+prices are upserted. The writer updates the weekly prices of the weeks written
+in the same transaction.
+"""
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from tqdm import tqdm
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.libs.logs import log
+from stock_trading_ml_modelling.libs.scrapping import clean_day_prices
+from stock_trading_ml_modelling.libs.manage_data import upsert_daily_prices
+from stock_trading_ml_modelling.scrapping.scrapes import ScrapePrices, HostRateLimiter, create_client_session, run_coro
+from stock_trading_ml_modelling.scrapping.request_policy import RetryPolicy, CircuitBreaker, RequestMetrics
+
+class MultiTickerScrape:
+    def __init__(self, jobs, concurrency:int=None, limit_per_host:int=None, host_rate:float=None,
+        write_func=None, queue_size:int=None, retry_policy:RetryPolicy=None, desc:str="Scrape daily prices"):
+        """
+        args:
+        ----
+        jobs - list - dicts of ticker, ticker_id, st_date and en_date to scrape
+        concurrency - int:None - the max open connections (None for CONFIG["scrape"]["concurrency"])
+        limit_per_host - int:None - the max open connections to one host (None for CONFIG["scrape"]["limit_per_host"])
+        host_rate - float:None - requests per second to each host (None for CONFIG["scrape"]["host_rate"])
+        write_func - callable:None - writes a ticker's prices, called on the writer thread
+            (None for upsert_daily_prices, which also updates the weekly prices)
+        queue_size - int:None - the max tickers waiting to be written (None for CONFIG["scrape"]["write_queue_size"])
+        retry_policy - RetryPolicy:None - the retries, backoff and timeouts (None for the CONFIG["scrape"] settings)
+        desc - str:"Scrape daily prices" - the description to be used in the tqdm
+        """
+        self.jobs = jobs
+        self.concurrency = concurrency
+        self.limit_per_host = limit_per_host
+        self.rate_limiter = HostRateLimiter(CONFIG["scrape"]["host_rate"] if host_rate is None else host_rate)
+        self.write_func = upsert_daily_prices if write_func is None else write_func
+        self.queue_size = CONFIG["scrape"]["write_queue_size"] if queue_size is None else queue_size
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        #Shared by all the tickers so a failing host is backed off from as a whole
+        self.breaker = CircuitBreaker()
+        self.metrics = RequestMetrics()
+        self.desc = desc
+        self.errors = []
+        self.written = {}
+
+    async def scrape_ticker(self, session, job, queue):
+        """Fetch all the pages for one ticker and queue the cleaned prices"""
+        try:
+            tick_df = await ScrapePrices(job["ticker"], job["st_date"], job["en_date"]) \
+                .scrape_session(session, rate_limiter=self.rate_limiter, retry_policy=self.retry_policy,
+                    breaker=self.breaker, metrics=self.metrics)
+            check, prices_df = clean_day_prices(job["ticker"], tick_df)
+        except Exception as e:
+            log.error(f"{job['ticker']} - {e}")
+            self.errors.append({"ticker":job["ticker"], "error":e})
+            return
+        if check:
+            prices_df["ticker_id"] = job["ticker_id"]
+            await queue.put((job, prices_df))
+        else:
+            log.info(f"{job['ticker']} - no new records found")
+
+    async def write_prices(self, queue):
+        """The single writer, runs write_func on one thread until it gets None"""
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                item = await queue.get()
+                if item is None:
+                    return
+                job, prices_df = item
+                try:
+                    await loop.run_in_executor(executor, self.write_func, prices_df)
+                    self.written[job["ticker_id"]] = self.written.get(job["ticker_id"], 0) + prices_df.shape[0]
+                except Exception as e:
+                    log.error(f"{job['ticker']} - {e}")
+                    self.errors.append({"ticker":job["ticker"], "error":e})
+
+    async def run_tasks(self):
+        #Bounded so fetching waits for the writer if it falls behind
+        queue = asyncio.Queue(maxsize=self.queue_size)
+        writer = asyncio.create_task(self.write_prices(queue))
+        progress = tqdm(total=len(self.jobs), desc=self.desc)
+
+        async def run_job(session, job):
+            await self.scrape_ticker(session, job, queue)
+            progress.update(1)
+
+        try:
+            async with create_client_session(self.concurrency, self.limit_per_host) as session:
+                await asyncio.gather(*[run_job(session, job) for job in self.jobs])
+        finally:
+            progress.close()
+            await queue.put(None)
+            await writer
+
+    def run(self):
+        """Scrape and write the prices of all the jobs
+
+        returns:
+        ----
+        list - dicts of ticker and error for any tickers which failed
+        """
+        run_coro(self.run_tasks())
+        log.info(f"{sum(self.written.values())} prices written for {len(self.written)} of {len(self.jobs)} tickers")
+        log.info(f"Requests - {self.metrics.summary()}")
+        return self.errors
@@ -0,0 +1,49 @@
+"""Benchmark parsing saved Yahoo price pages with each parser backend
+
+Run against saved pages:
+    python -m stock_trading_ml_modelling.scrapping.parse_benchmark path/to/pages/*.html
+or with no paths to use the fixture pages in tests/fixtures. The baseline is the
+original path, a BeautifulSoup html.parser tree walked by ScrapePrices.process_soup.
+"""
+import sys
+import time
+import numpy as np
+from pathlib import Path
+from bs4 import BeautifulSoup as bs
+
+from stock_trading_ml_modelling.scrapping.scrapes import ScrapePrices
+from stock_trading_ml_modelling.scrapping.price_parser import parse_price_table, available_backends
+
+FIXTURES_PATH = Path(__file__).parent.parent.parent / "tests" / "fixtures"
+
+def _process_soup(html:str):
+    return ScrapePrices("BENCH", parser="bs4").process_soup(bs(html, "html.parser"))
+
+def time_parser(func, pages:list, repeats:int=5):
+    """Median seconds to parse a page"""
+    times = []
+    for _ in range(repeats):
+        for html in pages:
+            st_time = time.perf_counter()
+            func(html)
+            times.append(time.perf_counter() - st_time)
+    return float(np.median(times))
+
+def run_benchmark(pages:list, repeats:int=5):
+    """Time each backend on the pages, checking they extract the same rows as process_soup"""
+    expected = [_process_soup(html) for html in pages]
+    results = {"process_soup":time_parser(_process_soup, pages, repeats=repeats)}
+    for backend in available_backends():
+        for html, rows in zip(pages, expected):
+            cols = parse_price_table(html, backend=backend)
+            assert [dict(zip(cols, r)) for r in zip(*cols.values())] == rows, f"{backend} rows do not match"
+        results[backend] = time_parser(lambda html: parse_price_table(html, backend=backend), pages, repeats=repeats)
+    base = results["process_soup"]
+    print(f"{len(pages)} pages, {sum(len(r) for r in expected)} rows")
+    for name, secs in results.items():
+        print(f"{name:>12}: {secs * 1000:.2f}ms per page ({base / secs:.1f}x)")
+    return results
+
+if __name__ == "__main__":
+    paths = [Path(p) for p in sys.argv[1:]] or sorted(FIXTURES_PATH.glob("*.html"))
+    run_benchmark([p.read_text(encoding="utf-8") for p in paths])
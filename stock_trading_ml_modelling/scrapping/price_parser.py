@@ -0,0 +1,124 @@
+"""Fast extraction of the Yahoo historical-prices table
+
+Rather than building a BeautifulSoup tree of the whole page and walking it with
+refine_soup, the page is parsed with lxml (or selectolax if it is installed) and
+only the cells of the historical-prices table are read. The table is returned as
+column arrays - {column name:[cell text, ...]} - ready for a dataframe.
+
+Parsing is CPU bound, so scrapes run it in a process pool (parse_pool) to keep the
+event loop free to handle responses.
+
+Backends (CONFIG["scrape"]["parser"]):
+- "lxml" - lxml.html with XPath
+- "selectolax" - selectolax's lexbor parser, fastest, optional
+- "bs4" - BeautifulSoup html.parser, as ScrapePrices.process_soup
+"""
+import atexit
+from concurrent.futures import ProcessPoolExecutor
+import lxml.html
+from bs4 import BeautifulSoup as bs
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.utils.scrape import refine_soup
+from stock_trading_ml_modelling.utils.str_formatting import clean_col_name
+
+try:
+    from selectolax.lexbor import LexborHTMLParser
+except ImportError:
+    LexborHTMLParser = None
+
+BACKENDS = ["selectolax", "lxml", "bs4"]
+TABLE_ATTR = ("data-test", "historical-prices")
+
+def available_backends():
+    return [b for b in BACKENDS if b != "selectolax" or LexborHTMLParser is not None]
+
+def _to_columns(cols:list, rows):
+    """Column arrays from rows of cell text, skipping rows which do not fill every
+    column (EG dividends, which span the price columns)"""
+    out = {c:[] for c in cols}
+    for row in rows:
+        if len(row) == len(cols):
+            for c, v in zip(cols, row):
+                out[c].append(v)
+    return out
+
+def _parse_lxml(html:str):
+    tree = lxml.html.fromstring(html)
+    tables = tree.xpath(f'//table[@{TABLE_ATTR[0]}="{TABLE_ATTR[1]}"]')
+    if not tables:
+        return None
+    table = tables[0]
+    cols = [clean_col_name(th.text_content()) for th in table.xpath("./thead/tr[1]/th")]
+    rows = ([td.text_content() for td in tr.xpath("./td")] for tr in table.xpath("./tbody/tr"))
+    return _to_columns(cols, rows)
+
+def _parse_selectolax(html:str):
+    table = LexborHTMLParser(html).css_first(f'table[{TABLE_ATTR[0]}="{TABLE_ATTR[1]}"]')
+    if table is None:
+        return None
+    cols = [clean_col_name(th.text()) for th in table.css("thead > tr:first-child > th")]
+    rows = ([td.text() for td in tr.css("td")] for tr in table.css("tbody > tr"))
+    return _to_columns(cols, rows)
+
+def _parse_bs4(html:str):
+    soup = bs(html, "html.parser")
+    filt = {"name":"table", "attrs":{TABLE_ATTR[0]:TABLE_ATTR[1]}}
+    header = refine_soup(soup, [filt, {"name":"thead"}, {"name":"tr"}])
+    if not header:
+        return None
+    cols = [clean_col_name(th.text) for th in header[0].find_all("th")]
+    rows = ([td.text for td in refine_soup(tr, [{"name":"td"}])]
+        for tr in refine_soup(soup, [filt, {"name":"tbody"}, {"name":"tr"}]))
+    return _to_columns(cols, rows)
+
+_PARSERS = {
+    "lxml":_parse_lxml,
+    "selectolax":_parse_selectolax,
+    "bs4":_parse_bs4,
+}
+
+def default_backend():
+    """CONFIG["scrape"]["parser"], falling back to lxml if selectolax is not installed"""
+    backend = CONFIG["scrape"]["parser"]
+    if backend == "selectolax" and LexborHTMLParser is None:
+        return "lxml"
+    return backend
+
+def parse_price_table(html:str, backend:str=None):
+    """Extract the historical-prices table from a page
+
+    args:
+    ----
+    html - str - the page
+    backend - str:None - "lxml", "selectolax" or "bs4" (None for default_backend())
+
+    returns:
+    ----
+    dict - column name to a list of the cell text, empty if the page is empty
+
+    raises:
+    ----
+    ValueError - the page has no historical-prices table (EG a consent or error page)
+    """
+    backend = default_backend() if backend is None else backend
+    if not html:
+        return {}
+    columns = _PARSERS[backend](html)
+    if columns is None:
+        raise ValueError("No historical-prices table in the page")
+    return columns
+
+_parse_pool = None
+
+def parse_pool():
+    """The shared process pool for parsing, None to parse on the calling thread
+    (CONFIG["scrape"]["parse_workers"] of 0)"""
+    global _parse_pool
+    workers = CONFIG["scrape"]["parse_workers"]
+    if not workers:
+        return None
+    if _parse_pool is None:
+        _parse_pool = ProcessPoolExecutor(max_workers=workers)
+        atexit.register(_parse_pool.shutdown)
+    return _parse_pool
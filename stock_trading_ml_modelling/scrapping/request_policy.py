@@ -0,0 +1,156 @@
+"""Retry, backoff and circuit breaking for the async scrapes
+
+Settings are taken from CONFIG["scrape"]:
+- retries - attempts per url
+- backoff_base / backoff_max - seconds, the exponential backoff is
+  min(backoff_max, backoff_base * 2 ** attempt) with full jitter
+- request_timeout - seconds for one attempt, total_timeout - seconds for all attempts at a url
+  from the first attempt (time queued for a rate limit slot is not counted)
+- breaker_threshold - consecutive failures before a host's circuit opens
+- breaker_reset - seconds the circuit stays open before a trial request is let through
+"""
+import time
+import random
+import datetime as dt
+import pandas as pd
+import numpy as np
+from email.utils import parsedate_to_datetime
+
+from stock_trading_ml_modelling.config import CONFIG
+
+#Statuses worth retrying, others (EG 404) fail straight away
+RETRY_STATUSES = {408, 425, 429, 500, 502, 503, 504}
+
+class ScrapeError(Exception):
+    """A url could not be fetched"""
+
+class CircuitOpenError(ScrapeError):
+    """Requests to a host are being refused after repeated failures"""
+
+def parse_retry_after(value, now:dt.datetime=None):
+    """Seconds to wait from a Retry-After header (seconds or an http date), None if not set"""
+    if value is None:
+        return None
+    value = str(value).strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        retry_at = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    now = dt.datetime.now(dt.timezone.utc) if now is None else now
+    return max(0.0, (retry_at - now).total_seconds())
+
+class RetryPolicy:
+    def __init__(self, retries:int=None, backoff_base:float=None, backoff_max:float=None,
+        request_timeout:float=None, total_timeout:float=None):
+        """
+        args:
+        ----
+        retries - int:None - the max attempts per url (None for CONFIG["scrape"]["retries"])
+        backoff_base - float:None - seconds before the first retry (None for CONFIG["scrape"]["backoff_base"])
+        backoff_max - float:None - the max seconds between retries (None for CONFIG["scrape"]["backoff_max"])
+        request_timeout - float:None - seconds for one attempt (None for CONFIG["scrape"]["request_timeout"])
+        total_timeout - float:None - seconds for all attempts (None for CONFIG["scrape"]["total_timeout"])
+        """
+        conf = CONFIG["scrape"]
+        self.retries = conf["retries"] if retries is None else retries
+        self.backoff_base = conf["backoff_base"] if backoff_base is None else backoff_base
+        self.backoff_max = conf["backoff_max"] if backoff_max is None else backoff_max
+        self.request_timeout = conf["request_timeout"] if request_timeout is None else request_timeout
+        self.total_timeout = conf["total_timeout"] if total_timeout is None else total_timeout
+
+    def backoff(self, attempt:int, retry_after:float=None):
+        """Seconds to wait after a failed attempt (0 based), at least retry_after if the
+        server sent one. Full jitter stops retries from many requests lining up."""
+        delay = random.uniform(0, min(self.backoff_max, self.backoff_base * 2 ** attempt))
+        if retry_after is not None:
+            delay = max(delay, retry_after)
+        return delay
+
+class CircuitBreaker:
+    def __init__(self, threshold:int=None, reset_secs:float=None, clock=time.monotonic):
+        """Stops requests to a host after threshold consecutive failures, for reset_secs.
+        After that one trial request is let through, closing the circuit if it succeeds.
+
+        args:
+        ----
+        threshold - int:None - failures to open the circuit (None for CONFIG["scrape"]["breaker_threshold"])
+        reset_secs - float:None - seconds the circuit stays open (None for CONFIG["scrape"]["breaker_reset"])
+        clock - callable:time.monotonic - returns the current time in seconds
+        """
+        self.threshold = CONFIG["scrape"]["breaker_threshold"] if threshold is None else threshold
+        self.reset_secs = CONFIG["scrape"]["breaker_reset"] if reset_secs is None else reset_secs
+        self.clock = clock
+        self.failures = {}
+        self.opened_at = {}
+
+    def is_open(self, host):
+        return host in self.opened_at
+
+    def check(self, host):
+        """Raise CircuitOpenError if requests to the host are being refused"""
+        opened_at = self.opened_at.get(host)
+        if opened_at is None:
+            return
+        if self.clock() - opened_at < self.reset_secs:
+            raise CircuitOpenError(f"Circuit open for {host} after {self.failures[host]} failures")
+        #Half open - let this request through, another failure re-opens it
+        self.opened_at[host] = self.clock()
+
+    def record_success(self, host):
+        self.failures.pop(host, None)
+        self.opened_at.pop(host, None)
+
+    def record_failure(self, host):
+        self.failures[host] = self.failures.get(host, 0) + 1
+        if self.failures[host] >= self.threshold:
+            self.opened_at[host] = self.clock()
+
+class RequestMetrics:
+    def __init__(self):
+        """Attempt counts and latencies per url"""
+        self.urls = {}
+        self.cache_hits = 0
+
+    def record_cache_hit(self, url):
+        """Record a url served from the cache without a request"""
+        self.cache_hits += 1
+
+    def record(self, url, secs:float, status=None, error=None):
+        """Record one attempt at a url"""
+        rec = self.urls.setdefault(url, {"attempts":0, "latencies":[], "status":None, "error":None, "ok":False})
+        rec["attempts"] += 1
+        rec["latencies"].append(secs)
+        rec["status"] = status
+        rec["error"] = None if error is None else str(error)
+        rec["ok"] = status in (200, 304)
+
+    def to_df(self):
+        """One row per url with its attempts, last status and latencies"""
+        return pd.DataFrame([{
+            "url":url,
+            "attempts":rec["attempts"],
+            "status":rec["status"],
+            "ok":rec["ok"],
+            "error":rec["error"],
+            "latency_mean":np.mean(rec["latencies"]),
+            "latency_max":np.max(rec["latencies"]),
+            } for url, rec in self.urls.items()],
+            columns=["url","attempts","status","ok","error","latency_mean","latency_max"])
+
+    def summary(self):
+        """Totals across all urls, to help tune CONFIG["scrape"]"""
+        if not self.urls:
+            return {"urls":0, "cache_hits":self.cache_hits}
+        latencies = np.concatenate([rec["latencies"] for rec in self.urls.values()])
+        attempts = np.array([rec["attempts"] for rec in self.urls.values()])
+        return {
+            "urls":len(self.urls),
+            "cache_hits":self.cache_hits,
+            "failed":int(sum(not rec["ok"] for rec in self.urls.values())),
+            "attempts":int(attempts.sum()),
+            "retried_urls":int((attempts > 1).sum()),
+            "latency_p50":float(np.percentile(latencies, 50)),
+            "latency_p95":float(np.percentile(latencies, 95)),
+        }
@@ -1,6 +1,7 @@
 import pandas as pd
 import re
 import datetime as dt
+from functools import lru_cache
 
 from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.utils.str_formatting import zero_pad_single
@@ -30,13 +31,23 @@ def get_tickers():
 
     return tick_ftse
 
+@lru_cache(maxsize=None)
+def _scrape_public_holidays(year):
+    return tuple(ScrapeBankHolidays(year).scrape())
+
+def get_named_public_holidays(year):
+    """Function for getting the bank holidays in CONFIG["public_holidays"] as
+    (datetime, name) pairs. Each year is only scraped once per run (and is
+    cached on disk between runs)."""
+    holidays = []
+    for day, name in _scrape_public_holidays(year):
+        #Keep the public holiday dates
+        if name not in CONFIG["public_holidays"]:
+            continue
+        #Convert numbers to zero padded and convert the dates
+        holidays.append((dt.datetime.strptime(f'{zero_pad_single(day)} {year}', r"%B %d %Y"), name))
+    return holidays
+
 def get_public_holidays(year):
-    """Function for getting bank holidays and converting to datetime objects"""
-    dates = ScrapeBankHolidays.scrape(year)
-    #Keep the public holiday dates
-    dates = [d for d in dates if d[1] in CONFIG["public_holidays"]]
-    #Convert numbers to zero padded
-    dates = [zero_pad_single(d[0]) for d in dates]
-    #Convert the dates
-    dates = [dt.datetime.strptime(f'{d} {year}', r"%B %d %Y") for d in dates]
-    return dates
+    """Function for getting bank holidays and converting to datetime objects."""
+    return [d for d, _ in get_named_public_holidays(year)]
@@ -1,10 +1,13 @@
 """Functions fr scrapping data from websites"""
 import re
+import datetime as dt
+from functools import partial
 from tqdm import tqdm
 import pandas as pd
 import asyncio
 import nest_asyncio
 import aiohttp
+from urllib.parse import urlparse
 from bs4 import BeautifulSoup as bs
 
 from stock_trading_ml_modelling.config import CONFIG
@@ -13,6 +16,11 @@ from stock_trading_ml_modelling.utils.data import flatten_one
 from stock_trading_ml_modelling.libs.logs import log
 from stock_trading_ml_modelling.utils.scrape import get_soup, refine_soup
 from stock_trading_ml_modelling.utils.str_formatting import clean_col_name
+from stock_trading_ml_modelling.scrapping.request_policy import RetryPolicy, CircuitBreaker, RequestMetrics, \
+    ScrapeError, RETRY_STATUSES, parse_retry_after
+from stock_trading_ml_modelling.scrapping.price_parser import parse_price_table, parse_pool, default_backend
+from stock_trading_ml_modelling.scrapping.http_cache import HttpCache, CachedResponse, NEVER_EXPIRES, \
+    default_cache, source_ttl
 
 def scrape_num_pages(ref:str="ftse100"):
     #Fetch the data for ftse 100
@@ -22,34 +30,179 @@ def scrape_num_pages(ref:str="ftse100"):
     num_pages = int(re.sub('[^0-9]','', last_page.text))
     return num_pages
 
+HEADERS = {'User-Agent': 'Mozilla/5.0'}
+COOKIES = dict(BCPermissionLevel='PERSONAL')
+
+def create_client_session(concurrency:int=None, limit_per_host:int=None, **kwargs):
+    """An aiohttp session with the scrape headers and cookies, limiting the number
+    of open connections in total and to each host
+
+    args:
+    ----
+    concurrency - int:None - the max open connections (None for CONFIG["scrape"]["concurrency"])
+    limit_per_host - int:None - the max open connections to one host (None for CONFIG["scrape"]["limit_per_host"])
+    """
+    concurrency = CONFIG["scrape"]["concurrency"] if concurrency is None else concurrency
+    limit_per_host = CONFIG["scrape"]["limit_per_host"] if limit_per_host is None else limit_per_host
+    connector = aiohttp.TCPConnector(limit=concurrency, limit_per_host=limit_per_host)
+    return aiohttp.ClientSession(headers=HEADERS, cookies=COOKIES, connector=connector, **kwargs)
+
+def run_coro(coro):
+    """Run a coroutine to completion, also from inside a running loop (EG jupyter)"""
+    loop = asyncio.get_event_loop()
+    if isinstance(loop, asyncio.BaseEventLoop):
+        nest_asyncio.apply()
+    return loop.run_until_complete(coro)
+
+class HostRateLimiter:
+    def __init__(self, rate:float=None):
+        """Spaces out the requests to each host so no more than rate are started a second
+
+        args:
+        ----
+        rate - float:None - requests per second to each host (None or 0 for no limit)
+        """
+        self.interval = 1 / rate if rate else 0
+        self.next_times = {}
+
+    async def wait(self, url):
+        """Sleep until the next slot for the url's host, returns the seconds waited"""
+        if not self.interval:
+            return 0
+        host = urlparse(url).netloc
+        now = asyncio.get_running_loop().time()
+        #Claim the next slot for this host before sleeping
+        slot = max(now, self.next_times.get(host, now))
+        self.next_times[host] = slot + self.interval
+        await asyncio.sleep(slot - now)
+        return slot - now
+
 class AsyncScrape:
-    def __init__(self, func, urls, desc=None):
+    def __init__(self, func, urls, desc=None, rate_limiter:HostRateLimiter=None, retry_policy:RetryPolicy=None,
+        breaker:CircuitBreaker=None, metrics:RequestMetrics=None, cache:HttpCache=None, ttl=0,
+        text_func:bool=False, executor=None):
         """
         args:
         ----
-        func - callable - the function to run the scrape
-            MUST BE ASYNC FUNCTION
+        func - callable - the function to run the scrape, passed the soup of each page
+            (or the page text if text_func)
         urls - list - a list of urls to be scraped
         desc - str:None - the description to be usedin the tqdm
+        rate_limiter - HostRateLimiter:None - shared between scrapes to limit the requests to each host
+        retry_policy - RetryPolicy:None - the retries, backoff and timeouts (None for the CONFIG["scrape"] settings)
+        breaker - CircuitBreaker:None - shared between scrapes to stop requests to failing hosts
+        metrics - RequestMetrics:None - shared between scrapes to record attempts and latencies
+        cache - HttpCache:None - the cache to serve and store pages in (None for no caching)
+        ttl - float or dict:0 - seconds a cached page is served without revalidating, or a dict
+            of url to ttl (0 to always revalidate, NEVER_EXPIRES for pages which cannot change)
+        text_func - bool:False - pass func the page text rather than a BeautifulSoup
+        executor - Executor:None - run func in this pool (EG parse_pool()) so it does not
+            block the event loop (None to run it on the loop)
         """
         self.func = func
         self.urls = urls
         self.desc = desc
+        self.rate_limiter = HostRateLimiter() if rate_limiter is None else rate_limiter
+        self.retry_policy = RetryPolicy() if retry_policy is None else retry_policy
+        self.breaker = CircuitBreaker() if breaker is None else breaker
+        self.metrics = RequestMetrics() if metrics is None else metrics
+        self.cache = cache
+        self.ttl = ttl
+        self.text_func = text_func
+        self.executor = executor
+
+    def url_ttl(self, url):
+        return self.ttl.get(url, 0) if isinstance(self.ttl, dict) else self.ttl
+
+    async def _attempt(self, session, url, headers:dict=None):
+        """One request, returns the status, the body (if 200) and the response headers"""
+        timeout = aiohttp.ClientTimeout(total=self.retry_policy.request_timeout)
+        async with session.get(url, timeout=timeout, headers=headers) as resp:
+            body = None
+            if resp.status == 200:
+                body = (await resp.read()).decode("utf-8")
+            return resp.status, body, resp.headers
+
+    async def _request(self, session, url, cached:CachedResponse=None):
+        host = urlparse(url).netloc
+        loop = asyncio.get_running_loop()
+        policy = self.retry_policy
+        error = None
+        #The total timeout starts at the first attempt, time spent queueing for a
+        #rate limit slot is not counted (every url gathered at once is queued)
+        deadline = None
+        for i in range(policy.retries):
+            self.breaker.check(host)
+            waited = await self.rate_limiter.wait(url)
+            st_time = loop.time()
+            deadline = st_time + policy.total_timeout if deadline is None else deadline + waited
+            status, retry_after = None, None
+            try:
+                status, body, resp_headers = await asyncio.wait_for(
+                    self._attempt(session, url, HttpCache.conditional_headers(cached)),
+                    timeout=max(deadline - st_time, 0))
+                retry_after = parse_retry_after(resp_headers.get("Retry-After"))
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                error = e if str(e) else type(e).__name__
+            if status == 200 or (status == 304 and cached is not None):
+                self.metrics.record(url, loop.time() - st_time, status=status)
+                self.breaker.record_success(host)
+                if status == 304:
+                    self.cache.touch(url)
+                    return cached.body, None
+                return body, resp_headers
+            if status is not None:
+                error = f"HTTP {status}"
+            self.metrics.record(url, loop.time() - st_time, status=status, error=error)
+            if status is not None and status not in RETRY_STATUSES:
+                raise ScrapeError(f"{error} from {url}")
+            self.breaker.record_failure(host)
+            if i + 1 < policy.retries:
+                delay = policy.backoff(i, retry_after=retry_after)
+                if loop.time() + delay >= deadline:
+                    #No time left for another attempt
+                    raise ScrapeError(f"Timed out getting {url} after {policy.total_timeout}s - {error}")
+                log.warning(f"Attempt {i + 1} for {url} failed ({error}), retrying in {delay:.1f}s")
+                await asyncio.sleep(delay)
+        raise ScrapeError(f"Failed to get {url} after {policy.retries} attempts - {error}")
+
+    async def fetch(self, session, url):
+        """Fetch a url, retrying connection errors, timeouts and retryable statuses with
+        exponential backoff until the retries or the total timeout (from the first
+        attempt) run out. Pages within their ttl are served from the cache, older
+        ones are revalidated.
+
+        returns:
+        ----
+        str, headers - the page and the response headers to cache it with (None if
+            it came from the cache)
+
+        raises:
+        ----
+        ScrapeError - the url could not be fetched (or is not cached in offline mode)
+        CircuitOpenError - requests to the host are being refused
+        """
+        cached = None
+        if self.cache is not None:
+            cached = self.cache.get(url)
+            if cached is not None and (self.cache.offline or self.cache.is_fresh(cached, self.url_ttl(url))):
+                self.metrics.record_cache_hit(url)
+                return cached.body, None
+            if self.cache.offline:
+                raise ScrapeError(f"{url} is not in the cache to replay offline")
+        return await self._request(session, url, cached)
+
+    def store(self, url, body:str, resp_headers):
+        """Cache a fetched page (nothing is stored if it came from the cache)"""
+        if self.cache is None or resp_headers is None:
+            return
+        self.cache.put(url, body, etag=resp_headers.get("ETag"), last_modified=resp_headers.get("Last-Modified"))
 
     async def async_request(self, session, url):
-        for i in range(5):
-            # try:
-            async with session.get(url) as resp:
-                if resp.status == 200:
-                    body = await resp.content.read()
-                    body = body.decode("utf-8")
-                    return body
-            # except Exception as e:
-            #     print(f"Error encountered in attempt {i} for url {url}")
-            #     print(e)
-            #     continue
-            # else:
-            #     raise Exception(f"Failed to get a response from url {url}")
+        """Fetch a url (see fetch), caching the page"""
+        body, resp_headers = await self.fetch(session, url)
+        self.store(url, body, resp_headers)
+        return body
 
     async def get_soup(self, session, url):
         content = await self.async_request(session, url)
@@ -57,31 +210,35 @@ class AsyncScrape:
         return soup
     
     async def run_func(self, session, url):
-        soup = await self.get_soup(session, url)
-        return self.func(soup)
+        """Fetch and process a page. The page is only cached once func has processed
+        it, so an error page served with a 200 (EG a consent page) is not kept."""
+        body, resp_headers = await self.fetch(session, url)
+        content = body if self.text_func else bs(body, 'html.parser')
+        try:
+            if self.executor is None:
+                out = self.func(content)
+            else:
+                out = await asyncio.get_running_loop().run_in_executor(self.executor, self.func, content)
+        except:
+            #A bad page served from the cache is dropped so it is fetched again
+            if self.cache is not None and resp_headers is None:
+                self.cache.delete(url)
+            raise
+        self.store(url, body, resp_headers)
+        return out
+
+    async def run_session(self, session):
+        """Scrape all the urls with an open session"""
+        tasks = [self.run_func(session, url) for url in self.urls]
+        return await asyncio.gather(*tasks)
 
     async def run_tasks(self):
-        tasks = []
-        semaphore = asyncio.Semaphore(1)
-        hdr = {'User-Agent': 'Mozilla/5.0'}
-        cookies = dict(BCPermissionLevel='PERSONAL')
-        async with semaphore:
-            async with aiohttp.ClientSession(headers=hdr, cookies=cookies) as session:
-                for url in tqdm(self.urls, total=len(self.urls), desc=self.desc):
-                    #fa will be a list of arguments
-                    tasks.append(
-                        self.run_func(session, url)
-                    )
-                return await asyncio.gather(*tasks)
+        async with create_client_session() as session:
+            return await self.run_session(session)
 
     def get_resps(self):
         """Creaes an event loop and starts the async scrape"""
-        loop = asyncio.get_event_loop()
-        if isinstance(loop, asyncio.BaseEventLoop):
-            nest_asyncio.apply()
-        coro = self.run_tasks()
-        resps = loop.run_until_complete(coro)
-        return resps
+        return run_coro(self.run_tasks())
 
 class ScrapeTickers:
     def __init__(self, ref:str="ftse100"):
@@ -111,7 +268,7 @@ class ScrapeTickers:
         #Prep urls
         urls = [CONFIG["web_addr"][self.ref].format(page) for page in range(1, num_pages+1)]
         #Scrape asyncronously
-        async_scrape = AsyncScrape(self.process_soup, urls)
+        async_scrape = AsyncScrape(self.process_soup, urls, cache=default_cache(), ttl=source_ttl(self.ref))
         row_li = flatten_one(async_scrape.get_resps())
         #Create a dataframe
         tick_ftse = pd.DataFrame(data=row_li, columns=['ticker','company'])
@@ -119,7 +276,7 @@ class ScrapeTickers:
         return tick_ftse
 
 class ScrapePrices:
-    def __init__(self, ticker, st_date=None, en_date=None, interval="1d"):
+    def __init__(self, ticker, st_date=None, en_date=None, interval="1d", parser:str=None):
         """
         args:
         ----
@@ -127,6 +284,8 @@ class ScrapePrices:
         st_date - datetime object:None
         en_date - dtaetime object:None
         interval - str:"1d"
+        parser - str:None - the parser backend, "bs4" for process_soup, else see
+            price_parser (None for CONFIG["scrape"]["parser"])
 
         returns:
         ----
@@ -137,6 +296,7 @@ class ScrapePrices:
         self.st_date = st_date
         self.en_date = en_date
         self.interval = interval
+        self.parser = default_backend() if parser is None else parser
 
     def process_soup(self, soup):
         if soup == "":
@@ -168,15 +328,46 @@ class ScrapePrices:
                 data.append({c:x.text for c,x in zip(cols, td)})
         return data
 
-    def scrape(self):
-        #clean ticker
+    def url_ttls(self):
+        """The pages to scrape, each covering no more than max_days, with their cache ttls.
+        Windows which ended more than final_after_days ago can no longer change so never expire."""
         sec_ref_li = create_sec_ref_li(self.st_date, self.en_date, days=CONFIG["scrape"]["max_days"])
-        #Prep urls
-        urls = [CONFIG["web_addr"]["share_price"].format(self.ticker, secs[0], secs[1], self.interval, self.interval) for secs in sec_ref_li]
+        final_date = dt.datetime.now() - dt.timedelta(days=CONFIG["scrape"]["cache"]["final_after_days"])
+        final_secs = (final_date - dt.datetime(1970, 1, 1)).total_seconds()
+        return {
+            CONFIG["web_addr"]["share_price"].format(self.ticker, secs[0], secs[1], self.interval, self.interval):
+                NEVER_EXPIRES if secs[1] < final_secs else source_ttl("share_price")
+            for secs in sec_ref_li
+            }
+
+    def urls(self):
+        return list(self.url_ttls())
+
+    def async_scrape(self, **kwargs):
+        """kwargs are passed to AsyncScrape, the default cache is used unless one is given"""
+        url_ttls = self.url_ttls()
+        kwargs.setdefault("cache", default_cache())
+        kwargs.setdefault("ttl", url_ttls)
+        if self.parser == "bs4":
+            return AsyncScrape(self.process_soup, list(url_ttls), **kwargs)
+        #Only the price table is extracted, in the parse pool
+        kwargs.setdefault("executor", parse_pool())
+        return AsyncScrape(partial(parse_price_table, backend=self.parser), list(url_ttls), text_func=True, **kwargs)
+
+    def to_df(self, pages:list):
+        """Combine the scraped pages into one dataframe"""
+        if self.parser == "bs4":
+            return pd.DataFrame(flatten_one(pages))
+        pages = [pd.DataFrame(cols) for cols in pages if cols]
+        return pd.concat(pages, ignore_index=True) if pages else pd.DataFrame()
+
+    async def scrape_session(self, session, **kwargs):
+        """Scrape with an open session (shared with other scrapes), kwargs are passed to AsyncScrape"""
+        return self.to_df(await self.async_scrape(**kwargs).run_session(session))
+
+    def scrape(self):
         #Scrape asyncronously
-        async_scrape = AsyncScrape(self.process_soup, urls)
-        data = flatten_one(async_scrape.get_resps())
-        tick_df = pd.DataFrame(data)
+        tick_df = self.to_df(self.async_scrape().get_resps())
         return tick_df
 
 class ScrapeBankHolidays:
@@ -204,7 +395,9 @@ class ScrapeBankHolidays:
 
     def scrape(self):
         urls = [CONFIG["web_addr"]["holidays"].format(self.year)]
+        #Past years can no longer change
+        ttl = NEVER_EXPIRES if self.year < dt.date.today().year else source_ttl("holidays")
         #Scrape asyncronously
-        async_scrape = AsyncScrape(self.process_soup, urls)
+        async_scrape = AsyncScrape(self.process_soup, urls, cache=default_cache(), ttl=ttl)
         data = flatten_one(async_scrape.get_resps())
         return data
@@ -2,11 +2,66 @@
 import pandas as pd
 import numpy as np
 import datetime as dt
+import warnings
+from scipy.signal import lfilter
 
 ####################
 ### EMA AND MACD ###
 ####################
 
+#Vectorised ema kernel - runs the ema recursion as a linear filter over the last axis
+def calc_ema_array(arr, periods:int, lead_nan=0, seed_window:int=None):
+    """Function used to create EMAs for a 1-D series or a 2-D block (IE ticker x date)
+    in a single call, running the recursion as a compiled linear filter rather than
+    a python loop.
+
+    The EMA is seeded with the mean of the first seed_window values (after lead_nan)
+    and this seed is placed at position lead_nan + periods - 1. All values before the
+    seed are nan. Nans after the seed propagate through the recursion.
+    
+    args:
+    -----
+    arr - numpy array - 1-D or 2-D array of float values, time runs along the last axis
+    periods - int - value describing how far to look at for EMA calc
+    lead_nan - int or array:0 - the number of nans at the start which should be ignored,
+        an array with one value per row can be given for 2-D inputs
+    seed_window - int:None - the number of values averaged for the seed, defaults to periods
+
+    returns:
+    ------
+    numpy array - float64 of the same shape as arr
+    """
+    arr = np.asarray(arr, dtype=np.float64)
+    one_d = arr.ndim == 1
+    arr = np.atleast_2d(arr)
+    if seed_window is None:
+        seed_window = periods
+    #Calc mod val
+    mod = 2 / (periods+1)
+    out = np.full(arr.shape, np.nan)
+    lead_nan = np.broadcast_to(np.asarray(lead_nan, dtype=int), (arr.shape[0],))
+    #Rows sharing a lead_nan share a seed position so can be filtered together
+    for ln in np.unique(lead_nan):
+        rows = np.flatnonzero(lead_nan == ln)
+        seed_i = ln + periods - 1
+        if seed_i >= arr.shape[1] or seed_i < 0:
+            continue
+        block = arr[rows]
+        #Seed with the sma, nanmean of an all nan slice gives nan (as per the loop version)
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", category=RuntimeWarning)
+            seed = np.nanmean(block[:, ln:ln + seed_window], axis=1)
+        out[rows, seed_i] = seed
+        if seed_i + 1 < arr.shape[1]:
+            #ema[i] = v[i] * mod + ema[i-1] * (1 - mod), with ema[seed_i] fed in as the initial state
+            out[rows, seed_i+1:] = lfilter(
+                [mod], [1, -(1 - mod)],
+                block[:, seed_i+1:],
+                axis=1,
+                zi=((1 - mod) * seed)[:, None]
+            )[0]
+    return out[0] if one_d else out
+
 #Function for calculating ema
 def calc_ema(s_in, periods, lead_nan:int=0):
     """Function used to create EMA for a series
@@ -21,36 +76,35 @@ def calc_ema(s_in, periods, lead_nan:int=0):
     ------
     pandas series    
     """
-    #Calc mod val
-    mod = 2 / (periods+1)
-
-    li_out = []
-    thresh_i = s_in.index.min() + lead_nan + periods - 1
-    for i, v in s_in.iteritems():
-        if i < thresh_i:
-            ema = None
-        elif i == thresh_i:
-            ema = np.nanmean(s_in.iloc[lead_nan:lead_nan + periods + 1])
-        else:
-            ema = (v * mod) + (prev_ema * (1 - mod))
-        prev_ema = ema
-        li_out.append(ema)
-    s_out = pd.Series(li_out)
-    s_out.index = s_in.index
-    return s_out
-
-    # #Weighting series
-    # weight_ar = np.array(range(0, periods))
-    # weight_ar = (1-mod)**weight_ar
-    # #Calc cum emas
-    # ema_s = [0] * s_in.shape[0]
-    # for i in range(0, periods):
-    #     ema_s += s_in.shift(i) * weight_ar[i]
-    # #Calc ema
-    # ema_s =  ema_s / np.sum(weight_ar)
-    # return ema_s.copy()
+    #The seed has historically been the mean of periods + 1 values, keep this so features don't shift
+    ema = calc_ema_array(s_in.values, periods, lead_nan=lead_nan, seed_window=periods + 1)
+    return pd.Series(ema, index=s_in.index)
 
 #Function for calculating the MACD
+def calc_macd_array(arr, ema_lng:int=26, ema_sht:int=12, sig_period:int=9, lead_nan=0):
+    """Function used to create MACD for a 1-D series or a 2-D block (IE ticker x date)
+    
+    args:
+    -----
+    arr - numpy array - values to be converted to macd, time runs along the last axis
+    ema_lng - int:26 - the period over which the long ema will be calculated
+    ema_sht - int:12 - the period over which the short ema will be calculated
+    sig_period - int:9 - the period over which the macd will be smoothed as an ema
+    lead_nan - int or array:0 - the number of nans at the start of each row which should be ignored
+    
+    returns:
+    ------
+    tuple of numpy arrays - short ema, long ema, MACD line, signal line, macd histogram  
+    """
+    lead_nan = np.asarray(lead_nan, dtype=int)
+    ema_lng_ar = calc_ema_array(arr, ema_lng, lead_nan=lead_nan, seed_window=ema_lng + 1)
+    ema_sht_ar = calc_ema_array(arr, ema_sht, lead_nan=lead_nan, seed_window=ema_sht + 1)
+    #Calc the signal line
+    macd_line = ema_sht_ar - ema_lng_ar
+    signal_line = calc_ema_array(macd_line, sig_period, lead_nan=lead_nan + ema_lng, seed_window=sig_period + 1)
+    macd_hist = macd_line - signal_line
+    return (ema_sht_ar, ema_lng_ar, macd_line, signal_line, macd_hist)
+
 def calc_macd(s_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
     """Function used to create MACD for a series
     
@@ -65,18 +119,34 @@ def calc_macd(s_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
     ------
     tuple of pandas series, pandas series, pandas series - MACD line, signal line, macd histogram  
     """
+    macd_ars = calc_macd_array(s_in.values, ema_lng=ema_lng, ema_sht=ema_sht, sig_period=sig_period)
+    names = ['ema_sht','ema_lng','macd_line','signal_line','macd_hist']
+    return tuple(pd.Series(ar, index=s_in.index, name=n) for ar,n in zip(macd_ars, names))
+
+#Pack grouped values into a left aligned block
+def group_to_block(s_in, group_s):
+    """Function used to pack a long series into a 2-D block with one row per group.
+    Each row starts at column 0 so every group keeps its own start point.
     
-    tmp_df = s_in.to_frame()
-    tmp_df['ema_lng'] = calc_ema(s_in, ema_lng)
-    tmp_df['ema_sht'] = calc_ema(s_in, ema_sht)
-    #Calc the signal line
-    tmp_df['macd_line'] = tmp_df.ema_sht - tmp_df.ema_lng
-    tmp_df['signal_line'] = calc_ema(tmp_df.macd_line, sig_period, lead_nan=ema_lng)
-    tmp_df['macd_hist'] = tmp_df.macd_line - tmp_df.signal_line
-    return (tmp_df.ema_sht, tmp_df.ema_lng, tmp_df.macd_line, tmp_df.signal_line, tmp_df.macd_hist) 
+    args:
+    -----
+    s_in - pandas series - values to be packed, already in order within each group
+    group_s - pandas series - the group label for each value
+
+    returns:
+    ------
+    tuple - numpy array, numpy array, numpy array - the block, row positions, column positions
+    """
+    rows = pd.factorize(group_s, sort=True)[0]
+    cols = group_s.groupby(group_s, sort=False).cumcount().values
+    if not rows.shape[0]:
+        return np.empty((0, 0)), rows, cols
+    block = np.full((rows.max() + 1, cols.max() + 1), np.nan)
+    block[rows, cols] = s_in.values
+    return block, rows, cols
 
 #Calc the ema and macds for the data
-def calc_ema_macd(df_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
+def calc_ema_macd(df_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9, by:str=None):
     """Function used to call EMA and MACD functions
     
     args:
@@ -85,6 +155,7 @@ def calc_ema_macd(df_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
     ema_lng - int:26 - the period over which the long ema will be calculated
     ema_sht - int:12 - the period over which the short ema will be calculated
     sig_period - int:9 - the period over which the macd will be smoothed as an ema
+    by - str:None - a column to group by (EG 'ticker'), all groups are calculated in one call
 
     returns:
     ------
@@ -93,8 +164,15 @@ def calc_ema_macd(df_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
     tick_df = df_in.copy()
     try:
         #Add in the ema and macd
-        tick_df = tick_df.sort_values(by='date')
-        tick_df['ema12'],tick_df['ema26'],tick_df['macd_line'],tick_df['signal_line'],tick_df['macd'] = calc_macd(tick_df['close'],ema_lng=ema_lng, ema_sht=ema_sht, sig_period=sig_period)
+        if by is None:
+            tick_df = tick_df.sort_values(by='date')
+            tick_df['ema12'],tick_df['ema26'],tick_df['macd_line'],tick_df['signal_line'],tick_df['macd'] = calc_macd(tick_df['close'],ema_lng=ema_lng, ema_sht=ema_sht, sig_period=sig_period)
+        else:
+            tick_df = tick_df.sort_values(by=[by,'date'])
+            block, rows, cols = group_to_block(tick_df['close'], tick_df[by])
+            macd_ars = calc_macd_array(block, ema_lng=ema_lng, ema_sht=ema_sht, sig_period=sig_period)
+            for col, ar in zip(['ema12','ema26','macd_line','signal_line','macd'], macd_ars):
+                tick_df[col] = ar[rows, cols]
         return tick_df
     except Exception as e:
         print('ERROR:{}'.format(e))
@@ -106,6 +184,120 @@ def calc_ema_macd(df_in, ema_lng:int=26, ema_sht:int=12, sig_period:int=9):
 ### NORMALISING ###
 ###################
 
+#Strided view of every window of a 1-D array
+def sliding_windows(arr, window:int):
+    """Every window of consecutive values in a 1-D array as a read-only view, one
+    row per window. Built with as_strided so it works with numpy < 1.20 (which has
+    no sliding_window_view).
+
+    args:
+    -----
+    arr - numpy array - 1-D array of values
+    window - int - the number of values in each window
+
+    returns:
+    ------
+    numpy array - shape (len(arr) - window + 1, window), sharing memory with arr
+    """
+    arr = np.asarray(arr)
+    if arr.ndim != 1:
+        raise ValueError(f"arr must be 1-D, got {arr.ndim} dimensions")
+    if window < 1 or window > arr.shape[0]:
+        raise ValueError(f"window must be between 1 and the length of arr ({arr.shape[0]}), got {window}")
+    return np.lib.stride_tricks.as_strided(
+        arr,
+        shape=(arr.shape[0] - window + 1, window),
+        strides=(arr.strides[0], arr.strides[0]),
+        writeable=False
+        )
+
+#Rolling stats used to normalise every value against the window which came before it
+def norm_time_stats(s_in, window:int, neg_vals:bool=False, mode:str='max_min'):
+    """Calculate the values needed to normalise each value in a series against its
+    trailing window (the value and up to window - 1 values before it) in one pass.
+
+    Uses pandas rolling windows so the whole series is O(n) rather than re-reducing
+    each window. norm_val = (v - sub) / div
+    
+    args:
+    -----
+    s_in - pandas series - a series of values to be normalised
+    window - int - the number of values to look over
+    neg_vals - bool:False - is the output to accunt for the sign of values
+    mode  str:max_min - should the normalisation be done by max mins or standard deviation
+
+    returns:
+    ------
+    tuple - numpy array, numpy array - sub, div
+    """
+    s = pd.Series(np.asarray(s_in, dtype=np.float64))
+    if mode == 'max_min':
+        roll = s.rolling(window, min_periods=1)
+        min = roll.min().values
+        max = roll.max().values
+        #If accounting for neg_vals then adjust max and min to allow this
+        # This method allows values to be normalised and be relative to each other (IE -25 is half the magnitude of -50 and 50)
+        if neg_vals:
+            max = np.fmax(np.abs(min), max)
+            min = np.zeros(min.shape)
+        return min, max - min
+    elif mode == 'std':
+        if neg_vals:
+            #Values are normalised only against values of the same sign (0 counts as both)
+            pos = s.where(s >= 0).rolling(window, min_periods=1)
+            neg = s.where(s <= 0).rolling(window, min_periods=1)
+            neg_mask = (s < 0).values
+            mean = np.where(neg_mask, neg.mean().values, pos.mean().values)
+            std = np.where(neg_mask, neg.std(ddof=0).values, pos.std(ddof=0).values)
+        else:
+            roll = s.rolling(window, min_periods=1)
+            mean = roll.mean().values
+            std = roll.std(ddof=0).values
+        return mean, std
+    else:
+        raise ValueError('mode must be "std" or "max_min", {} given'.format(mode))
+
+def norm_time_series(s_in, window:int, neg_vals:bool=False, mode:str='max_min'):
+    """Normalise every value in a series against its trailing window
+    
+    args:
+    -----
+    s_in - pandas series - a series of values to be normalised
+    window - int - the number of values to look over
+    neg_vals - bool:False - is the output to accunt for the sign of values
+    mode  str:max_min - should the normalisation be done by max mins or standard deviation
+
+    returns:
+    ------
+    pandas series - normalised values, same index as s_in
+    """
+    sub, div = norm_time_stats(s_in, window, neg_vals=neg_vals, mode=mode)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_val = (s_in.values - sub) / div
+    return pd.Series(norm_val, index=s_in.index)
+
+def norm_time_windows(s_in, window:int, neg_vals:bool=False, mode:str='max_min'):
+    """Create the trailing window for every value in a series, each window normalised
+    by its own stats. Windows at the start of the series are padded with leading nans.
+    
+    args:
+    -----
+    s_in - pandas series - a series of values to be normalised
+    window - int - the number of values to look over
+    neg_vals - bool:False - is the output to accunt for the sign of values
+    mode  str:max_min - should the normalisation be done by max mins or standard deviation
+
+    returns:
+    ------
+    numpy array - shape (len(s_in), window)
+    """
+    sub, div = norm_time_stats(s_in, window, neg_vals=neg_vals, mode=mode)
+    padded = np.concatenate((np.full(window - 1, np.nan), np.asarray(s_in, dtype=np.float64)))
+    windows = sliding_windows(padded, window)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        norm_val = (windows - sub[:, None]) / div[:, None]
+    return norm_val
+
 #Create a function which normalises a feature based only on the values which have come before it - avoids time series bias
 def norm_time_s(ind:int, s_in, window:int, neg_vals:bool=False, mode:str='max_min',return_series:bool=False, fill_window:bool=False):
     """Normalise a value within over a time period
@@ -130,40 +322,14 @@ def norm_time_s(ind:int, s_in, window:int, neg_vals:bool=False, mode:str='max_mi
         st_ind = 0
     else:
         st_ind = this_ind - window + 1
-    s = s_in[st_ind:this_ind+1]
-    if return_series:
-        v = s
-    else:
-        v = s_in[ind]
-    #Normalise the value
-    if mode == 'max_min':
-        min = np.nanmin(s.values)
-        max = np.nanmax(s.values)
-        #If accounting for neg_vals then adjust max and min to allow this
-        # This method allows values to be normalised and be relative to each other (IE -25 is half the magnitude of -50 and 50)
-        if neg_vals:
-            max = np.nanmax([np.abs(min),max])
-            min = 0
-        norm_val = (v - min) / (max - min)
-    elif mode == 'std':
-        if neg_vals:
-            if v < 0:
-                s = s[s <= 0]
-            else:
-                s = s[s >= 0]
-            mean = np.nanmean(s.values)
-            std = np.nanstd(s.values)
-            norm_val = (v - mean) / std
-        else:
-            mean = np.nanmean(s.values)
-            std = np.nanstd(s.values)
-            norm_val = (v - mean) / std
-    else:
-        raise ValueError('mode must be "std" or "max_min", {} given'.format(mode))
-    if return_series and fill_window:
-            leading_s = pd.Series([np.nan] * (window - norm_val.shape[0]))
-            norm_val = leading_s.append(norm_val)
-    return norm_val
+    s = s_in.iloc[st_ind:this_ind+1]
+    if not return_series:
+        return norm_time_series(s, window, neg_vals=neg_vals, mode=mode).iloc[-1]
+    norm_val = norm_time_windows(s, window, neg_vals=neg_vals, mode=mode)[-1]
+    if fill_window:
+        index = list(range(window - s.shape[0])) + list(s.index)
+        return pd.Series(norm_val, index=index)
+    return pd.Series(norm_val[window - s.shape[0]:], index=s.index)
 
 #Run the functions
 def norm_prices(df_in, norm_window:int):
@@ -193,7 +359,7 @@ def norm_prices(df_in, norm_window:int):
     #Normalise
     for col in norm_cols:
         df_out["{}orig".format(col)] = df_out[col].copy() #Take a copy so as the values are changed this does not affect following calculations
-        df_out[col] = [norm_time_s(x, df_out["{}orig".format(col)],norm_window) for x in df_out.index]
+        df_out[col] = norm_time_series(df_out["{}orig".format(col)], norm_window)
     return df_out
 
 #Get in-row price change
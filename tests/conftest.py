@@ -0,0 +1,75 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from stock_trading_ml_modelling.database.models.prices import create_db
+from stock_trading_ml_modelling.libs.manage_data import calc_week_start
+
+
+@pytest.fixture
+def db_session():
+    """A session on a new in memory db"""
+    engine = create_engine("sqlite://")
+    create_db(engine)
+    session = scoped_session(sessionmaker(bind=engine))
+    yield session
+    session.remove()
+    engine.dispose()
+
+
+def _daily_prices(ticker_ids, dates, seed=None):
+    """Daily price rows for each ticker on each date. With a seed the prices are
+    random, otherwise they count up from the ticker_id so values can be checked
+    (open and close i + ticker_id, high and low 1 either side and volume i * 10)."""
+    rng = None if seed is None else np.random.default_rng(seed)
+    dates = pd.DatetimeIndex(dates)
+    n = len(dates)
+    dfs = []
+    for ticker_id in np.atleast_1d(ticker_ids):
+        if rng is None:
+            close = np.arange(n, dtype=float) + ticker_id
+            prices = {"open":close, "high":close + 1, "low":close - 1, "close":close, "volume":np.arange(n, dtype=float) * 10}
+        else:
+            prices = {c:rng.random(n) * 100 + 1 for c in ["open","high","low","close"]}
+            prices["volume"] = rng.random(n) * 1000 + 1
+        dfs.append(pd.DataFrame({
+            "ticker_id":int(ticker_id),
+            "date":dates,
+            **prices,
+            "change":0.0,
+            "week_start_date":calc_week_start(pd.Series(dates)).values,
+        }))
+    return pd.concat(dfs, ignore_index=True)
+
+
+@pytest.fixture
+def daily_prices():
+    """Factory for daily_price rows - daily_prices(ticker_ids, dates, seed=None)"""
+    return _daily_prices
+
+
+def _model_prices(ticker_rows, seed=0, end="2021-06-30"):
+    """Prices as returned by PriceData.get_prices, sorted by ticker_id and date.
+    Every ticker ends on the same date."""
+    rng = np.random.default_rng(seed)
+    dfs = []
+    for ticker_id, n in ticker_rows.items():
+        close = 100 + np.cumsum(rng.normal(0, 1, n))
+        spread = rng.random(n) + 0.1
+        dfs.append(pd.DataFrame({
+            "ticker_id":ticker_id,
+            "date":pd.bdate_range(end=end, periods=n),
+            "open":close + rng.normal(0, 0.5, n),
+            "close":close,
+            "high":close + spread,
+            "low":close - spread,
+        }))
+    return pd.concat(dfs, ignore_index=True)
+
+
+@pytest.fixture
+def model_prices():
+    """Factory for the price frames used to build windows - model_prices({ticker_id:rows}, seed=0)"""
+    return _model_prices
@@ -0,0 +1,59 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip("tensorflow")
+
+from stock_trading_ml_modelling.modelling.classifier_model import ClassifierModel
+from stock_trading_ml_modelling.modelling.dataset_store import ShardedArray
+
+
+def _data(n, row_shape=(9, 8)):
+    """Each row of X holds its own row number so batches can be checked against y"""
+    X = np.broadcast_to(np.arange(n, dtype=np.float32)[:, None, None], (n,) + row_shape).copy()
+    y = np.arange(n) % 3
+    return X, y
+
+
+def _batches(dataset):
+    return [(batch_X.numpy(), batch_y.numpy()) for batch_X, batch_y in dataset]
+
+
+def test_make_dataset_in_order():
+    cls_model = ClassifierModel(3, batch_size=4)
+    X, y = _data(10)
+    idx = np.array([7, 1, 2, 9, 4, 0])
+    batches = _batches(cls_model.make_dataset(ShardedArray([X[:5], X[5:]]), y, idx))
+    assert [b[0].shape for b in batches] == [(4, 9, 8), (2, 9, 8)]
+    assert all(b[0].dtype == np.float32 and b[1].dtype == np.int64 for b in batches)
+    rows = np.concatenate([b[0][:, 0, 0] for b in batches]).astype(int)
+    np.testing.assert_array_equal(rows, idx)
+    np.testing.assert_array_equal(np.concatenate([b[1] for b in batches]), y[idx])
+
+
+def test_make_dataset_shuffled_blocks():
+    cls_model = ClassifierModel(3, batch_size=8, shuffle_block=4)
+    X, y = _data(50)
+    idx = np.random.default_rng(0).permutation(50)[:44]
+    dataset = cls_model.make_dataset(X, y, idx, shuffle=True)
+    epochs = []
+    for _ in range(2):
+        batches = _batches(dataset)
+        assert [b[0].shape[0] for b in batches] == [8] * 5 + [4]
+        rows = np.concatenate([b[0][:, 0, 0] for b in batches]).astype(int)
+        #Every row once, with its label
+        np.testing.assert_array_equal(np.sort(rows), np.sort(idx))
+        np.testing.assert_array_equal(np.concatenate([b[1] for b in batches]), y[rows])
+        #Each batch is made of whole blocks of neighbouring training rows
+        blocks = np.searchsorted(np.sort(idx), rows) // 4
+        for st in range(0, 40, 8):
+            assert len(np.unique(blocks[st:st + 8])) == 2
+        epochs.append(rows)
+    #Reshuffled each epoch
+    assert not np.array_equal(epochs[0], epochs[1])
+
+
+def test_make_dataset_normalise():
+    cls_model = ClassifierModel(3, batch_size=4, normalise=lambda batch_X, batch_y: (batch_X / 10, batch_y))
+    X, y = _data(6)
+    batches = _batches(cls_model.make_dataset(X, y))
+    np.testing.assert_allclose(np.concatenate([b[0] for b in batches]), X / 10)
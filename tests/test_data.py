@@ -0,0 +1,137 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+#libs.data needs pandas_ta
+pytest.importorskip("pandas_ta")
+
+from stock_trading_ml_modelling.libs.data import Data, norm_windows_max_value, norm_windows_max_min_value, _safe_divide
+
+
+def _loop_build_moving_window_data(s, window, bulk_start=False, bulk_val=np.nan):
+    """The original per-window copy, kept as the reference implementation"""
+    data, en_i, window = Data(s).bulk_data_for_moving_window(s, window=window, bulk_start=bulk_start, bulk_val=bulk_val)
+    out = []
+    index = []
+    for j in range(en_i):
+        out.append(data.iloc[j:j+window])
+        index.append(data.index[j+window-1])
+    return np.array(index), np.array(out)
+
+
+def _loop_norm(arr, norm_func):
+    """The original per-window normalising through Data objects"""
+    arr = arr.copy()
+    for i, x in enumerate(arr):
+        arr[i] = norm_func(Data(x))
+    return arr
+
+
+def _windows(seed=0):
+    rng = np.random.default_rng(seed)
+    arr = rng.normal(0, 1, (20, 8))
+    #Flat, all zero, partly nan and all nan windows
+    arr[3] = 2.5
+    arr[4] = 0
+    arr[5, [1, 6]] = np.nan
+    arr[6] = np.nan
+    return arr
+
+
+@pytest.mark.parametrize("n,bulk_start,bulk_val", [
+    (30, False, np.nan),
+    (5, False, 0),
+    (30, True, 0.5),
+    (8, False, np.nan),
+    ])
+def test_build_moving_window_data_matches_loop(n, bulk_start, bulk_val):
+    s = pd.Series(np.random.default_rng(n).normal(0, 1, n), index=np.arange(n) + 100)
+    ref_index, ref = _loop_build_moving_window_data(s, 8, bulk_start=bulk_start, bulk_val=bulk_val)
+    index, out = Data(s).build_moving_window_data(window=8, bulk_start=bulk_start, bulk_val=bulk_val)
+    np.testing.assert_array_equal(out, ref)
+    np.testing.assert_array_equal(index, ref_index)
+    assert out.shape == (max(n, 8) - 8 + 1 + (7 if bulk_start else 0), 8)
+
+
+def test_build_moving_window_data_copy_dtype():
+    s = pd.Series(np.arange(12, dtype=float))
+    _, view = Data(s).build_moving_window_data(window=4)
+    #A read-only view over the data
+    assert not view.flags.writeable
+    assert np.shares_memory(view[0], view[1])
+    _, out = Data(s).build_moving_window_data(window=4, copy=True)
+    assert out.flags.writeable
+    out[0, 0] = -1
+    assert not np.shares_memory(out[0], out[1])
+    assert s.iloc[0] == 0 and out[1, 0] == 1
+    _, out = Data(s).build_moving_window_data(window=4, dtype=np.float32)
+    assert out.dtype == np.float32
+    np.testing.assert_array_equal(out, view)
+
+
+def test_norm_windows_max_min_value_matches_loop():
+    arr = _windows()
+    ref = _loop_norm(arr, lambda d: d.norm_data_max_min_value())
+    out = norm_windows_max_min_value(arr)
+    #Flat windows were NaN (0 / 0), filled with 0 by TrainingData
+    assert (out[3] == 0).all() and (out[4] == 0).all()
+    assert np.isnan(ref[3]).all()
+    np.testing.assert_allclose(np.nan_to_num(out), np.nan_to_num(ref))
+    #NaN items stay NaN
+    np.testing.assert_array_equal(np.isnan(out), np.isnan(ref) & ~np.isin(np.arange(20), [3, 4])[:, None])
+    #Works on float32 strided views without copying them first
+    _, view = Data(pd.Series(arr[:, 0])).build_moving_window_data(window=8, dtype=np.float32)
+    out = norm_windows_max_min_value(view)
+    assert out.dtype == np.float32
+    np.testing.assert_allclose(out, _loop_norm(view.copy(), lambda d: d.norm_data_max_min_value()), rtol=1e-6)
+
+
+def test_norm_windows_max_value_matches_loop():
+    arr = np.abs(_windows())
+    ref = _loop_norm(arr, lambda d: d.norm_data_max_value())
+    out = norm_windows_max_value(arr)
+    #All zero windows were NaN (0 / 0), filled with 0 by TrainingData
+    assert (out[4] == 0).all()
+    assert np.isnan(ref[4]).all()
+    np.testing.assert_allclose(np.nan_to_num(out), np.nan_to_num(ref))
+    assert (out[3] == 1).all()
+
+
+def test_safe_divide():
+    num = np.array([[1.0, 2.0], [3.0, 0.0]], dtype=np.float32)
+    den = np.array([[2.0], [0.0]], dtype=np.float32)
+    out = _safe_divide(num, den)
+    np.testing.assert_array_equal(out, [[0.5, 1.0], [0.0, 0.0]])
+    assert out.dtype == np.float32
+    assert _safe_divide(np.arange(3), np.float64(2)).dtype == np.float64
+
+
+def _close(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 + np.cumsum(rng.normal(0, 1, n)))
+
+
+@pytest.mark.parametrize("periods", [(12, 26, 9), (3, 6, 2), (26, 12, 9)])
+def test_calc_macd_matches_pandas_ta(periods):
+    import pandas_ta as ta
+    s = _close(200)
+    out = Data(s).calc_macd(*periods, fillna=None)
+    ref = ta.macd(s, *periods)
+    assert out.columns.tolist() == ref.columns.tolist()
+    np.testing.assert_allclose(out.values, ref.values, rtol=1e-9, atol=1e-9)
+    #Too short for the longest period
+    assert Data(s.iloc[:20]).calc_macd(12, 26, 9) is None
+
+
+def test_calc_macd_missing_prices():
+    import pandas_ta as ta
+    s = _close(200)
+    s.iloc[[50, 51, 120]] = np.nan
+    out = Data(s).calc_macd(12, 26, 9, fillna=None)
+    #A gap does not carry nans through the rest of the series
+    assert not out.iloc[60:].isna().any().any()
+    #Missing prices are treated as unchanged
+    np.testing.assert_allclose(out.values, ta.macd(s.ffill(), 12, 26, 9).values, rtol=1e-9, atol=1e-9)
+    #Leading nans are left for the seed
+    s.iloc[:3] = np.nan
+    assert Data(s).calc_macd(12, 26, 9).notna().all().all()
@@ -0,0 +1,168 @@
+import numpy as np
+import pandas as pd
+import pytest
+from sqlalchemy import create_engine, inspect, text
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.database.models import create_sqlite_engine
+from stock_trading_ml_modelling.database.models.prices import create_db, DailyPrice, WeeklyPrice, Ticker
+from stock_trading_ml_modelling.database.models.migrations import migrate, get_version, MIGRATIONS
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
+from stock_trading_ml_modelling.database import daily_price
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df, sqlaq_to_df_chunks, sqlaq_to_ticker_dfs
+from stock_trading_ml_modelling.database.del_data import _find_duplicates, _remove_duplicates
+
+
+def _days(n):
+    return pd.date_range("2020-01-01", periods=n, freq="D")
+
+
+def test_bulk_add_df_batches(db_session, daily_prices):
+    df = daily_prices(1, _days(25))
+    #Columns not in the table are ignored
+    df["not_a_column"] = "x"
+    assert _bulk_add_df(df, DailyPrice, session=db_session, batch_size=10) == 25
+    out = pd.read_sql("SELECT * FROM daily_price ORDER BY date", db_session.bind)
+    assert out.shape[0] == 25
+    assert out.date.iloc[3] == "2020-01-04"
+    np.testing.assert_array_equal(out.volume.values, df.volume.values)
+    assert (out.ticker_id == 1).all()
+
+
+def test_bulk_add_df_defaults(db_session):
+    df = pd.DataFrame({"ticker":["AAA","BBB"], "company":["A plc", "B plc"]})
+    _bulk_add_df(df, Ticker, session=db_session)
+    out = pd.read_sql("SELECT * FROM ticker ORDER BY ticker", db_session.bind)
+    assert out.ticker.tolist() == ["AAA","BBB"]
+    assert out.last_seen_date.notnull().all()
+
+
+def test_upsert_df_updates_and_inserts(db_session, daily_prices):
+    daily_price.upsert_df(daily_prices(1, _days(10)), session=db_session, batch_size=4)
+    new_df = daily_prices(1, _days(15))
+    new_df["close"] = new_df.close + 100
+    assert daily_price.upsert_df(new_df.iloc[5:], session=db_session, batch_size=4) == 10
+    out = pd.read_sql("SELECT * FROM daily_price ORDER BY date", db_session.bind)
+    assert out.shape[0] == 15
+    np.testing.assert_array_equal(out.close.values[:5], np.arange(5) + 1)
+    np.testing.assert_array_equal(out.close.values[5:], np.arange(5, 15) + 1 + 100)
+    #Existing rows keep their ids
+    assert out.id.iloc[:10].tolist() == list(range(1, 11))
+
+
+def test_migrate_upgrades_old_db(daily_prices):
+    engine = create_engine("sqlite://")
+    #An old db - tables without any indexes and with a duplicate price
+    for table in [DailyPrice.__table__, WeeklyPrice.__table__]:
+        table.create(engine)
+        for index in table.indexes:
+            index.drop(engine)
+    df = daily_prices(1, _days(5))
+    session = scoped_session(sessionmaker(bind=engine))
+    #A duplicate of row 2 with the same volume and one of row 3 with a lower volume
+    dups = df.iloc[[2, 3]].copy()
+    dups["volume"] = [df.volume.iloc[2], df.volume.iloc[3] - 1]
+    _bulk_add_df(pd.concat([df, dups]), DailyPrice, session=session)
+    assert get_version(engine) == 0
+    assert migrate(engine) == len(MIGRATIONS)
+    index_names = {ix["name"] for ix in inspect(engine).get_indexes("daily_price")}
+    assert {"uix_daily_price_ticker_id_date", "ix_daily_price_ticker_id_date_ohlcv", "ix_daily_price_date"} <= index_names
+    out = pd.read_sql("SELECT * FROM daily_price ORDER BY date", engine)
+    assert out.shape[0] == 5
+    #The highest volume is kept, then the last added
+    assert out.id.tolist() == [1, 2, 6, 4, 5]
+    #Nothing left to run
+    assert migrate(engine) == len(MIGRATIONS)
+
+
+def test_sqlite_engines(tmp_path):
+    path = tmp_path / "prices.db"
+    engine = create_sqlite_engine(path)
+    create_db(engine)
+    with engine.connect() as conn:
+        assert conn.execute(text("PRAGMA journal_mode")).scalar() == "wal"
+        assert conn.execute(text("PRAGMA synchronous")).scalar() == 1
+        assert conn.execute(text("PRAGMA busy_timeout")).scalar() == CONFIG["db"]["pragmas"]["busy_timeout"]
+    read_engine = create_sqlite_engine(path, read_only=True)
+    with read_engine.connect() as conn:
+        assert conn.execute(text("SELECT COUNT(*) FROM daily_price")).scalar() == 0
+        with pytest.raises(OperationalError):
+            conn.execute(text("DELETE FROM daily_price"))
+
+
+def test_fetch_columns_order_and_dtypes(db_session, daily_prices):
+    df = pd.concat([daily_prices(2, _days(10)), daily_prices(1, _days(10))])
+    _bulk_add_df(df, DailyPrice, session=db_session)
+    query = daily_price.fetch(from_date=pd.Timestamp("2020-01-05").date(), columns=["ticker_id","date","close"], order=True)
+    out = sqlaq_to_df(query, session=db_session, dtypes={"date":"datetime64[ns]", "close":np.float32})
+    assert out.columns.tolist() == ["ticker_id","date","close"]
+    assert out.shape[0] == 12
+    assert out.date.dtype == "datetime64[ns]"
+    assert out.close.dtype == np.float32
+    assert out.ticker_id.tolist() == [1] * 6 + [2] * 6
+    assert out.groupby("ticker_id").date.apply(lambda s: s.is_monotonic_increasing).all()
+
+
+def test_sqlaq_to_df_chunks_dtypes(db_session, daily_prices):
+    _bulk_add_df(daily_prices(1, _days(25)), DailyPrice, session=db_session)
+    chunks = list(sqlaq_to_df_chunks(daily_price.fetch(order=True), session=db_session, chunksize=10))
+    assert [c.shape[0] for c in chunks] == [10, 10, 5]
+    df = pd.concat(chunks, ignore_index=True)
+    assert df.date.dtype == "datetime64[ns]"
+    assert df.week_start_date.dtype == "datetime64[ns]"
+    assert df.ticker_id.dtype == np.int64
+    assert df.close.dtype == np.float64
+    assert df.date.iloc[3] == pd.Timestamp("2020-01-04")
+    df32 = next(sqlaq_to_df_chunks(daily_price.fetch(), session=db_session, dtypes={"close":np.float32}))
+    assert df32.close.dtype == np.float32
+
+
+def test_sqlaq_to_ticker_dfs_across_chunks(db_session, daily_prices):
+    for ticker_id, n in [(1, 7), (2, 3), (3, 12)]:
+        _bulk_add_df(daily_prices(ticker_id, _days(n)), DailyPrice, session=db_session)
+    query = daily_price.fetch(columns=["ticker_id","date","close"], order=True)
+    out = list(sqlaq_to_ticker_dfs(query, session=db_session, chunksize=4))
+    assert [t for t,_ in out] == [1, 2, 3]
+    assert [df.shape[0] for _,df in out] == [7, 3, 12]
+    for ticker_id, df in out:
+        assert (df.ticker_id == ticker_id).all()
+        assert df.date.is_monotonic_increasing
+    #Ordered by date the tickers' rows are interleaved, within and across chunks
+    query = daily_price.fetch(columns=["ticker_id","date","close"]).order_by(DailyPrice.date, DailyPrice.ticker_id)
+    for chunksize in [4, 100]:
+        with pytest.raises(ValueError):
+            list(sqlaq_to_ticker_dfs(query, session=db_session, chunksize=chunksize))
+
+
+def test_remove_duplicates(daily_prices):
+    #An old db without the unique indexes
+    engine = create_engine("sqlite://")
+    DailyPrice.__table__.create(engine)
+    for index in DailyPrice.__table__.indexes:
+        index.drop(engine)
+    session = scoped_session(sessionmaker(bind=engine))
+    df = daily_prices(1, _days(5))
+    _bulk_add_df(pd.concat([df, daily_prices(2, _days(5))]), DailyPrice, session=session)
+    #Ticker 1 has 2020-01-02 three times and 2020-01-04 twice (a tie on volume)
+    extra = df.iloc[[1, 1, 3]].copy()
+    extra["volume"] = [1000.0, 0.0, df.volume.iloc[3]]
+    _bulk_add_df(extra, DailyPrice, session=session)
+
+    dups = _find_duplicates(DailyPrice, session=session)
+    assert dups.shape[0] == 3
+    assert (dups.ticker_id == 1).all()
+    #A dry run deletes nothing
+    assert pd.read_sql("SELECT COUNT(*) n FROM daily_price", engine).n[0] == 13
+
+    assert _remove_duplicates(DailyPrice, session=session) == 3
+    out = pd.read_sql("SELECT * FROM daily_price ORDER BY ticker_id, date", engine)
+    assert out.shape[0] == 10
+    assert not out.duplicated(["ticker_id","date"]).any()
+    kept = out.set_index(["ticker_id","date"])
+    #The highest volume is kept, then the last added
+    assert kept.volume[(1, "2020-01-02")] == 1000.0
+    assert kept.id[(1, "2020-01-04")] == 13
+    assert _remove_duplicates(DailyPrice, session=session) == 0
+    session.remove()
@@ -0,0 +1,117 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stock_trading_ml_modelling.modelling.dataset_store import ShardedArray, open_shard, write_dataset, \
+    read_manifest, load_dataset, shard_files
+
+LABELS = {"hold":0, "buy":1, "sell":2}
+
+
+def _dataset(ticker_rows, row_shape=(3, 4), seed=0):
+    """X, y and row_index with rows grouped by ticker, dates are business days"""
+    rng = np.random.default_rng(seed)
+    n = sum(ticker_rows.values())
+    X = rng.random((n,) + row_shape).astype(np.float32)
+    y = rng.integers(0, len(LABELS), n)
+    row_index = pd.concat([
+        pd.DataFrame({"ticker_id":tick_id, "date":pd.bdate_range("2021-01-04", periods=rows)})
+        for tick_id, rows in ticker_rows.items()
+        ], ignore_index=True)
+    return X, y, row_index
+
+
+def test_sharded_array_indexing():
+    X, _, _ = _dataset({1:5, 2:3, 3:4})
+    sharded = ShardedArray([X[:5], X[5:8], X[8:]])
+    assert sharded.shape == X.shape
+    assert len(sharded) == 12
+    assert sharded.ndim == 3
+    assert sharded.dtype == np.float32
+    np.testing.assert_array_equal(sharded[6], X[6])
+    np.testing.assert_array_equal(sharded[-1], X[-1])
+    np.testing.assert_array_equal(sharded[3:10:2], X[3:10:2])
+    np.testing.assert_array_equal(sharded[X[:, 0, 0] > 0.5], X[X[:, 0, 0] > 0.5])
+    #Unsorted rows across shards come back in the order asked for
+    idx = np.array([11, 0, 7, 4, 4, -2])
+    np.testing.assert_array_equal(sharded[idx], X[idx])
+    np.testing.assert_array_equal(sharded[idx, 1], X[idx, 1])
+    np.testing.assert_array_equal(np.asarray(sharded), X)
+    sharded[[1, 9]] = 0
+    assert (sharded[[1, 9]] == 0).all()
+    empty = ShardedArray([], row_shape=(3, 4), dtype=np.float32)
+    assert empty.shape == (0, 3, 4)
+    assert empty[np.array([], dtype=int)].shape == (0, 3, 4)
+
+
+def test_write_load_round_trip(tmp_path):
+    X, y, row_index = _dataset({3:6, 1:4, 2:5})
+    manifest = write_dataset(tmp_path, X, y, row_index, LABELS, window=4)
+    assert read_manifest(tmp_path) == manifest
+    assert manifest["n_rows"] == 15
+    assert manifest["row_shape"] == [3, 4]
+    assert manifest["labels"] == LABELS
+    #Shards keep the order of the rows
+    assert [(s["ticker_id"], s["rows"], s["st_date"], s["en_date"]) for s in manifest["shards"]] == [
+        (3, 6, "2021-01-04", "2021-01-11"),
+        (1, 4, "2021-01-04", "2021-01-07"),
+        (2, 5, "2021-01-04", "2021-01-08"),
+        ]
+    assert sorted(p.name for p in tmp_path.iterdir()) == sorted(
+        ["manifest.json"] + [f for t in [1, 2, 3] for f in shard_files(t).values()])
+    X_out, y_out, row_index_out, _ = load_dataset(tmp_path)
+    #X is read from the memmapped shards
+    assert all(isinstance(s, np.memmap) for s in X_out.shards)
+    assert X_out.shape == X.shape
+    np.testing.assert_array_equal(X_out[:], X)
+    np.testing.assert_array_equal(y_out, y)
+    np.testing.assert_array_equal(row_index_out.ticker_id.values, row_index.ticker_id.values)
+    np.testing.assert_array_equal(row_index_out.date.values.astype("datetime64[D]"), row_index.date.values.astype("datetime64[D]"))
+
+
+def test_load_subset(tmp_path):
+    X, y, row_index = _dataset({3:6, 1:4, 2:5})
+    write_dataset(tmp_path, X, y, row_index, LABELS, window=4)
+    #Tickers
+    X_out, y_out, row_index_out, _ = load_dataset(tmp_path, ticker_ids=[2, 3])
+    mask = row_index.ticker_id.isin([2, 3]).values
+    np.testing.assert_array_equal(X_out[:], X[mask])
+    np.testing.assert_array_equal(y_out, y[mask])
+    assert row_index_out.ticker_id.tolist() == row_index[mask].ticker_id.tolist()
+    #Dates - ticker 1 ends before from_date so is skipped
+    X_out, y_out, row_index_out, _ = load_dataset(tmp_path, from_date="2021-01-08", to_date="2021-01-08")
+    mask = (row_index.date == "2021-01-08").values
+    assert row_index_out.ticker_id.tolist() == [3, 2]
+    assert len(X_out.shards) == 2
+    np.testing.assert_array_equal(X_out[:], X[mask])
+    np.testing.assert_array_equal(y_out, y[mask])
+    #Both
+    X_out, y_out, row_index_out, _ = load_dataset(tmp_path, ticker_ids=[3], from_date="2021-01-06")
+    mask = ((row_index.ticker_id == 3) & (row_index.date >= "2021-01-06")).values
+    np.testing.assert_array_equal(X_out[:], X[mask])
+    np.testing.assert_array_equal(y_out, y[mask])
+    #Nothing matches
+    X_out, y_out, row_index_out, _ = load_dataset(tmp_path, ticker_ids=[4])
+    assert X_out.shape == (0, 3, 4)
+    assert X_out.dtype == np.float32
+    assert y_out.shape == (0,)
+    assert row_index_out.shape[0] == 0
+
+
+def test_write_memmapped_shards_in_place(tmp_path):
+    X, y, row_index = _dataset({1:4, 2:5})
+    #Built straight into the dataset folder as when create_data(memmap=True)
+    sharded = ShardedArray([open_shard(tmp_path, 1, (4, 3, 4), np.float32), open_shard(tmp_path, 2, (5, 3, 4), np.float32)])
+    sharded[:] = X
+    sharded.flush()
+    write_dataset(tmp_path, sharded, y, row_index, LABELS, window=4)
+    X_out, y_out, _, _ = load_dataset(tmp_path)
+    np.testing.assert_array_equal(X_out[:], X)
+    np.testing.assert_array_equal(y_out, y)
+    #Saving a subset over the folder it was loaded from would lose rows
+    X_sub, y_sub, row_index_sub, _ = load_dataset(tmp_path, from_date="2021-01-06")
+    with pytest.raises(ValueError):
+        write_dataset(tmp_path, X_sub, y_sub, row_index_sub, LABELS, window=4)
+    write_dataset(tmp_path / "subset", X_sub, y_sub, row_index_sub, LABELS, window=4)
+    X_out, _, _, _ = load_dataset(tmp_path / "subset")
+    np.testing.assert_array_equal(X_out[:], X[(row_index.date >= "2021-01-06").values])
@@ -0,0 +1,141 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from stock_trading_ml_modelling.utils.ft_eng import calc_ema, calc_ema_array, calc_macd, calc_ema_macd, \
+    norm_time_s, norm_time_series, norm_time_windows, sliding_windows
+
+
+def _loop_calc_ema(s_in, periods, lead_nan:int=0):
+    """The original per-row ema, kept as the reference implementation"""
+    mod = 2 / (periods+1)
+    li_out = []
+    thresh_i = s_in.index.min() + lead_nan + periods - 1
+    for i, v in s_in.items():
+        if i < thresh_i:
+            ema = None
+        elif i == thresh_i:
+            ema = np.nanmean(s_in.iloc[lead_nan:lead_nan + periods + 1])
+        else:
+            ema = (v * mod) + (prev_ema * (1 - mod))
+        prev_ema = ema
+        li_out.append(ema)
+    s_out = pd.Series(li_out, dtype=float)
+    s_out.index = s_in.index
+    return s_out
+
+
+def _prices(n, seed=0):
+    rng = np.random.default_rng(seed)
+    return pd.Series(100 + np.cumsum(rng.normal(0, 1, n)))
+
+
+def test_calc_ema_matches_loop():
+    s = _prices(300)
+    for periods in [3, 12, 26]:
+        for lead_nan in [0, 5]:
+            np.testing.assert_allclose(
+                calc_ema(s, periods, lead_nan=lead_nan).values,
+                _loop_calc_ema(s, periods, lead_nan=lead_nan).values,
+                rtol=1e-10, equal_nan=True
+            )
+
+
+def test_calc_ema_offset_index():
+    s = _prices(100)
+    s.index = s.index + 1000
+    np.testing.assert_allclose(calc_ema(s, 12).values, _loop_calc_ema(s, 12).values, rtol=1e-10, equal_nan=True)
+
+
+def test_calc_ema_short_series():
+    s = _prices(5)
+    assert calc_ema(s, 12).isnull().all()
+
+
+def test_calc_macd_matches_loop():
+    s = _prices(300)
+    ema_sht, ema_lng, macd_line, signal_line, macd_hist = calc_macd(s)
+    ref_macd_line = _loop_calc_ema(s, 12) - _loop_calc_ema(s, 26)
+    ref_signal_line = _loop_calc_ema(ref_macd_line, 9, lead_nan=26)
+    np.testing.assert_allclose(macd_line.values, ref_macd_line.values, rtol=1e-10, equal_nan=True)
+    np.testing.assert_allclose(signal_line.values, ref_signal_line.values, rtol=1e-10, equal_nan=True)
+    np.testing.assert_allclose(macd_hist.values, (ref_macd_line - ref_signal_line).values, rtol=1e-10, equal_nan=True)
+
+
+def test_calc_ema_array_block_matches_rows():
+    block = np.stack([_prices(200, seed=i).values for i in range(4)])
+    out = calc_ema_array(block, 12, lead_nan=[0, 3, 0, 7], seed_window=13)
+    for i, ln in enumerate([0, 3, 0, 7]):
+        ref = _loop_calc_ema(pd.Series(block[i]), 12, lead_nan=ln)
+        np.testing.assert_allclose(out[i], ref.values, rtol=1e-10, equal_nan=True)
+
+
+def test_calc_ema_macd_grouped_matches_per_ticker():
+    df = pd.concat([
+        pd.DataFrame({
+            "ticker":tick,
+            "date":pd.date_range("2020-01-01", periods=n, freq="D"),
+            "close":_prices(n, seed=n).values,
+        })
+        for tick, n in [("AAA", 120), ("BBB", 80), ("CCC", 30)]
+    ]).sample(frac=1, random_state=0).reset_index(drop=True)
+    grouped = calc_ema_macd(df, by="ticker")
+    for tick in df.ticker.unique():
+        tick_df = df[df.ticker == tick].sort_values("date").reset_index(drop=True)
+        ref = calc_ema_macd(tick_df)
+        out = grouped[grouped.ticker == tick]
+        for col in ["ema12", "ema26", "macd_line", "signal_line", "macd"]:
+            np.testing.assert_allclose(out[col].values, ref[col].values, rtol=1e-10, equal_nan=True)
+
+
+def _loop_norm_time_s(ind, s_in, window, neg_vals=False, mode='max_min'):
+    """The original per-value normaliser, kept as the reference implementation"""
+    this_ind = ind - s_in.index.min()
+    st_ind = 0 if this_ind < window else this_ind - window + 1
+    s = s_in.iloc[st_ind:this_ind+1]
+    v = s_in[ind]
+    if mode == 'max_min':
+        min, max = np.nanmin(s.values), np.nanmax(s.values)
+        if neg_vals:
+            max = np.nanmax([np.abs(min), max])
+            min = 0
+        return (v - min) / (max - min)
+    if neg_vals:
+        s = s[s <= 0] if v < 0 else s[s >= 0]
+    return (v - np.nanmean(s.values)) / np.nanstd(s.values)
+
+
+def test_norm_time_series_matches_loop():
+    s = _prices(200).diff().fillna(0)
+    for mode in ['max_min', 'std']:
+        for neg_vals in [False, True]:
+            ref = [_loop_norm_time_s(x, s, 20, neg_vals=neg_vals, mode=mode) for x in s.index]
+            np.testing.assert_allclose(
+                norm_time_series(s, 20, neg_vals=neg_vals, mode=mode).values,
+                ref, rtol=1e-8, atol=1e-10
+            )
+            assert np.isclose(norm_time_s(150, s, 20, neg_vals=neg_vals, mode=mode), ref[150])
+
+
+def test_sliding_windows():
+    arr = np.arange(10, dtype=float)
+    windows = sliding_windows(arr, 4)
+    np.testing.assert_array_equal(windows, [arr[i:i+4] for i in range(7)])
+    assert not windows.flags.writeable
+    assert np.shares_memory(windows, arr)
+    #Strided input, EG a column of a 2-D array
+    col = np.arange(20).reshape(10, 2)[:, 1]
+    np.testing.assert_array_equal(sliding_windows(col, 10), [col])
+    np.testing.assert_array_equal(sliding_windows(col, 1), col[:, None])
+    for window in [0, 11]:
+        with pytest.raises(ValueError):
+            sliding_windows(col, window)
+
+
+def test_norm_time_windows_rows():
+    s = _prices(60)
+    windows = norm_time_windows(s, 10)
+    assert windows.shape == (60, 10)
+    assert np.isnan(windows[3, :6]).all()
+    np.testing.assert_allclose(windows[40], norm_time_s(40, s, 10, return_series=True).values)
+    np.testing.assert_allclose(windows[40, -1], norm_time_series(s, 10).iloc[40])
@@ -0,0 +1,67 @@
+import json
+import numpy as np
+import pandas as pd
+import pytest
+
+#libs.data needs pandas_ta
+pytest.importorskip("pandas_ta")
+tf = pytest.importorskip("tensorflow")
+
+from stock_trading_ml_modelling.database.models.prices import Ticker
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
+from stock_trading_ml_modelling.modelling import inference, classifier_model
+from stock_trading_ml_modelling.modelling.training_data import TrainingData
+from stock_trading_ml_modelling.modelling.inference import SignalScorer
+
+LABELS = {"hold":0, "buy":1, "sell":2}
+
+
+def _training_data():
+    return TrainingData(macd_sht=[3, 6, 2], macd_lng=[6, 13, 4], window=16, folder="test")
+
+
+def test_create_latest_data_matches_last_window(model_prices):
+    training_data = _training_data()
+    assert training_data.inference_rows == 16 + 3 * (13 + 4)
+    #Ticker 3 is shorter than the window
+    prices = model_prices({1:training_data.inference_rows, 2:40, 3:10})
+    row_index, X = training_data.create_latest_data(prices)
+    assert X.shape == (3, 9, 16)
+    assert X.dtype == np.float32
+    assert row_index.ticker_id.tolist() == [1, 2, 3]
+    assert (row_index.date == pd.Timestamp("2021-06-30")).all()
+    for i, (_, tick_prices) in enumerate(prices.groupby("ticker_id", sort=False)):
+        np.testing.assert_array_equal(X[i], training_data.create_ticker_X(tick_prices[["open","close","high","low"]])[-1])
+
+
+def test_signal_scorer(db_session, tmp_path, monkeypatch, model_prices):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(inference, "read_session", db_session)
+    _bulk_add_df(pd.DataFrame({"id":[1, 2, 3], "ticker":["A.L","B.L","C.L"], "company":["A","B","C"]}),
+        Ticker, session=db_session)
+    #The labels saved with the model and a small model in place of the saved one
+    model_path = tmp_path / "data" / "models" / "test"
+    model_path.mkdir(parents=True)
+    (model_path / classifier_model.LABELS_FILE).write_text(json.dumps(LABELS))
+    tf.keras.utils.set_random_seed(0)
+    model = tf.keras.Sequential([
+        tf.keras.Input((9, 16)),
+        tf.keras.layers.Flatten(),
+        tf.keras.layers.Dense(len(LABELS), activation="softmax"),
+        ])
+    monkeypatch.setattr(classifier_model, "load_model", lambda path: model)
+    scorer = SignalScorer(folder="test", batch_size=2, training_data=_training_data())
+    assert scorer.cls_model.labels == LABELS
+    #Ticker 3 has no price on the latest date so is not scored
+    prices = model_prices({1:60, 2:40, 3:30})
+    prices = prices[(prices.ticker_id != 3) | (prices.date < "2021-06-30")]
+    scores_df = scorer.score(prices)
+    assert sorted(scores_df.ticker.tolist()) == ["A.L","B.L"]
+    assert scores_df.columns.tolist() == ["ticker_id","ticker","date","signal","prob_hold","prob_buy","prob_sell"]
+    np.testing.assert_allclose(scores_df[["prob_hold","prob_buy","prob_sell"]].sum(axis=1), 1, rtol=1e-5)
+    assert scores_df.prob_buy.is_monotonic_decreasing
+    #The same probabilities as scoring the windows directly
+    _, X = scorer.training_data.create_latest_data(prices[prices.ticker_id != 3])
+    probs = model.predict(X)
+    expected = dict(zip([1, 2], probs[:, LABELS["buy"]]))
+    np.testing.assert_allclose(scores_df.prob_buy, scores_df.ticker_id.map(expected), rtol=1e-5)
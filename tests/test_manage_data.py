@@ -0,0 +1,153 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+from stock_trading_ml_modelling.database.models.prices import Ticker
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
+from stock_trading_ml_modelling.database import weekly_price
+from stock_trading_ml_modelling.libs import manage_data
+from stock_trading_ml_modelling.libs.manage_data import daily_to_weekly_price_conversion, calc_week_start, \
+    _week_runs, upsert_daily_prices
+
+
+def test_calc_week_start():
+    dates = pd.Series(pd.to_datetime(["2021-01-04", "2021-01-08 15:30", "2021-01-10", "2020-12-31"]))
+    assert calc_week_start(dates).tolist() == [pd.Timestamp(d) for d in ["2021-01-04", "2021-01-04", "2021-01-04", "2020-12-28"]]
+
+
+def test_daily_to_weekly_one_week(daily_prices):
+    dp_df = daily_prices(1, pd.bdate_range("2021-01-04", "2021-01-08"), seed=0)
+    #Non-positive prices are ignored
+    dp_df.loc[0, "open"] = 0
+    dp_df.loc[4, "close"] = 0
+    dp_df.loc[2, "low"] = -1
+    dp_df.loc[3, "volume"] = 0
+    _, wp_df = daily_to_weekly_price_conversion(dp_df)
+    assert wp_df.shape[0] == 1
+    r = wp_df.iloc[0]
+    assert r.date == pd.Timestamp("2021-01-04")
+    assert r.open == dp_df.open.iloc[1]
+    assert r.close == dp_df.close.iloc[3]
+    assert r.high == dp_df.high.max()
+    assert r.low == dp_df.low[dp_df.low > 0].min()
+    assert r.volume == dp_df.volume[dp_df.volume > 0].sum()
+    assert r.change == r.close - r.open
+
+
+def test_daily_to_weekly_multi_ticker(daily_prices):
+    dates = pd.bdate_range("2020-12-21", "2021-02-05")
+    one = daily_prices(1, dates, seed=1)
+    two = daily_prices(2, dates, seed=2)
+    #Interleaved by date and shuffled, as they come from the db
+    dp_df = pd.concat([one, two]).sample(frac=1, random_state=0)
+    _, wp_df = daily_to_weekly_price_conversion(dp_df)
+    assert wp_df.shape[0] == 2 * 7
+    assert not wp_df.duplicated(["ticker_id","date"]).any()
+    for ticker_id, tick_df in [(1, one), (2, two)]:
+        _, expected = daily_to_weekly_price_conversion(tick_df)
+        pd.testing.assert_frame_equal(wp_df[wp_df.ticker_id == ticker_id].reset_index(drop=True), expected)
+    #The week over new year is one week
+    first = wp_df[(wp_df.ticker_id == 2) & (wp_df.date == pd.Timestamp("2020-12-28"))].iloc[0]
+    week = two[(two.date >= "2020-12-28") & (two.date <= "2021-01-01")]
+    assert first.open == week.open.iloc[0]
+    assert first.close == week.close.iloc[-1]
+
+
+def test_daily_to_weekly_week_without_prices(daily_prices):
+    dp_df = daily_prices(1, pd.bdate_range("2021-01-04", "2021-01-15"), seed=0)
+    dp_df.loc[:4, ["open","close"]] = 0
+    _, wp_df = daily_to_weekly_price_conversion(dp_df)
+    assert wp_df.date.tolist() == [pd.Timestamp("2021-01-04"), pd.Timestamp("2021-01-11")]
+    assert wp_df.open.iloc[0] == 0
+    assert wp_df.open.iloc[1] == dp_df.open.iloc[5]
+
+
+def _db_prices(session, table):
+    df = pd.read_sql(f"SELECT * FROM {table} ORDER BY ticker_id, date", session.bind)
+    df["date"] = pd.to_datetime(df.date)
+    return df
+
+
+def test_week_runs():
+    weeks_df = pd.DataFrame({
+        "ticker_id":[2, 1, 1, 1, 2, 1],
+        "date":pd.to_datetime(["2021-01-04", "2021-01-04", "2021-01-11", "2021-01-25", "2021-01-04", "2021-01-11"]),
+    })
+    assert _week_runs(weeks_df) == [
+        (1, pd.Timestamp("2021-01-04"), pd.Timestamp("2021-01-11")),
+        (1, pd.Timestamp("2021-01-25"), pd.Timestamp("2021-01-25")),
+        (2, pd.Timestamp("2021-01-04"), pd.Timestamp("2021-01-04")),
+    ]
+
+
+def test_upsert_daily_prices_updates_weeks(db_session, daily_prices):
+    dates = pd.bdate_range("2021-01-04", "2021-01-29")
+    upsert_daily_prices(pd.concat([daily_prices(1, dates, seed=1), daily_prices(2, dates, seed=2)]), session=db_session)
+    assert _db_prices(db_session, "weekly_price").shape[0] == 2 * 4
+    #Revise a day in an existing week and add a new week for one ticker
+    new_df = daily_prices(1, pd.bdate_range("2021-01-13", "2021-02-02"), seed=3)
+    new_df = new_df[new_df.date.isin(pd.to_datetime(["2021-01-13", "2021-02-01", "2021-02-02"]))]
+    assert upsert_daily_prices(new_df, session=db_session) == 3
+    #The weekly prices match converting every daily price again
+    dp_df = _db_prices(db_session, "daily_price")
+    _, expected = daily_to_weekly_price_conversion(dp_df)
+    wp_df = _db_prices(db_session, "weekly_price")[expected.columns]
+    pd.testing.assert_frame_equal(wp_df, expected, check_dtype=False)
+    assert wp_df.shape[0] == 2 * 4 + 1
+
+
+def test_upsert_daily_prices_only_reads_new_weeks(db_session, monkeypatch, daily_prices):
+    dates = pd.bdate_range("2021-01-04", "2021-03-26")
+    upsert_daily_prices(daily_prices(1, dates, seed=0), session=db_session)
+    fetched = []
+    fetch_week_daily_prices = manage_data.fetch_week_daily_prices
+    def spy(*args, **kwargs):
+        df = fetch_week_daily_prices(*args, **kwargs)
+        fetched.append(df)
+        return df
+    monkeypatch.setattr(manage_data, "fetch_week_daily_prices", spy)
+    upsert_daily_prices(daily_prices(1, pd.bdate_range("2021-03-25", "2021-03-29"), seed=0), session=db_session)
+    #The week of the 22nd and the week of the 29th, not the history
+    assert fetched[0].shape[0] == 5 + 1
+
+
+def test_upsert_daily_prices_is_one_transaction(db_session, monkeypatch, daily_prices):
+    def fail(*args, **kwargs):
+        raise RuntimeError("weekly upsert failed")
+    monkeypatch.setattr(weekly_price, "upsert_df", fail)
+    with pytest.raises(RuntimeError):
+        upsert_daily_prices(daily_prices(1, pd.bdate_range("2021-01-04", "2021-01-08"), seed=0), session=db_session)
+    assert _db_prices(db_session, "daily_price").shape[0] == 0
+
+
+def test_rebuild_weekly_prices(db_session, monkeypatch, daily_prices):
+    from stock_trading_ml_modelling.manage_data import rebuild_weekly_prices
+    _bulk_add_df(pd.DataFrame({"id":[1, 2, 3], "ticker":["A.L","B.L","C.L"], "company":["A","B","C"]}),
+        Ticker, session=db_session)
+    dates = pd.bdate_range("2021-01-04", "2021-01-29")
+    upsert_daily_prices(pd.concat([daily_prices(t, dates, seed=t) for t in [1, 2, 3]]), session=db_session)
+    #A week left from daily prices which have since been removed, and a wrong week
+    weekly_price.upsert_df(pd.DataFrame({
+        "ticker_id":[1, 3], "date":[dt.date(2020, 12, 28), dt.date(2021, 1, 4)], "open":-1.0, "high":-1.0,
+        "low":-1.0, "close":-1.0, "change":0.0, "volume":-1.0,
+        }), session=db_session)
+    #Fails on the second batch, which is rolled back
+    upsert_df = weekly_price.upsert_df
+    calls = []
+    def fail_second(*args, **kwargs):
+        calls.append(1)
+        if len(calls) == 2:
+            raise RuntimeError("weekly upsert failed")
+        return upsert_df(*args, **kwargs)
+    monkeypatch.setattr(weekly_price, "upsert_df", fail_second)
+    with pytest.raises(RuntimeError):
+        rebuild_weekly_prices(batch_tickers=2, session=db_session)
+    wp_df = _db_prices(db_session, "weekly_price")
+    assert (wp_df.ticker_id == 1).sum() == 4
+    assert (wp_df.close == -1).sum() == 1
+    monkeypatch.setattr(weekly_price, "upsert_df", upsert_df)
+    assert rebuild_weekly_prices(batch_tickers=2, session=db_session) == 3 * 4
+    _, expected = daily_to_weekly_price_conversion(_db_prices(db_session, "daily_price"))
+    wp_df = _db_prices(db_session, "weekly_price")[expected.columns]
+    pd.testing.assert_frame_equal(wp_df, expected, check_dtype=False)
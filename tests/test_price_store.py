@@ -0,0 +1,81 @@
+import numpy as np
+import pandas as pd
+
+from stock_trading_ml_modelling.database.models.prices import DailyPrice
+from stock_trading_ml_modelling.database.add_data import _bulk_add_df
+from stock_trading_ml_modelling.database.price_store import sync_price_store, read_prices, write_year
+
+
+def _days(st="2019-12-20", n=30):
+    return pd.bdate_range(st, periods=n)
+
+
+def test_sync_and_read(db_session, daily_prices, tmp_path):
+    df = daily_prices([2, 1, 3], _days())
+    _bulk_add_df(df, DailyPrice, session=db_session)
+    rows = sync_price_store(tables=["daily_price"], path=tmp_path, session=db_session)
+    assert rows == {"daily_price":90}
+    assert sorted(p.name for p in (tmp_path / "daily_price").iterdir()) == ["year=2019", "year=2020"]
+    out = read_prices(path=tmp_path)
+    assert out.shape[0] == 90
+    assert out.date.dtype == "datetime64[ns]"
+    ref = df.sort_values(["ticker_id","date"]).reset_index(drop=True)
+    np.testing.assert_array_equal(out.ticker_id.values, ref.ticker_id.values)
+    np.testing.assert_array_equal(out.date.values, ref.date.values)
+    np.testing.assert_array_equal(out.close.values, ref.close.values)
+
+
+def test_read_pushdown(db_session, daily_prices, tmp_path):
+    _bulk_add_df(daily_prices([1, 2, 3], _days()), DailyPrice, session=db_session)
+    sync_price_store(tables=["daily_price"], path=tmp_path, session=db_session)
+    out = read_prices(path=tmp_path, columns=["close"], ticker_ids=[2], from_date="2020-01-01", float_dtype=np.float32)
+    assert out.columns.tolist() == ["close"]
+    assert out.close.dtype == np.float32
+    assert out.shape[0] == 22
+    assert out.close.iloc[0] == 8 + 2
+
+
+def test_sync_from_date_rewrites_year(db_session, daily_prices, tmp_path):
+    _bulk_add_df(daily_prices([1], _days()), DailyPrice, session=db_session)
+    sync_price_store(tables=["daily_price"], path=tmp_path, session=db_session)
+    db_session.query(DailyPrice).filter(DailyPrice.date >= pd.Timestamp("2020-01-01").date()).update({"close":-1.0})
+    db_session.commit()
+    rows = sync_price_store(tables=["daily_price"], from_date="2020-01-10", path=tmp_path, session=db_session)
+    assert rows == {"daily_price":22}
+    out = read_prices(path=tmp_path)
+    assert (out[out.date >= "2020-01-01"].close == -1).all()
+    assert (out[out.date < "2020-01-01"].close >= 0).all()
+
+
+def test_read_missing_store(tmp_path):
+    out = read_prices(path=tmp_path, columns=["ticker_id","close"])
+    assert out.shape == (0, 2)
+
+
+def test_sync_removes_stale_years(db_session, daily_prices, tmp_path):
+    _bulk_add_df(daily_prices([1, 2], _days()), DailyPrice, session=db_session)
+    sync_price_store(tables=["daily_price"], path=tmp_path, session=db_session)
+    #Prices moved out of 2019, so it only exists in the store
+    db_session.query(DailyPrice).filter(DailyPrice.date < pd.Timestamp("2020-01-01").date()).delete()
+    db_session.commit()
+    #Before from_date so kept
+    sync_price_store(tables=["daily_price"], from_date="2020-01-01", path=tmp_path, session=db_session)
+    assert sorted(p.name for p in (tmp_path / "daily_price").iterdir()) == ["year=2019", "year=2020"]
+    rows = sync_price_store(tables=["daily_price"], path=tmp_path, session=db_session)
+    assert rows == {"daily_price":44}
+    assert sorted(p.name for p in (tmp_path / "daily_price").iterdir()) == ["year=2020"]
+    assert read_prices(path=tmp_path).shape[0] == 44
+
+
+def test_write_year_replaces_file(daily_prices, tmp_path):
+    df = daily_prices([1], _days())
+    assert write_year("daily_price", 2020, df[df.date.dt.year == 2020], path=tmp_path) == 22
+    #A write which stopped part way is not read
+    (tmp_path / "daily_price" / "year=2020" / "_part-0.parquet.tmp").write_bytes(b"partial")
+    assert read_prices(path=tmp_path).shape[0] == 22
+    df["close"] = -1.0
+    write_year("daily_price", 2020, df[df.date.dt.year == 2020], path=tmp_path)
+    assert [p.name for p in (tmp_path / "daily_price" / "year=2020").iterdir()] == ["part-0.parquet"]
+    out = read_prices(path=tmp_path)
+    assert out.shape[0] == 22
+    assert (out.close == -1).all()
@@ -0,0 +1,444 @@
+import asyncio
+import datetime as dt
+from pathlib import Path
+from bs4 import BeautifulSoup as bs
+import pandas as pd
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from stock_trading_ml_modelling.config import CONFIG
+from stock_trading_ml_modelling.scrapping.multi_scrape import MultiTickerScrape
+from stock_trading_ml_modelling.scrapping.scrapes import AsyncScrape, ScrapePrices, HostRateLimiter, create_client_session
+from stock_trading_ml_modelling.scrapping.http_cache import HttpCache, NEVER_EXPIRES
+from stock_trading_ml_modelling.scrapping.price_parser import parse_price_table, available_backends
+from stock_trading_ml_modelling.scrapping.request_policy import RetryPolicy, CircuitBreaker, RequestMetrics, \
+    ScrapeError, CircuitOpenError, parse_retry_after
+
+
+@pytest.fixture(autouse=True)
+def no_default_cache(monkeypatch):
+    #Keep the tests from reading or writing the real cache
+    monkeypatch.setitem(CONFIG["scrape"]["cache"], "mode", "off")
+
+
+PAGE = """<html><body><table data-test="historical-prices">
+<thead><tr><th>Date</th><th>Open</th><th>High</th><th>Low</th><th>Close*</th><th>Adj Close**</th><th>Volume</th></tr></thead>
+<tbody>{}</tbody></table></body></html>"""
+ROW = "<tr><td>{}</td><td>{p}</td><td>{p}</td><td>{p}</td><td>{p}</td><td>{p}</td><td>1,000</td></tr>"
+
+
+def _price_page(period1, period2, price):
+    dates = pd.bdate_range(dt.datetime.utcfromtimestamp(int(period1)), dt.datetime.utcfromtimestamp(int(period2)), inclusive="left")
+    return PAGE.format("".join(ROW.format(d.strftime("%b %d, %Y"), p=price) for d in reversed(dates)))
+
+
+class StubYahoo:
+    """Serves price pages, counting the requests in flight"""
+    def __init__(self, delay=0.02, fail_tickers=()):
+        self.delay = delay
+        self.fail_tickers = fail_tickers
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.requests = []
+
+    async def history(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.requests.append(request.match_info["ticker"])
+        try:
+            await asyncio.sleep(self.delay)
+            if request.match_info["ticker"] in self.fail_tickers:
+                return web.Response(status=200, text="<html>no table</html>")
+            price = 100 + len(request.match_info["ticker"].split(".")[0])
+            return web.Response(text=_price_page(request.query["period1"], request.query["period2"], price), content_type="text/html")
+        finally:
+            self.in_flight -= 1
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/quote/{ticker}/history", self.history)
+        return app
+
+
+def _patch_url(monkeypatch, server):
+    monkeypatch.setitem(CONFIG["web_addr"], "share_price",
+        f"http://{server.host}:{server.port}/quote/{{}}/history?period1={{}}&period2={{}}&interval={{}}&frequency={{}}")
+
+
+def _run_scrape(monkeypatch, stub, jobs, **kwargs):
+    async def main():
+        async with TestServer(stub.app()) as server:
+            _patch_url(monkeypatch, server)
+            scraper = MultiTickerScrape(jobs, **kwargs)
+            await scraper.run_tasks()
+            return scraper
+    return asyncio.run(main())
+
+
+def _jobs(tickers, days=300):
+    en_date = dt.datetime(2021, 1, 1)
+    return [{"ticker":t, "ticker_id":i, "st_date":en_date - dt.timedelta(days=days), "en_date":en_date}
+        for i,t in enumerate(tickers, start=1)]
+
+
+def test_multi_ticker_scrape_writes_every_ticker(monkeypatch):
+    written = []
+    stub = StubYahoo()
+    jobs = _jobs(["AAA", "BB", "CCCC", "D"])
+    scraper = _run_scrape(monkeypatch, stub, jobs, concurrency=3, limit_per_host=3, host_rate=0, write_func=written.append)
+    assert scraper.errors == []
+    #300 days is 3 pages per ticker
+    assert len(stub.requests) == 12
+    assert stub.max_in_flight <= 3
+    assert sorted(df.ticker_id.iloc[0] for df in written) == [1, 2, 3, 4]
+    for df in written:
+        assert df.date.is_unique
+        assert (df.close == 100 + len(df.ticker.iloc[0])).all()
+        assert {"ticker_id","date","week_start_date","open","close","volume"} <= set(df.columns)
+
+
+def test_multi_ticker_scrape_errors_do_not_stop_others(monkeypatch):
+    written = []
+    stub = StubYahoo(fail_tickers=("BAD.L",))
+
+    def write_func(df):
+        if df.ticker_id.iloc[0] == 3:
+            raise ValueError("db locked")
+        written.append(df)
+
+    jobs = _jobs(["GOOD", "BAD", "WRITEFAIL"], days=50)
+    scraper = _run_scrape(monkeypatch, stub, jobs, host_rate=0, write_func=write_func)
+    assert [df.ticker_id.iloc[0] for df in written] == [1]
+    assert sorted(e["ticker"] for e in scraper.errors) == ["BAD", "WRITEFAIL"]
+    assert set(scraper.written) == {1}
+
+
+def test_multi_ticker_scrape_host_rate(monkeypatch):
+    stub = StubYahoo(delay=0)
+    jobs = _jobs(["AAA", "BBB"], days=50)
+    loop_times = []
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            _patch_url(monkeypatch, server)
+            scraper = MultiTickerScrape(jobs, host_rate=20, write_func=lambda df: None)
+            st_time = asyncio.get_running_loop().time()
+            await scraper.run_tasks()
+            loop_times.append(asyncio.get_running_loop().time() - st_time)
+
+    asyncio.run(main())
+    #2 requests at 20 a second to one host are spaced by 0.05s
+    assert loop_times[0] >= 0.05
+
+
+class StubResponses:
+    """Serves a scripted sequence of responses, (status, delay secs, headers) per request"""
+    def __init__(self, script):
+        self.script = list(script)
+        self.times = []
+
+    async def handle(self, request):
+        self.times.append(asyncio.get_running_loop().time())
+        status, delay, headers = self.script.pop(0) if self.script else (200, 0, {})
+        await asyncio.sleep(delay)
+        return web.Response(status=status, text="body" if status == 200 else "error", headers=headers)
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/page", self.handle)
+        return app
+
+
+def _policy(**kwargs):
+    kwargs = {"retries":3, "backoff_base":0.01, "backoff_max":0.05, "request_timeout":1.0, "total_timeout":5.0, **kwargs}
+    return RetryPolicy(**kwargs)
+
+
+def _request(stub, policy):
+    """Request the stub page once, returning the result (or error) and the scraper"""
+    scraper = AsyncScrape(None, [], retry_policy=policy, breaker=CircuitBreaker(threshold=100, reset_secs=60))
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            url = f"http://{server.host}:{server.port}/page"
+            async with create_client_session(4, 4) as session:
+                try:
+                    return await scraper.async_request(session, url), url
+                except ScrapeError as e:
+                    return e, url
+    out, url = asyncio.run(main())
+    return out, scraper, url
+
+
+def test_async_request_retries_server_errors():
+    stub = StubResponses([(503, 0, {}), (500, 0, {}), (200, 0, {})])
+    body, scraper, url = _request(stub, _policy())
+    assert body == "body"
+    rec = scraper.metrics.urls[url]
+    assert rec["attempts"] == 3
+    assert rec["ok"]
+    assert len(rec["latencies"]) == 3
+    assert scraper.metrics.summary()["retried_urls"] == 1
+
+
+def test_async_request_gives_up_after_retries():
+    stub = StubResponses([(503, 0, {})] * 5)
+    err, scraper, url = _request(stub, _policy())
+    assert isinstance(err, ScrapeError)
+    assert "HTTP 503" in str(err)
+    assert len(stub.times) == 3
+    df = scraper.metrics.to_df()
+    assert df.attempts.tolist() == [3]
+    assert not df.ok.iloc[0]
+
+
+def test_async_request_does_not_retry_client_errors():
+    stub = StubResponses([(404, 0, {}), (200, 0, {})])
+    err, _, _ = _request(stub, _policy())
+    assert isinstance(err, ScrapeError)
+    assert len(stub.times) == 1
+
+
+def test_async_request_honours_retry_after():
+    stub = StubResponses([(429, 0, {"Retry-After":"1"}), (200, 0, {})])
+    body, _, _ = _request(stub, _policy())
+    assert body == "body"
+    assert stub.times[1] - stub.times[0] >= 1.0
+
+
+def test_async_request_timeouts():
+    #Each attempt times out, then the total timeout stops the retries
+    stub = StubResponses([(200, 1.0, {})] * 5)
+    err, scraper, url = _request(stub, _policy(request_timeout=0.1, retries=3))
+    assert isinstance(err, ScrapeError)
+    assert scraper.metrics.urls[url]["attempts"] == 3
+    assert all(t < 0.5 for t in scraper.metrics.urls[url]["latencies"])
+    stub = StubResponses([(200, 1.0, {})] * 5)
+    err, _, _ = _request(stub, _policy(request_timeout=0.5, retries=10, total_timeout=0.3))
+    assert "Timed out" in str(err)
+
+
+def test_total_timeout_excludes_rate_limit_queue():
+    #30 urls at 20 a second queue for 1.5s, longer than the total timeout of each url
+    stub = StubResponses([])
+    scraper = AsyncScrape(lambda text: text, [], text_func=True, rate_limiter=HostRateLimiter(20),
+        retry_policy=_policy(total_timeout=0.5))
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            scraper.urls = [f"http://{server.host}:{server.port}/page?i={i}" for i in range(30)]
+            async with create_client_session(4, 4) as session:
+                return await scraper.run_session(session)
+    assert asyncio.run(main()) == ["body"] * 30
+    assert len(stub.times) == 30
+    assert stub.times[-1] - stub.times[0] >= 29 / 20 - 0.05
+
+
+def test_circuit_breaker_opens_and_resets():
+    clock = [0.0]
+    breaker = CircuitBreaker(threshold=2, reset_secs=10, clock=lambda: clock[0])
+    stub = StubResponses([(503, 0, {})] * 2 + [(200, 0, {})] * 5)
+    scraper = AsyncScrape(None, [], retry_policy=_policy(retries=2), breaker=breaker)
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            url = f"http://{server.host}:{server.port}/page"
+            async with create_client_session(4, 4) as session:
+                with pytest.raises(ScrapeError, match="HTTP 503"):
+                    await scraper.async_request(session, url)
+                #Refused without reaching the server
+                with pytest.raises(CircuitOpenError):
+                    await scraper.async_request(session, url)
+                assert len(stub.times) == 2
+                #After the reset time a trial request is let through and closes the circuit
+                clock[0] = 11
+                assert await scraper.async_request(session, url) == "body"
+                assert breaker.failures == {} and breaker.opened_at == {}
+
+    asyncio.run(main())
+
+
+def test_parse_retry_after():
+    now = dt.datetime(2021, 1, 1, 12, 0, 0, tzinfo=dt.timezone.utc)
+    assert parse_retry_after(None) is None
+    assert parse_retry_after("120") == 120
+    assert parse_retry_after("Fri, 01 Jan 2021 12:00:30 GMT", now=now) == 30
+    assert parse_retry_after("not a date") is None
+
+
+def test_backoff_is_bounded():
+    policy = _policy(backoff_base=1, backoff_max=4)
+    delays = [policy.backoff(i) for i in range(10) for _ in range(20)]
+    assert min(delays) >= 0
+    assert max(delays) <= 4
+    assert policy.backoff(0, retry_after=7) >= 7
+
+
+class StubETag:
+    """Serves a page with an ETag, answering 304 when the client already has it"""
+    def __init__(self, etag='"v1"'):
+        self.etag = etag
+        self.requests = []
+
+    async def handle(self, request):
+        self.requests.append(request.headers.get("If-None-Match"))
+        if request.headers.get("If-None-Match") == self.etag:
+            return web.Response(status=304, headers={"ETag":self.etag})
+        return web.Response(text=f"page {self.etag}", headers={"ETag":self.etag})
+
+    def app(self):
+        app = web.Application()
+        app.router.add_get("/page", self.handle)
+        return app
+
+
+def _cached_requests(stub, cache, ttl, n=1):
+    """Request the stub page n times through a cache"""
+    scraper = AsyncScrape(None, [], retry_policy=_policy(), cache=cache, ttl=ttl)
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            url = f"http://{server.host}:{server.port}/page"
+            async with create_client_session(4, 4) as session:
+                return [await scraper.async_request(session, url) for _ in range(n)], url
+    out, url = asyncio.run(main())
+    return out, scraper, url
+
+
+def test_http_cache_store(tmp_path):
+    clock = [1000.0]
+    cache = HttpCache(tmp_path / "cache.db", mode="normal", clock=lambda: clock[0])
+    assert cache.get("http://a/1") is None
+    cache.put("http://a/1", "body \u00a3", etag='"x"')
+    entry = cache.get("http://a/1")
+    assert entry.body == "body \u00a3"
+    assert cache.conditional_headers(entry) == {"If-None-Match":'"x"'}
+    clock[0] += 100
+    assert cache.is_fresh(entry, 101)
+    assert not cache.is_fresh(entry, 100)
+    assert cache.is_fresh(entry, NEVER_EXPIRES)
+    cache.touch("http://a/1")
+    assert cache.get("http://a/1").fetched_at == 1100
+    #Persists between connections
+    cache.close()
+    cache = HttpCache(tmp_path / "cache.db", mode="normal")
+    assert cache.get("http://a/1").body == "body \u00a3"
+    cache.clear()
+    assert cache.get("http://a/1") is None
+
+
+def test_async_request_serves_fresh_pages_from_cache(tmp_path):
+    stub = StubETag()
+    cache = HttpCache(tmp_path / "cache.db", mode="normal")
+    out, scraper, _ = _cached_requests(stub, cache, ttl=3600, n=3)
+    assert out == ['page "v1"'] * 3
+    assert len(stub.requests) == 1
+    assert scraper.metrics.cache_hits == 2
+
+
+def test_error_pages_are_not_cached(tmp_path, monkeypatch):
+    #A historic window (never expires) served as a 200 page without the price table
+    stub = StubYahoo(delay=0, fail_tickers=("BAD.L",))
+    cache = HttpCache(tmp_path / "cache.db", mode="normal")
+    scrape = ScrapePrices("BAD", dt.datetime(2020, 1, 1), dt.datetime(2020, 2, 1), parser="lxml")
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            _patch_url(monkeypatch, server)
+            url = scrape.urls()[0]
+            async with create_client_session(4, 4) as session:
+                for _ in range(3):
+                    with pytest.raises(ValueError):
+                        await scrape.async_scrape(cache=cache, executor=None).run_session(session)
+                #A bad page already in the cache is dropped once it fails to parse
+                cache.put(url, "<html>consent</html>")
+                with pytest.raises(ValueError):
+                    await scrape.async_scrape(cache=cache, executor=None).run_session(session)
+                return url
+    url = asyncio.run(main())
+    assert len(stub.requests) == 3
+    assert cache.get(url) is None
+    assert scrape.url_ttls()[url] == NEVER_EXPIRES
+
+
+def test_async_request_revalidates_stale_pages(tmp_path):
+    stub = StubETag()
+    cache = HttpCache(tmp_path / "cache.db", mode="normal")
+    out, scraper, url = _cached_requests(stub, cache, ttl=0, n=2)
+    assert out == ['page "v1"'] * 2
+    #The second request sends the ETag and gets a 304
+    assert stub.requests == [None, '"v1"']
+    assert scraper.metrics.urls[url]["status"] == 304
+    #A changed page replaces the cached one
+    stub.etag = '"v2"'
+    out, _, _ = _cached_requests(stub, cache, ttl=0)
+    assert out == ['page "v2"']
+
+
+def test_async_request_offline_replay(tmp_path):
+    stub = StubETag()
+    cache = HttpCache(tmp_path / "cache.db", mode="normal")
+    _, _, url = _cached_requests(stub, cache, ttl=0)
+    cache.mode = "offline"
+    scraper = AsyncScrape(None, [], cache=cache, ttl=0)
+
+    async def main():
+        async with create_client_session(4, 4) as session:
+            assert await scraper.async_request(session, url) == 'page "v1"'
+            with pytest.raises(ScrapeError, match="not in the cache"):
+                await scraper.async_request(session, url + "?other")
+
+    asyncio.run(main())
+    assert len(stub.requests) == 1
+
+
+def test_scrape_prices_historic_windows_never_expire():
+    today = dt.datetime.combine(dt.date.today(), dt.time())
+    url_ttls = ScrapePrices("AAA", today - dt.timedelta(days=400), today).url_ttls()
+    ttls = list(url_ttls.values())
+    assert len(ttls) == 3
+    #The latest window may still change, older ones cannot
+    assert ttls[0] == CONFIG["scrape"]["cache"]["ttl"]["share_price"]
+    assert ttls[1:] == [NEVER_EXPIRES, NEVER_EXPIRES]
+
+
+FIXTURE = Path(__file__).parent / "fixtures" / "yahoo_history_prices.html"
+
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_parse_price_table_matches_process_soup(backend):
+    html = FIXTURE.read_text(encoding="utf-8")
+    expected = ScrapePrices("AAA", parser="bs4").process_soup(bs(html, "html.parser"))
+    cols = parse_price_table(html, backend=backend)
+    assert list(cols) == ["date","open","high","low","close","adj_close","volume"]
+    #The dividend row is skipped
+    assert len(cols["date"]) == len(expected) == 140
+    assert [dict(zip(cols, r)) for r in zip(*cols.values())] == expected
+
+
+@pytest.mark.parametrize("backend", available_backends())
+def test_parse_price_table_without_table(backend):
+    assert parse_price_table("", backend=backend) == {}
+    with pytest.raises(ValueError):
+        parse_price_table("<html><body>Consent</body></html>", backend=backend)
+
+
+def test_scrape_prices_parsers_give_same_frame(monkeypatch):
+    stub = StubYahoo(delay=0)
+
+    async def main():
+        async with TestServer(stub.app()) as server:
+            _patch_url(monkeypatch, server)
+            async with create_client_session(4, 4) as session:
+                return [
+                    await ScrapePrices("AAA", dt.datetime(2020, 1, 1), dt.datetime(2020, 12, 1), parser=parser) \
+                        .scrape_session(session, retry_policy=_policy())
+                    for parser in ["bs4", "lxml"]
+                    ]
+
+    bs4_df, lxml_df = asyncio.run(main())
+    assert lxml_df.shape[0] > 200
+    assert lxml_df.close.iloc[0] == "103"
+    pd.testing.assert_frame_equal(bs4_df, lxml_df)
+
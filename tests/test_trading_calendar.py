@@ -0,0 +1,124 @@
+import datetime as dt
+import numpy as np
+import pandas as pd
+import pytest
+
+from stock_trading_ml_modelling.scrapping import scrape_data
+from stock_trading_ml_modelling.database import daily_price, market_holiday
+from stock_trading_ml_modelling.database.get_data import sqlaq_to_df
+from stock_trading_ml_modelling.database.models.prices import MarketHolidayYear
+from stock_trading_ml_modelling.libs.trading_calendar import TradingCalendar, load_holidays, find_price_gaps
+
+HOLIDAYS = ["2021-01-01", "2021-04-02", "2021-04-05", "2021-12-27", "2021-12-28"]
+
+
+def _days(dates):
+    return np.array(dates, dtype="datetime64[D]")
+
+
+def test_trading_dates():
+    calendar = TradingCalendar(HOLIDAYS)
+    days = calendar.trading_dates(dt.datetime(2021, 3, 31), dt.datetime(2021, 4, 9))
+    np.testing.assert_array_equal(days, _days(["2021-03-31", "2021-04-01", "2021-04-06", "2021-04-07", "2021-04-08", "2021-04-09"]))
+    assert calendar.is_trading_day(pd.Series(pd.to_datetime(["2021-04-02", "2021-04-03", "2021-04-06"]))).tolist() == [False, False, True]
+    assert len(calendar.trading_dates(dt.date(2021, 1, 1), dt.date(2021, 12, 31))) == 261 - len(HOLIDAYS)
+
+
+def test_missing_dates():
+    calendar = TradingCalendar(HOLIDAYS)
+    days = calendar.trading_dates("2021-01-04", "2021-01-29")
+    #A price on a weekend is ignored
+    dates = pd.to_datetime(list(np.delete(days, [3, 4, 10])) + ["2021-01-23"])
+    np.testing.assert_array_equal(calendar.missing_dates(dates, dt.date(2021, 1, 1), dt.date(2021, 1, 29)), days[[3, 4, 10]])
+    np.testing.assert_array_equal(calendar.missing_dates(days[12:], days[12], days[-1]), [])
+    np.testing.assert_array_equal(calendar.missing_dates([], days[12], days[-1]), days[12:])
+
+
+def test_load_holidays_stores_scrapes(db_session, monkeypatch):
+    scraped = []
+    def get_named_public_holidays(year):
+        scraped.append(year)
+        return [(pd.Timestamp(d).to_pydatetime(), "Holiday") for d in HOLIDAYS if d.startswith(str(year))]
+    monkeypatch.setattr(scrape_data, "get_named_public_holidays", get_named_public_holidays)
+    np.testing.assert_array_equal(load_holidays([2021], session=db_session), _days(HOLIDAYS))
+    #Stored years are read from the db, future years are not scraped
+    np.testing.assert_array_equal(load_holidays([2020, 2021, dt.date.today().year + 1], session=db_session), _days(HOLIDAYS))
+    assert scraped == [2021, 2020]
+    calendar = TradingCalendar.from_db(dt.date(2021, 1, 1), dt.date(2021, 12, 31), session=db_session)
+    np.testing.assert_array_equal(calendar.holidays, _days(HOLIDAYS))
+    #Years with no holidays found are recorded as scraped so are not scraped again
+    calendar = TradingCalendar.from_db(dt.date(2019, 1, 1), dt.date(2021, 12, 31), session=db_session)
+    np.testing.assert_array_equal(calendar.holidays, _days(HOLIDAYS))
+    assert scraped == [2021, 2020, 2019]
+    assert sqlaq_to_df(market_holiday.fetch_years(), session=db_session).year.tolist() == [2019, 2020, 2021]
+
+
+def test_load_holidays_refreshes_current_year(db_session, monkeypatch):
+    today = dt.date.today()
+    year = today.year
+    holidays = {year:[dt.date(year, 1, 1), dt.date(year, 12, 25)], year - 1:[dt.date(year - 1, 12, 25)]}
+    scraped = []
+    def get_named_public_holidays(year):
+        scraped.append(year)
+        return [(dt.datetime.combine(d, dt.time()), "Holiday") for d in holidays[year]]
+    monkeypatch.setattr(scrape_data, "get_named_public_holidays", get_named_public_holidays)
+    #Stored before the years scraped were recorded, with a holiday since moved
+    market_holiday.upsert_df(pd.DataFrame({
+        "date":[dt.date(year - 1, 12, 25), dt.date(year, 1, 1), dt.date(year, 12, 24)],
+        "name":"Holiday",
+        }), session=db_session)
+    np.testing.assert_array_equal(load_holidays([year - 1, year], session=db_session),
+        _days(holidays[year - 1] + holidays[year]))
+    #Only the current year is scraped again and the moved holiday is removed
+    assert scraped == [year]
+    stored = sqlaq_to_df(market_holiday.fetch(), session=db_session)
+    assert pd.to_datetime(stored.date).dt.date.tolist() == holidays[year - 1] + holidays[year]
+    fetched = sqlaq_to_df(market_holiday.fetch_years(), session=db_session)
+    assert fetched.year.tolist() == [year]
+    assert pd.Timestamp(fetched.fetched_date.iloc[0]).date() == today
+    #Within the ttl the stored holidays are used
+    load_holidays([year], session=db_session)
+    assert scraped == [year]
+    #Scraped again once the ttl has passed
+    db_session.query(MarketHolidayYear).update({"fetched_date":today - dt.timedelta(days=31)})
+    db_session.commit()
+    load_holidays([year], session=db_session)
+    assert scraped == [year, year]
+    #A scrape with no holidays keeps the stored ones
+    holidays[year] = []
+    db_session.query(MarketHolidayYear).update({"fetched_date":today - dt.timedelta(days=31)})
+    db_session.commit()
+    np.testing.assert_array_equal(load_holidays([year], session=db_session), _days([dt.date(year, 1, 1), dt.date(year, 12, 25)]))
+    assert scraped == [year, year, year]
+    load_holidays([year], session=db_session)
+    assert scraped == [year, year, year]
+
+
+def test_find_price_gaps(db_session, daily_prices):
+    calendar = TradingCalendar(HOLIDAYS)
+    days = calendar.trading_dates("2021-03-01", "2021-05-28")
+    #Ticker 1 - two missing days over easter and a run of 12, ticker 2 - one missing day
+    #and listed part way through, ticker 3 - no gaps
+    prices = [
+        (1, np.delete(days, [22, 23] + list(range(40, 52)))),
+        (2, np.delete(days[30:], [5])),
+        (3, days),
+        ]
+    daily_price.upsert_df(pd.concat([daily_prices(t, dates) for t, dates in prices]), session=db_session)
+    gaps = find_price_gaps(calendar, dt.date(2021, 3, 1), dt.date(2021, 5, 28), max_days=7, session=db_session)
+    expected = [
+        (1, days[22], days[23], 2),
+        #The run of 12 (wed 28th apr to thu 13th may) split into spans of at most 7 days
+        (1, days[40], days[45], 6),
+        (1, days[46], days[51], 6),
+        (2, days[35], days[35], 1),
+        ]
+    assert [(r.ticker_id, np.datetime64(r.st_date, "D"), np.datetime64(r.en_date, "D"), r.missing_days)
+        for r in gaps.itertuples()] == expected
+    #The same days as the array diff after each ticker's first price
+    for ticker_id, dates in prices:
+        missing = calendar.missing_dates(dates, dates[0], days[-1])
+        assert gaps[gaps.ticker_id == ticker_id].missing_days.sum() == len(missing)
+    #Filtered to tickers
+    assert find_price_gaps(calendar, dt.date(2021, 3, 1), dt.date(2021, 5, 28), ticker_ids=[2, 3], session=db_session) \
+        .ticker_id.tolist() == [2]
@@ -0,0 +1,119 @@
+import threading
+import time
+import numpy as np
+import pandas as pd
+import pytest
+from concurrent.futures import ThreadPoolExecutor
+
+#libs.data needs pandas_ta
+pytest.importorskip("pandas_ta")
+
+from stock_trading_ml_modelling.modelling.training_data import TrainingData, bounded_map
+
+
+def _training_data(n_jobs, prices):
+    training_data = TrainingData(macd_sht=[3, 6, 2], macd_lng=[6, 13, 4], window=16, n_jobs=n_jobs)
+    #Set so get_price_data does not read the db
+    training_data.prices = prices.copy()
+    return training_data
+
+
+def _loop_create_data(training_data):
+    """The original create_data loop, kept as the reference implementation - each
+    ticker's windows concatenated onto X and y"""
+    prices = training_data.prices
+    X = y = None
+    for tick_id in prices.ticker_id.unique():
+        tick_prices = prices[prices.ticker_id == tick_id]
+        encoded_signal, close, _open, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi = \
+            training_data.create_ticker_data(tick_prices)
+        tick_X = training_data.zip_data([_open, close, tail, head, macd_sht_pos, macd_sht_neg, macd_lng_pos, macd_lng_neg, rsi])
+        X = tick_X if X is None else np.concatenate((X, tick_X), axis=0)
+        y = encoded_signal if y is None else np.concatenate((y, encoded_signal), axis=None)
+    return X, y
+
+
+def test_bounded_map_in_order():
+    lock = threading.Lock()
+    running = {"now":0, "max":0}
+    def func(x):
+        with lock:
+            running["now"] += 1
+            running["max"] = max(running["max"], running["now"])
+        time.sleep(0.01 * (x % 3))
+        with lock:
+            running["now"] -= 1
+        return x * 2
+    read = []
+    def items():
+        for x in range(20):
+            read.append(x)
+            yield x
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        results = bounded_map(executor, func, items(), 3)
+        assert next(results) == 0
+        #Only the window has been read from the iterable
+        assert len(read) == 4
+        assert [0] + list(results) == [x * 2 for x in range(20)]
+    assert running["max"] <= 3
+    with ThreadPoolExecutor(max_workers=2) as executor:
+        assert list(bounded_map(executor, func, [], 3)) == []
+
+
+def test_create_data_parallel_matches_serial(model_prices):
+    #Ticker 3 is shorter than the window so is bulked to a single window
+    prices = model_prices({1:60, 2:45, 3:10, 4:30})
+    serial = _training_data(1, prices)
+    serial.create_data()
+    parallel = _training_data(2, prices)
+    parallel.create_data()
+    assert serial.X.shape == (45 + 30 + 1 + 15, 9, 16)
+    np.testing.assert_array_equal(parallel.X, serial.X)
+    np.testing.assert_array_equal(parallel.y, serial.y)
+    pd.testing.assert_frame_equal(parallel.row_index, serial.row_index)
+
+
+def test_create_data_matches_concatenated_tickers(tmp_path, monkeypatch, model_prices):
+    prices = model_prices({1:60, 2:45, 3:10})
+    training_data = _training_data(1, prices)
+    training_data.create_data()
+    X, y = _loop_create_data(training_data)
+    np.testing.assert_array_equal(training_data.X, X)
+    np.testing.assert_array_equal(training_data.y, y)
+    assert training_data.X.dtype == np.float32
+    assert training_data.row_index.groupby("ticker_id").size().to_dict() == {1:45, 2:30, 3:1}
+    #The same split as copying the data
+    X_train, X_test, y_train, y_test = training_data.test_train_split(X, y)
+    np.testing.assert_array_equal(training_data.X_train, X_train)
+    np.testing.assert_array_equal(training_data.X_test, X_test)
+    np.testing.assert_array_equal(training_data.y_train, y_train)
+    np.testing.assert_array_equal(training_data.y_test, y_test)
+    #Built straight into memmapped shards
+    monkeypatch.chdir(tmp_path)
+    memmapped = _training_data(1, prices)
+    memmapped.create_data(memmap=True)
+    np.testing.assert_array_equal(memmapped.X[:], X)
+    assert len(list((tmp_path / "data" / "default").glob("X_*.npy"))) == 3
+
+
+def test_create_data_sorts_prices(model_prices):
+    prices = model_prices({1:40, 2:30, 3:20})
+    ordered = _training_data(1, prices)
+    ordered.create_data()
+    #Tickers interleaved and dates out of order
+    shuffled = _training_data(1, prices.sample(frac=1, random_state=0))
+    shuffled.create_data()
+    np.testing.assert_array_equal(shuffled.X, ordered.X)
+    np.testing.assert_array_equal(shuffled.y, ordered.y)
+    pd.testing.assert_frame_equal(shuffled.row_index, ordered.row_index)
+    assert (shuffled.row_index.groupby("ticker_id").date.max() == pd.Timestamp("2021-06-30")).all()
+
+
+def test_create_data_empty(model_prices):
+    training_data = _training_data(1, model_prices({1:1}).iloc[:0])
+    training_data.create_data()
+    assert training_data.X.shape == (0, 9, 16)
+    assert training_data.y.shape == (0,)
+    assert training_data.train_idx.shape == (0,) and training_data.test_idx.shape == (0,)
+    assert training_data.X_train.shape == (0, 9, 16)
+    assert training_data.signals.shape == (0,)